@@ -0,0 +1,287 @@
+"""Establishing new reference sequences and aligning them with previous ones (adaptive updates),
+either on the frame-processing path or on a background thread while sync continues."""
+
+# Python imports
+import copy
+import queue
+import threading
+
+# Module imports
+from loguru import logger
+
+# Optical Gating Alignment module
+import optical_gating_alignment.optical_gating_alignment as oga
+
+# Local imports
+from . import alignment_history
+from . import determine_reference_period as ref
+from . import prospective_optical_gating as pog
+from . import parameters
+from . import ring_buffer
+from . import sad_backends
+
+# The pog_settings keys that describe the reference sequence itself.
+# These must all be replaced together whenever a new reference sequence is swapped in.
+REFERENCE_KEYS = (
+    "reference_period",
+    "referenceFrameCount",
+    "targetSyncPhase",
+    "referenceFrame",
+    "barrierFrame",
+    "frameToUseArray",
+    "roi",
+)
+
+
+def establish_reference(ref_buffer, frame, timestamp, period_guesses, settings, max_duration=None):
+    """ Add a frame to 'ref_buffer', and attempt to establish a reference sequence from the frames it now holds.
+        If successful, we also identify the region of interest (if settings["auto_roi"] is set),
+        the target frame and the barrier frames for the new reference sequence.
+        Parameters:
+            ref_buffer      FrameRingBuffer Buffer of recent frames
+            frame           array-like      2D frame pixel data
+            timestamp       float           Timestamp associated with the frame
+            period_guesses  list            Period estimates for previous frames (updated in place)
+            settings        dict            Parameters controlling the sync algorithms
+            max_duration    float           If not None, the maximum time (in seconds) that the buffer should span
+        Returns:
+            ref_frames      ndarray         3D view onto ref_buffer holding the new reference sequence (or None)
+            settings        dict            Updated settings
+    """
+    # Adds new frame to buffer (the ring buffer discards the oldest frame once it is full)
+    ref_buffer.append(frame, timestamp)
+    # Impose an upper limit on the buffer duration, to protect against performance degradation
+    # in cases where we are not succeeding in identifying a period
+    if (max_duration is not None) and (ref_buffer.duration() > max_duration):
+        logger.debug("Trimming buffer to duration {0}".format(max_duration))
+        ref_buffer.drop_oldest()
+
+    # Compare the new frame against the earlier ones. The ring buffer keeps these SADs,
+    # so that we do not need to recompute any of them when picking the target frame below
+    diffs = ref_buffer.update_sads(
+        sad_backends.get_backend(settings["sad_backend"]).sad_with_references,
+        settings["roi"],
+    )
+
+    # Calculate period from determine_reference_period.py
+    logger.info("Attempting to determine new reference period.")
+    start, stop, settings = ref.establish_indices(
+        ref_buffer.frames(), period_guesses, settings, diffs=diffs
+    )
+    if start is None or stop is None:
+        return None, settings
+
+    # ref_frames is a 3D array view onto ref_buffer (which is what oga expects to work with).
+    # No copy is needed, provided the caller starts a new buffer rather than appending any more frames to this one
+    ref_frames = ref_buffer.frames()[start:stop]
+
+    # Identify the region of the frame containing the moving heart, if requested
+    if settings["auto_roi"]:
+        settings["roi"] = pog.determine_roi(ref_frames, settings)
+
+    # Automatically select a target frame and barrier, reusing the SADs between consecutive frames
+    # if we have them (we won't, if the region of interest has just changed).
+    # This can be overriden by the user/controller later
+    numExtra = settings["numExtraRefFrames"]
+    deltas = ref_buffer.consecutive_sads(start + numExtra, stop - numExtra, settings["roi"])
+    settings = pog.pick_target_and_barrier_frames(ref_frames, settings, deltas=deltas)
+
+    # Determine barrier frames
+    settings = pog.determine_barrier_frames(settings)
+    return ref_frames, settings
+
+
+def align_reference(
+    ref_frames,
+    settings,
+    sequence_history,
+    period_history,
+    drift_history,
+    shift_history,
+    global_solution,
+    max_sequences=None,
+):
+    """ Align a new reference sequence relative to the previous ones (see oga.process_sequence),
+        and move the target frame to the phase that matches the target in our original reference sequence.
+        Parameters:
+            ref_frames      ndarray     3D (t by x by y) frame pixel data for the new reference sequence
+            settings        dict        Parameters controlling the sync algorithms
+            (the next five parameters are the history of previous reference sequences, as returned by oga)
+            max_sequences   int         Maximum number of sequences to retain in the history
+                                         (see alignment_history.compact_history), or None for no limit
+        Returns:
+            sequence_history, period_history, drift_history, shift_history, global_solution
+                                        Updated history (including the new reference sequence)
+            target          float       Target phase in the new reference sequence (out of 80)
+            settings        dict        Updated settings
+    """
+    (
+        sequence_history,
+        period_history,
+        drift_history,
+        shift_history,
+        global_solution,
+        target,
+    ) = oga.process_sequence(
+        ref_frames,
+        settings["reference_period"],
+        settings["drift"],
+        sequence_history=sequence_history,
+        period_history=period_history,
+        drift_history=drift_history,
+        shift_history=shift_history,
+        global_solution=global_solution,
+        max_offset=3,
+        ref_seq_id=0,
+        ref_seq_phase=settings["referenceFrame"],
+    )
+    (
+        sequence_history,
+        period_history,
+        drift_history,
+        shift_history,
+        global_solution,
+    ) = alignment_history.compact_history(
+        sequence_history,
+        period_history,
+        drift_history,
+        shift_history,
+        global_solution,
+        max_sequences,
+    )
+    settings = parameters.update(
+        settings,
+        referenceFrame=(
+            settings["reference_period"] * target / 80
+        )  # TODO 80 here should be a user-defined variable; we tend not to change it but let's give them the option
+        % settings["reference_period"],
+    )
+    return (
+        sequence_history,
+        period_history,
+        drift_history,
+        shift_history,
+        global_solution,
+        target,
+        settings,
+    )
+
+
+class BackgroundAdapter:
+    """ Carries out an adaptive update (establishing a new reference sequence with establish_reference,
+        and aligning it with align_reference) on a background thread, so that the caller can continue
+        to sync (and send triggers) using its current reference sequence in the meantime.
+
+        The caller passes every new frame to submit(). Once the update is complete, 'result' is set
+        (and further frames are ignored), and the caller should swap in the new reference sequence
+        between frames. If the update fails, 'error' is set instead.
+        Establishing a period requires consecutive frames, so if the background thread falls so far behind
+        that frames have to be dropped, it discards the frames it has buffered and starts again.
+    """
+
+    def __init__(
+        self,
+        settings,
+        oga_history,
+        buffer_capacity,
+        max_duration=None,
+        max_sequences=None,
+    ):
+        """Function inputs:
+            settings        dict    Parameters controlling the sync algorithms (the adapter works on a copy)
+            oga_history     tuple   (sequence_history, period_history, drift_history, shift_history, global_solution)
+                                     The caller must not modify these until the update is complete.
+            buffer_capacity int     Maximum number of frames to buffer while establishing the new period
+            max_duration    float   If not None, the maximum time (in seconds) that the buffered frames should span
+            max_sequences   int     Maximum number of sequences to retain in the history (see align_reference)
+        """
+        self.settings = copy.deepcopy(settings)
+        self.oga_history = oga_history
+        self.max_duration = max_duration
+        self.max_sequences = max_sequences
+        self.ref_buffer = ring_buffer.FrameRingBuffer(buffer_capacity)
+        self.period_guesses = []
+        self.result = None
+        self.error = None
+        self.num_dropped = 0
+        self._num_submitted = 0
+        self._cancelled = False
+        self._queue = queue.Queue(maxsize=self.ref_buffer.capacity)
+        self._thread = threading.Thread(
+            target=self._run, name="BackgroundAdapter", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, frame, timestamp):
+        """ Pass a newly-received frame to the background thread (without blocking).
+            Parameters:
+                frame       array-like  2D frame pixel data (which must not be modified afterwards)
+                timestamp   float       Timestamp associated with the frame
+        """
+        if self.finished():
+            return
+        try:
+            self._queue.put_nowait((self._num_submitted, frame, timestamp))
+        except queue.Full:
+            self.num_dropped += 1
+            logger.warning("Background adaptive update has fallen behind; dropping frame")
+        self._num_submitted += 1
+
+    def finished(self):
+        """Returns True once the update has completed (successfully or not), or been cancelled."""
+        return (self.result is not None) or (self.error is not None) or self._cancelled
+
+    def cancel(self):
+        """Abandon the update (the background thread will exit after finishing whatever it is currently doing)."""
+        self._cancelled = True
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def _run(self):
+        expected = 0
+        while not self._cancelled:
+            item = self._queue.get()
+            if item is None or self._cancelled:
+                return
+            index, frame, timestamp = item
+            if index != expected:
+                logger.warning(
+                    "Background adaptive update missed {0} frames; restarting period determination",
+                    index - expected,
+                )
+                self.ref_buffer.clear()
+                self.period_guesses = []
+            expected = index + 1
+
+            try:
+                ref_frames, self.settings = establish_reference(
+                    self.ref_buffer,
+                    frame,
+                    timestamp,
+                    self.period_guesses,
+                    self.settings,
+                    max_duration=self.max_duration,
+                )
+                if ref_frames is None:
+                    continue
+                logger.success("Period determined (in background).")
+                *oga_history, target, self.settings = align_reference(
+                    ref_frames,
+                    self.settings,
+                    *self.oga_history,
+                    max_sequences=self.max_sequences
+                )
+            except Exception as e:
+                logger.error("Background adaptive update failed: {0}", e)
+                self.error = e
+                return
+            # Publish the complete result in a single assignment, so the caller never sees a partial update
+            self.result = {
+                "ref_frames": ref_frames,
+                "settings": self.settings,
+                "oga_history": tuple(oga_history),
+                "target": target,
+            }
+            return
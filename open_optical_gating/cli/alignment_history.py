@@ -0,0 +1,79 @@
+"""Retention policy for the history of reference sequences used by the adaptive algorithm (see oga.process_sequence)."""
+
+# Module imports
+import numpy as np
+from loguru import logger
+
+
+def compact_history(
+    sequence_history,
+    period_history,
+    drift_history,
+    shift_history,
+    global_solution,
+    max_sequences,
+    anchor_score=1.0,
+):
+    """ Limit the number of reference sequences retained for the adaptive algorithm to 'max_sequences',
+        so that the memory used (and the time taken by oga.process_sequence) does not grow over a long experiment.
+
+        We always keep the first sequence (sequence 0), since it defines the target phase that every later
+        sequence is aligned to, plus the most recent (max_sequences - 1) sequences, which are the ones
+        that new sequences are aligned against. The other sequences are dropped, along with any shifts involving them,
+        and the remaining shifts are re-indexed accordingly.
+
+        Dropping sequences would break the chains of shifts that tied the retained sequences back to sequence 0.
+        To keep the global phase solution consistent, we therefore add an "anchor" shift between sequence 0 and
+        each retained sequence (unless there is already a shift between them), taken from the existing
+        global solution and given a score of 'anchor_score'.
+        Shifts are stored as (i, j, shift, score) tuples, where shift is the phase of sequence j relative to
+        sequence i, so the anchor shift for sequence j is global_solution[j] - global_solution[0].
+
+        Parameters:
+            sequence_history    list        Reference sequences (3D arrays), oldest first
+            period_history      list        Period of each reference sequence
+            drift_history       list        Drift of each reference sequence
+            shift_history       list        (i, j, shift, score) tuples relating pairs of sequences
+            global_solution     array-like  Phase of each sequence, relative to sequence 0
+            max_sequences       int         Maximum number of sequences to retain (None for no limit)
+            anchor_score        float       Score assigned to the anchor shifts
+        Returns:
+            sequence_history, period_history, drift_history, shift_history, global_solution
+                                            Compacted history (unchanged if no sequences needed to be dropped)
+    """
+    if (
+        max_sequences is None
+        or sequence_history is None
+        or len(sequence_history) <= max_sequences
+    ):
+        return sequence_history, period_history, drift_history, shift_history, global_solution
+    if max_sequences < 2:
+        raise ValueError("max_sequences must be at least 2 (got {0})".format(max_sequences))
+
+    numSequences = len(sequence_history)
+    keep = [0] + list(range(numSequences - (max_sequences - 1), numSequences))
+    newIndex = {old: new for new, old in enumerate(keep)}
+    logger.info(
+        "Compacting alignment history from {0} to {1} sequences", numSequences, len(keep)
+    )
+
+    global_solution = np.asarray(global_solution)
+    shifts = [
+        (newIndex[i], newIndex[j]) + tuple(rest)
+        for (i, j, *rest) in shift_history
+        if i in newIndex and j in newIndex
+    ]
+    anchored = {j for (i, j, *rest) in shifts if i == 0}
+    for old in keep[1:]:
+        if newIndex[old] not in anchored:
+            shifts.append(
+                (0, newIndex[old], global_solution[old] - global_solution[0], anchor_score)
+            )
+
+    return (
+        [sequence_history[k] for k in keep],
+        [period_history[k] for k in keep],
+        [drift_history[k] for k in keep],
+        shifts,
+        global_solution[keep],
+    )
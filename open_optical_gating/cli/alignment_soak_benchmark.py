@@ -0,0 +1,99 @@
+"""Soak test for the adaptive alignment history: carries out many adaptive updates in a row (as happens
+over a long time-lapse), and reports how the time per update and the memory in use evolve.
+
+Run with, e.g.:
+    python -m open_optical_gating.cli.alignment_soak_benchmark --updates 2000 --max-sequences 20
+and compare against --max-sequences 0 (no limit on the history)."""
+
+# Python imports
+import argparse
+import sys
+import time
+import tracemalloc
+
+# Module imports
+import numpy as np
+from loguru import logger
+
+# Local imports
+from . import adaptive_update
+from . import parameters
+
+
+def synthetic_sequence(period, numExtra, shape, phase_offset, rng):
+    """ Returns a synthetic reference sequence (a bright blob moving round a circle, plus noise)
+        of int(period) + 1 + 2 * numExtra uint8 frames, starting at 'phase_offset' (radians).
+    """
+    numFrames = int(period) + 1 + 2 * numExtra
+    x, y = np.meshgrid(np.arange(shape[1]), np.arange(shape[0]))
+    frames = np.zeros((numFrames,) + shape, dtype=np.uint8)
+    for i in range(numFrames):
+        phase = phase_offset + 2 * np.pi * (i - numExtra) / period
+        cx = shape[1] / 2 + shape[1] / 4 * np.cos(phase)
+        cy = shape[0] / 2 + shape[0] / 4 * np.sin(phase)
+        blob = 200 * np.exp(-((x - cx) ** 2 + (y - cy) ** 2) / (2 * (shape[0] / 10) ** 2))
+        frames[i] = np.clip(blob + rng.normal(10, 3, shape), 0, 255)
+    return frames
+
+
+def run(args, desc):
+    """ Run the soak benchmark.
+        Params:   args       list    Caller should normally pass sys.argv[1:] here
+                  desc       str     Description to provide as command line help description
+    """
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument("--updates", type=int, default=2000, help="Number of adaptive updates to carry out")
+    parser.add_argument(
+        "--max-sequences",
+        type=int,
+        default=20,
+        help="Maximum number of sequences retained in the alignment history (0 for no limit)",
+    )
+    parser.add_argument("--period", type=float, default=31.3, help="Reference period (in frames)")
+    parser.add_argument("--size", type=int, default=64, help="Width and height of each frame (in pixels)")
+    parser.add_argument("--report-every", type=int, default=100, help="Number of updates between reports")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the synthetic sequences")
+    args = parser.parse_args(args)
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+    maxSequences = args.max_sequences if args.max_sequences > 0 else None
+
+    rng = np.random.default_rng(args.seed)
+    settings = parameters.initialise(reference_period=args.period)
+    shape = (args.size, args.size)
+    # A small pool of sequences is enough to exercise the alignment, and saves generating thousands of them
+    pool = [
+        synthetic_sequence(args.period, settings["numExtraRefFrames"], shape, rng.uniform(0, 2 * np.pi), rng)
+        for _ in range(8)
+    ]
+
+    history = (None, None, None, None, None)
+    tracemalloc.start()
+    times = []
+    print(
+        "{0:>8} {1:>12} {2:>12} {3:>10} {4:>10}".format(
+            "update", "mean ms", "memory MB", "sequences", "shifts"
+        )
+    )
+    for update in range(1, args.updates + 1):
+        # Each update gets its own copy of the frames, as it would in the real system
+        ref_frames = pool[update % len(pool)].copy()
+        t0 = time.perf_counter()
+        *history, target, settings = adaptive_update.align_reference(
+            ref_frames, settings, *history, max_sequences=maxSequences
+        )
+        times.append(time.perf_counter() - t0)
+        if update % args.report_every == 0:
+            current, _ = tracemalloc.get_traced_memory()
+            print(
+                "{0:>8} {1:>12.3f} {2:>12.2f} {3:>10} {4:>10}".format(
+                    update, 1e3 * np.mean(times), current / 1e6, len(history[0]), len(history[3])
+                )
+            )
+            times = []
+    tracemalloc.stop()
+    return True
+
+
+if __name__ == "__main__":
+    run(sys.argv[1:], "Soak test for the adaptive alignment history")
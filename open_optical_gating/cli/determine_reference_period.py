@@ -6,16 +6,26 @@ import os
 import numpy as np
 from loguru import logger
 from datetime import datetime
-import j_py_sad_correlation as jps
 # See comment in pyproject.toml for why we have to try both of these
 try:
     import skimage.io as tiffio
 except:
     import tifffile as tiffio
 
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
 # Local
 from . import parameters
 from . import prospective_optical_gating as pog
+from . import sad_backends
 
 
 def establish(sequence, period_history, settings, require_stable_history=True):
@@ -30,12 +40,13 @@ def establish(sequence, period_history, settings, require_stable_history=True):
     # We should just return that value from this function, and the caller can do something with it.
     """ Attempt to establish a reference period from a sequence of recently-received frames.
         Parameters:
-            sequence        list of PixelArray objects  Sequence of recently-received frame pixel arrays (in chronological order)
+            sequence        array-like                  3D (t by x by y) sequence of recently-received frames (in chronological order),
+                                                        or a list of PixelArray objects
             period_history  list of float               Values of period calculated for previous frames (which we will append to)
             settings        dict                        Parameters controlling the sync algorithms
             require_stable_history  bool                Do we require a stable history of similar periods before we consider accepting this one?
         Returns:
-            List of frame pixel arrays that form the reference sequence (or None).
+            Slice of 'sequence' that forms the reference sequence (or None).
     """
     start, stop, settings = establish_indices(sequence, period_history, settings, require_stable_history)
     if start is not None and stop is not None:
@@ -46,9 +57,11 @@ def establish(sequence, period_history, settings, require_stable_history=True):
     return referenceFrames, settings
 
 
-def establish_indices(sequence, period_history, settings, require_stable_history=True):
+def establish_indices(sequence, period_history, settings, require_stable_history=True, diffs=None):
     """ Establish the list indices representing a reference period, from a given input sequence.
-        Parameters: see header comment for establish(), above
+        Parameters: see header comment for establish(), above, plus:
+            diffs   ndarray     Optional SADs between the last frame in 'sequence' and each earlier frame
+                                 (e.g. from FrameRingBuffer.update_sads), if the caller has already computed them
         Returns:
             List of indices that form the reference sequence (or None).
     """
@@ -57,11 +70,23 @@ def establish_indices(sequence, period_history, settings, require_stable_history
         frame = sequence[-1]
         pastFrames = sequence[:-1]
 
-        # Calculate Diffs between this frame and previous frames in the sequence
-        diffs = jps.sad_with_references(frame, pastFrames)
+        if diffs is None:
+            if settings["roi"] is not None:
+                # Only compare the region of interest identified from a previous reference sequence
+                roi = settings["roi"]
+                frame = frame[roi[0] : roi[1], roi[2] : roi[3]]
+                if isinstance(pastFrames, np.ndarray):
+                    pastFrames = pastFrames[:, roi[0] : roi[1], roi[2] : roi[3]]
+                else:
+                    pastFrames = [f[roi[0] : roi[1], roi[2] : roi[3]] for f in pastFrames]
+
+            # Calculate Diffs between this frame and previous frames in the sequence
+            diffs = sad_backends.get_backend(settings["sad_backend"]).sad_with_references(
+                frame, pastFrames
+            )
 
         # Calculate Period based on these Diffs
-        period = calculate_period_length(diffs, settings["minPeriod"], settings["lowerThresholdFactor"], settings["upperThresholdFactor"])
+        period = calculate_period_length(diffs, settings["minPeriod"], settings["lowerThresholdFactor"], settings["upperThresholdFactor"], settings["period_method"])
         if period != -1:
             period_history.append(period)
 
@@ -105,16 +130,23 @@ def establish_indices(sequence, period_history, settings, require_stable_history
     return None, None, settings
 
 
-def calculate_period_length(diffs, minPeriod=5, lowerThresholdFactor=0.5, upperThresholdFactor=0.75):
+def calculate_period_length(
+    diffs,
+    minPeriod=5,
+    lowerThresholdFactor=0.5,
+    upperThresholdFactor=0.75,
+    method="fast",
+):
     """ Attempt to determine the period of one heartbeat, from the diffs array provided. The period will be measured backwards from the most recent frame in the array
         Parameters:
             diffs    ndarray    Diffs between latest frame and previously-received frames
+            method   str        "reference" (the original Python loop, with detailed logging)
+                                 or "fast" (identical results, compiled with numba if it is available)
         Returns:
             Period, or -1 if no period found
     """
 
     # Calculate the heart period (with sub-frame interpolation) based on a provided list of comparisons between the current frame and previous frames.
-    bestMatchPeriod = None
 
     # Unlike JTs codes, the following currently only supports determining the period for a *one* beat sequence.
     # It therefore also only supports determining a period which ends with the final frame in the diffs sequence.
@@ -122,6 +154,46 @@ def calculate_period_length(diffs, minPeriod=5, lowerThresholdFactor=0.5, upperT
         logger.debug("Not enough diffs, returning -1")
         return -1
 
+    if method == "reference":
+        bestMatchPeriod = period_search_reference(
+            diffs, minPeriod, lowerThresholdFactor, upperThresholdFactor
+        )
+    elif method == "fast":
+        bestMatchPeriod = _period_search_fast(
+            np.asarray(diffs),
+            minPeriod,
+            float(lowerThresholdFactor),
+            float(upperThresholdFactor),
+        )
+        if bestMatchPeriod < 0:
+            bestMatchPeriod = None
+    else:
+        raise ValueError("Unknown period_method '{0}'".format(method))
+
+    if bestMatchPeriod is None:
+        logger.debug("I didn't find a whole period, returning -1")
+        return -1
+
+    bestMatchEntry = diffs.size - bestMatchPeriod
+
+    interpolatedMatchEntry = (
+        bestMatchEntry
+        + pog.v_fitting(
+            diffs[bestMatchEntry - 1], diffs[bestMatchEntry], diffs[bestMatchEntry + 1]
+        )[0]
+    )
+
+    return diffs.size - interpolatedMatchEntry
+
+
+def period_search_reference(diffs, minPeriod, lowerThresholdFactor, upperThresholdFactor):
+    """ Reference implementation of the search in calculate_period_length.
+        Looks backwards through 'diffs' for a dip followed by a rise, using a two-stage threshold state machine.
+        Returns:
+            Delta (in frames, back from the most recent frame) of the best match, or None if no period found
+    """
+    bestMatchPeriod = None
+
     # initialise search parameters for last diff
     score = diffs[diffs.size - 1]
     minScore = score
@@ -188,32 +260,120 @@ def calculate_period_length(diffs, minPeriod=5, lowerThresholdFactor=0.5, upperT
 
     if got:
         bestMatchPeriod = deltaForMinSinceMax
+    return bestMatchPeriod
 
-    if bestMatchPeriod is None:
-        logger.debug("I didn't find a whole period, returning -1")
-        return -1
 
-    bestMatchEntry = diffs.size - bestMatchPeriod
+def _period_search_python(diffs, minPeriod, lowerThresholdFactor, upperThresholdFactor):
+    # Same state machine as period_search_reference, without the logging (and the unused running mean),
+    # written so that it can be compiled by numba. Returns -1 if no period found
+    n = diffs.size
+    score = diffs[n - 1]
+    minScore = score
+    maxScore = score
+    minSinceMax = score
+    deltaForMinSinceMax = 0
+    stage = 1
+    for d in range(minPeriod, n + 1):
+        score = diffs[n - d]
+        lowerThresholdScore = minScore + (maxScore - minScore) * lowerThresholdFactor
+        upperThresholdScore = minScore + (maxScore - minScore) * upperThresholdFactor
+        if score < lowerThresholdScore and stage == 1:
+            stage = 2
+        if score > upperThresholdScore and stage == 2:
+            return deltaForMinSinceMax
+        if score > maxScore:
+            maxScore = score
+            minSinceMax = score
+            deltaForMinSinceMax = d
+            stage = 1
+        elif score != 0 and (minScore == 0 or score < minScore):
+            minScore = score
+        if score < minSinceMax:
+            minSinceMax = score
+            deltaForMinSinceMax = d
+    return -1
 
-    interpolatedMatchEntry = (
-        bestMatchEntry
-        + pog.v_fitting(
-            diffs[bestMatchEntry - 1], diffs[bestMatchEntry], diffs[bestMatchEntry + 1]
-        )[0]
-    )
 
-    return diffs.size - interpolatedMatchEntry
+if numba is not None:
+    _period_search_fast = numba.njit(cache=True)(_period_search_python)
+else:
+    _period_search_fast = _period_search_python
 
 
-def save_period(reference_period, parent_dir="~/"):
-    """Function to save a reference period in am ISO format time-stamped folder with a parent_dir.
+def save_period(
+    reference_period,
+    parent_dir="~/",
+    file_format="frames",
+    compress=0,
+    settings=None,
+    dt=None,
+):
+    """Function to save a reference period with an ISO format time-stamped name, within a parent_dir.
         Parameters:
             reference_period    ndarray     t by x by y 3d array of reference frames
             parent_dir          string      parent directory within which to store the period
+            file_format         string      "frames" (a time-stamped folder with one TIFF file per frame),
+                                             "tiff" (a single multi-page TIFF file) or "npz" (a single NumPy .npz file)
+            compress            int         zlib compression level for "tiff" (0 for no compression)
+            settings            dict        Optional parameters controlling the sync algorithms (or a JSON string from
+                                             parameters.to_json), which are saved alongside the frames
+                                             (in settings.json, the TIFF image description or the .npz file)
+            dt                  string      Time stamp to use in the name (default: now)
+        Returns:
+            path of the folder or file that was written
     """
-    dt = datetime.now().strftime("%Y-%m-%dT%H%M%S")
-    os.makedirs(os.path.join(parent_dir, dt), exist_ok=True)
-
-    # Saves the period
-    for i, frame in enumerate(reference_period):
-        tiffio.imsave(os.path.join(parent_dir, dt, "{0:03d}.tiff".format(i)), frame)
+    if dt is None:
+        dt = datetime.now().strftime("%Y-%m-%dT%H%M%S")
+    if settings is None or isinstance(settings, str):
+        settingsJSON = settings
+    else:
+        settingsJSON = parameters.to_json(settings)
+
+    if file_format == "frames":
+        os.makedirs(os.path.join(parent_dir, dt), exist_ok=True)
+
+        # Saves the period
+        for i, frame in enumerate(reference_period):
+            tiffio.imsave(os.path.join(parent_dir, dt, "{0:03d}.tiff".format(i)), frame)
+        if settingsJSON is not None:
+            with open(os.path.join(parent_dir, dt, "settings.json"), "w") as f:
+                f.write(settingsJSON)
+        return os.path.join(parent_dir, dt)
+
+    os.makedirs(parent_dir, exist_ok=True)
+    if file_format == "tiff" and tifffile is None:
+        logger.warning("tifffile is not available; saving reference period as .npz instead")
+        file_format = "npz"
+
+    if file_format == "tiff":
+        path = os.path.join(parent_dir, "{0}.tif".format(dt))
+        kwargs = {}
+        if settingsJSON is not None:
+            kwargs["description"] = settingsJSON
+        if compress:
+            try:
+                tifffile.imwrite(path, np.asarray(reference_period), compress=compress, **kwargs)
+            except TypeError:
+                # Newer versions of tifffile have a different API for compression
+                tifffile.imwrite(
+                    path,
+                    np.asarray(reference_period),
+                    compression="zlib",
+                    compressionargs={"level": compress},
+                    **kwargs
+                )
+        else:
+            tifffile.imwrite(path, np.asarray(reference_period), **kwargs)
+    elif file_format == "npz":
+        path = os.path.join(parent_dir, "{0}.npz".format(dt))
+        if settingsJSON is None:
+            np.savez(path, reference_period=np.asarray(reference_period))
+        else:
+            np.savez(
+                path,
+                reference_period=np.asarray(reference_period),
+                pog_settings=np.array(settingsJSON),
+            )
+    else:
+        raise ValueError("Unknown period file format '{0}'".format(file_format))
+    return path
@@ -6,6 +6,7 @@ import json
 import urllib.request
 
 # Module imports
+import numpy as np
 from loguru import logger
 from tqdm.auto import tqdm
 # See comment in pyproject.toml for why we have to try both of these
@@ -17,6 +18,7 @@ except:
 # Local imports
 from . import optical_gater_server as server
 from . import pixelarray as pa
+from . import frame_sources
 
 
 class FileOpticalGater(server.OpticalGater):
@@ -59,7 +61,7 @@ class FileOpticalGater(server.OpticalGater):
         # Load
         logger.success("Loading image data...")
         try:
-            self.data = tiffio.imread(filename)
+            self.data = self.read_file(filename)
         except FileNotFoundError:
             if "source_url" in self.settings:
                 if (sys.platform == "win32"):
@@ -74,7 +76,7 @@ class FileOpticalGater(server.OpticalGater):
                                                    reporthook=tqdm_hook(t))
                     logger.info("Downloaded file {0}".format(filename))
                     # Try again
-                    self.data = tiffio.imread(filename)
+                    self.data = self.read_file(filename)
                 else:
                     raise
             else:
@@ -89,6 +91,48 @@ class FileOpticalGater(server.OpticalGater):
         self.start_time = time.time()  # we use this to sanitise our timestamps
         self.last_frame_wallclock_time = None
 
+        # If settings["virtual_clock"] is set, frames are timestamped according to their position in the replay
+        # (rather than when we happen to get round to processing them), and are provided as fast as we can process them.
+        # This makes the results independent of the speed of this computer, and identical from one run to the next
+        self.virtual_clock = self.settings.get("virtual_clock", False)
+        self.num_frames_replayed = 0
+        self.virtual_clock_rng = np.random.default_rng(
+            self.settings.get("virtual_clock_seed", 0)
+        )
+        if self.virtual_clock:
+            # These options depend on how long processing takes, so would still make the results vary between runs
+            speedDependent = [k for k in ("background_adapt", "qos") if self.settings.get(k, False)]
+            if self.settings.get("capture_pipeline", False) and (
+                self.settings.get("capture_overflow_policy", "drop-oldest") != "block"
+            ):
+                speedDependent.append("capture_pipeline")
+            if speedDependent:
+                logger.warning(
+                    "Replaying with a virtual clock, but results will not be reproducible with {0} enabled",
+                    ", ".join(speedDependent),
+                )
+
+    def read_file(self, filename):
+        """ Returns the frames in the TIFF file 'filename', as a 3D (t by x by y) array-like object.
+            Unless settings["lazy_loading"] is False, we avoid reading the whole file up front,
+            and frames are only read when they are needed (see frame_sources.TiffFrameSource).
+            'filename' may also be a directory, glob pattern or playlist of TIFF files, which are replayed one after another
+            (see frame_sources.DatasetFrameSource). In that case frames are read in advance on a background thread.
+        """
+        if frame_sources.is_dataset(filename):
+            return frame_sources.DatasetFrameSource(
+                filename,
+                read_ahead=self.settings.get("read_ahead_frames", 16),
+                prefetch_length=self.settings.get("prefetch_frames", 64),
+            )
+        if self.settings.get("lazy_loading", True):
+            if frame_sources.tifffile is not None:
+                return frame_sources.TiffFrameSource(
+                    filename, read_ahead=self.settings.get("read_ahead_frames", 16)
+                )
+            logger.warning("tifffile is not available, so loading the whole of {0} into memory", filename)
+        return tiffio.imread(filename)
+
     def run_server(self, force_framerate=False):
         """ Run the OpticalGater server, acting on the in-file data.
             Function inputs:
@@ -108,14 +152,27 @@ class FileOpticalGater(server.OpticalGater):
             )
 
         logger.success("Emulating...")
-        while not self.stop:
-            self.analyze_pixelarray(self.next_frame(force_framerate=force_framerate))
+        self.analyse_until_stopped(
+            lambda: self.next_frame(force_framerate=force_framerate)
+        )
+        if isinstance(self.data, frame_sources.DatasetFrameSource):
+            logger.info(
+                "Waited for frames to be read from disk {0} times (total {1:.3f}s)",
+                self.data.num_stalls,
+                self.data.stall_time_s,
+            )
+            self.data.close()
 
     def next_frame(self, force_framerate=False):
         """This function gets the next frame from the data source, which can be passed to analyze()"""
         # Force framerate to match the brightfield_framerate in the settings
         # This gives accurate timings and plots
-        if force_framerate and (self.last_frame_wallclock_time is not None):
+        # (not needed with a virtual clock, since the timestamps do not depend on when we process the frame)
+        if (
+            force_framerate
+            and not self.virtual_clock
+            and (self.last_frame_wallclock_time is not None)
+        ):
             wait_s = (1 / self.settings["brightfield_framerate"]) - (
                 time.time() - self.last_frame_wallclock_time
             )
@@ -149,16 +206,31 @@ class FileOpticalGater(server.OpticalGater):
                 # Start again at the first frame in the file
                 self.next_frame_index = 0
 
+        if self.virtual_clock:
+            timestamp = self.virtual_timestamp()
+        else:
+            timestamp = time.time() - self.start_time  # relative to start_time to sanitise
         next = pa.PixelArray(
-            self.data[self.next_frame_index, :, :],
-            metadata={
-                "timestamp": time.time() - self.start_time
-            },  # relative to start_time to sanitise
+            self.data[self.next_frame_index],
+            metadata={"timestamp": timestamp},
         )
         self.next_frame_index += 1
+        self.num_frames_replayed += 1
         self.last_frame_wallclock_time = time.time()
         return next
 
+    def virtual_timestamp(self):
+        """ Timestamp for the next frame when replaying with a virtual clock: the frame's position in the replay
+            (counting across repeats) divided by the brightfield framerate, plus optional random jitter
+            (normally distributed, with standard deviation settings["virtual_clock_jitter_s"]) to emulate
+            an imperfect camera clock. The jitter is generated from settings["virtual_clock_seed"], so is the same on every run.
+        """
+        timestamp = self.num_frames_replayed / self.settings["brightfield_framerate"]
+        jitter_s = self.settings.get("virtual_clock_jitter_s", 0)
+        if jitter_s > 0:
+            timestamp += self.virtual_clock_rng.normal(0, jitter_s)
+        return timestamp
+
 def load_settings(raw_args, desc, add_extra_args=None):
     '''
         Load the settings.json file containing information including
@@ -259,6 +331,7 @@ def run(args, desc):
 
     logger.success("Running server...")
     analyser.run_server(force_framerate=True)
+    analyser.shutdown()
 
     logger.success("Plotting summaries...")
     analyser.plot_triggers()
@@ -0,0 +1,190 @@
+"""Columnar store for the metadata of frames analysed in sync mode."""
+
+# Python imports
+from collections import deque
+
+# Module imports
+import numpy as np
+
+
+class FrameHistory:
+    """ Fixed-capacity history of per-frame metadata, held as columns of a NumPy array.
+
+        This replaces keeping a list of PixelArray objects and extracting their metadata
+        with pa.get_metadata_from_list every time it is needed. Each column corresponds to one
+        of the frame metadata keys documented in pixelarray.py (see FrameHistory.columns).
+        Values that have not been set (e.g. predicted_trigger_time_s before we start predicting) are NaN.
+
+        As in ring_buffer.FrameRingBuffer, every row is written twice (at i and i + capacity),
+        so the most recent rows are always contiguous and can be returned as views without copying.
+        Views remain valid only until the next call to append().
+
+        We also maintain running sums of timestamp and unwrapped_phase (and their squares and products),
+        so that a least-squares linear fit of phase against time over any number of recent frames
+        can be evaluated in constant time (see linear_fit). These are only accurate if timestamp and
+        unwrapped_phase are provided when each row is appended.
+
+        The PixelArray objects themselves are also retained in self.frames, but only for the most recent
+        'pixel_capacity' frames. Since sync mode only needs the metadata once a frame has been analysed,
+        pixel_capacity can be small (or zero) to save memory.
+    """
+
+    columns = (
+        "timestamp",
+        "unwrapped_phase",
+        "sad_min",
+        "predicted_trigger_time_s",
+        "trigger_type_sent",
+        "processing_rate_fps",
+        "frames_missed",
+        "qos_level",
+    )
+
+    def __init__(self, capacity, pixel_capacity=None):
+        """Function inputs:
+            capacity        int     Maximum number of frames to retain metadata for
+            pixel_capacity  int     Maximum number of PixelArray objects to retain (default: same as capacity)
+        """
+        self.capacity = max(int(capacity), 1)
+        self._column_index = {c: i for i, c in enumerate(self.columns)}
+        self._data = np.full((2 * self.capacity, len(self.columns)), np.nan)
+        self._next = 0
+        self._length = 0
+        # Total number of frames ever appended (unaffected by eviction)
+        self.num_appended = 0
+        # Running sums for linear_fit: sum of x, y, x*x, x*y, where x and y are timestamp and unwrapped_phase
+        # relative to self._origin. For each row we store the sums over all rows *before* it,
+        # so the sums over any window are (self._sums - self._sums_before[first row of window]).
+        # To avoid loss of precision as the sums grow, we periodically recompute them (see _rebase)
+        self._sums_before = np.zeros((2 * self.capacity, 4))
+        self._sums = np.zeros(4)
+        self._origin = (0.0, 0.0)
+        self._appended_since_rebase = 0
+        if pixel_capacity is None:
+            pixel_capacity = self.capacity
+        self.frames = deque(maxlen=max(int(pixel_capacity), 0))
+
+    def append(self, pixelArray=None, **values):
+        """ Add a row to the history, evicting the oldest row if the history is already full.
+            Parameters:
+                pixelArray  PixelArray  Frame to retain alongside the metadata (optional)
+                values      float       Values for any of the columns (the others are set to NaN)
+        """
+        self._data[self._next] = np.nan
+        self._data[self._next + self.capacity] = np.nan
+        self._next = (self._next + 1) % self.capacity
+        self._length = min(self._length + 1, self.capacity)
+        self.num_appended += 1
+        self._set_last_values(values)
+        if pixelArray is not None:
+            self.frames.append(pixelArray)
+
+        # Update the running sums used by linear_fit
+        self._appended_since_rebase += 1
+        if self._length == 1 or self._appended_since_rebase >= self.capacity:
+            self._rebase()
+        else:
+            last = (self._next - 1) % self.capacity
+            self._sums_before[last] = self._sums
+            self._sums_before[last + self.capacity] = self._sums
+            self._sums += self._sum_terms(
+                self._data[last, self._column_index["timestamp"]],
+                self._data[last, self._column_index["unwrapped_phase"]],
+            )
+
+    def set_last(self, **values):
+        """Set values for any of the columns in the most recently-appended row."""
+        self._set_last_values(values)
+        if "timestamp" in values or "unwrapped_phase" in values:
+            self._rebase()
+
+    def _set_last_values(self, values):
+        last = (self._next - 1) % self.capacity
+        for key, value in values.items():
+            column = self._column_index[key]
+            if value is None:
+                value = np.nan
+            self._data[last, column] = value
+            self._data[last + self.capacity, column] = value
+
+    def last(self, key):
+        """Returns the value of column 'key' in the most recently-appended row."""
+        return self._data[(self._next - 1) % self.capacity, self._column_index[key]]
+
+    def window(self, keys, n=None):
+        """ Returns the values of the columns 'keys' for the most recent 'n' rows (oldest first).
+            Parameters:
+                keys    str or list     Column name, or list of column names
+                n       int             Number of rows to return (default: all rows in the history)
+            Returns:
+                1D array (if 'keys' is a str) or n-by-len(keys) array.
+                This is a view (no copy) if 'keys' is a str or a list of adjacent columns in order.
+        """
+        if n is None or n > self._length:
+            n = self._length
+        stop = (self._next - self._length) % self.capacity + self._length
+        rows = self._data[stop - n : stop]
+        if isinstance(keys, str):
+            return rows[:, self._column_index[keys]]
+        indices = [self._column_index[k] for k in keys]
+        if indices == list(range(indices[0], indices[0] + len(indices))):
+            return rows[:, indices[0] : indices[0] + len(indices)]
+        return rows[:, indices]
+
+    def linear_fit(self, n):
+        """ Least-squares linear fit of unwrapped_phase against timestamp, over the most recent 'n' rows.
+            This takes constant time, regardless of 'n'.
+            Parameters:
+                n               int     Number of rows to fit to (capped at the number of rows in the history)
+            Returns:
+                radsPerSec      float   Gradient of the fit
+                fittedPhase     float   Value of the fit at the timestamp of the most recent row
+        """
+        n = min(int(n), self._length)
+        first = (self._next - self._length) % self.capacity + self._length - n
+        sumX, sumY, sumXX, sumXY = self._sums - self._sums_before[first]
+        radsPerSec = (n * sumXY - sumX * sumY) / (n * sumXX - sumX * sumX)
+        intercept = (sumY - radsPerSec * sumX) / n
+        lastX = self.last("timestamp") - self._origin[0]
+        return radsPerSec, self._origin[1] + intercept + radsPerSec * lastX
+
+    def shift_phases(self, offset):
+        """ Add 'offset' to the unwrapped_phase of every row in the history
+            (e.g. to keep the phase history continuous when we switch to a new reference sequence).
+        """
+        self._data[:, self._column_index["unwrapped_phase"]] += offset
+        self._rebase()
+
+    def _sum_terms(self, timestamp, phase):
+        x = timestamp - self._origin[0]
+        y = phase - self._origin[1]
+        return np.array([x, y, x * x, x * y])
+
+    def _rebase(self):
+        # Recompute the running sums from scratch, relative to the oldest row we hold
+        self._appended_since_rebase = 0
+        if self._length == 0:
+            return
+        start = (self._next - self._length) % self.capacity
+        rows = self._data[start : start + self._length]
+        timestamps = rows[:, self._column_index["timestamp"]]
+        phases = rows[:, self._column_index["unwrapped_phase"]]
+        self._origin = (timestamps[0], phases[0])
+        terms = self._sum_terms(timestamps, phases).T
+        sums = np.cumsum(terms, axis=0)
+        self._sums = sums[-1].copy()
+        sumsBefore = np.concatenate([np.zeros((1, 4)), sums[:-1]])
+        rowIndices = (start + np.arange(self._length)) % self.capacity
+        self._sums_before[rowIndices] = sumsBefore
+        self._sums_before[rowIndices + self.capacity] = sumsBefore
+
+    def __getitem__(self, key):
+        return self.window(key)
+
+    def clear(self):
+        """Discard all rows (and frames) in the history."""
+        self._length = 0
+        self.frames.clear()
+
+    def __len__(self):
+        return self._length
@@ -0,0 +1,131 @@
+"""Producer/consumer pipeline, decoupling frame capture from frame analysis."""
+
+# Python imports
+import threading
+from collections import deque
+
+# Module imports
+from loguru import logger
+
+# What to do with a newly-captured frame when the queue is full
+OVERFLOW_POLICIES = ("drop-oldest", "latest-only", "block")
+
+
+class FramePipeline:
+    """ Captures frames on a background thread (by repeatedly calling a capture function),
+        and holds them in a bounded queue until the analysis thread is ready for them.
+
+        This means that a slow analysis step (e.g. establishing a new reference sequence) does not
+        delay the capture of the next frame. If analysis falls behind to the extent that the queue is full,
+        the overflow policy decides what happens to newly-captured frames:
+            "drop-oldest"   Discard the oldest frame in the queue to make room
+            "latest-only"   Hold only a single frame: each new frame replaces any frame still waiting,
+                            so that analysis always gets the most recent frame
+            "block"         Wait for room in the queue (no frames are dropped, but capture is held up)
+
+        The number of frames captured and dropped, and the current and maximum queue depth, are
+        available as attributes, so that the caller can monitor how well analysis is keeping up.
+    """
+
+    def __init__(self, capture, should_stop, max_queue_length=8, policy="drop-oldest"):
+        """Function inputs:
+            capture             function    Returns the next frame (called repeatedly on the capture thread)
+            should_stop         function    Returns True once capture should stop
+            max_queue_length    int         Maximum number of frames waiting to be analysed
+            policy              str         One of OVERFLOW_POLICIES
+        """
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(
+                "Unknown overflow policy '{0}' (available policies are: {1})".format(
+                    policy, ", ".join(OVERFLOW_POLICIES)
+                )
+            )
+        self.capture = capture
+        self.should_stop = should_stop
+        self.max_queue_length = max(int(max_queue_length), 1)
+        self.policy = policy
+        self.num_captured = 0
+        self.num_dropped = 0
+        self.max_depth = 0
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._finished = False
+        self._cancelled = False
+        self._error = None
+        self._thread = None
+
+    @property
+    def depth(self):
+        """Number of frames currently waiting to be analysed."""
+        return len(self._queue)
+
+    def start(self):
+        """Start capturing frames on the background thread."""
+        self._thread = threading.Thread(
+            target=self._run, name="FramePipeline", daemon=True
+        )
+        self._thread.start()
+
+    def get(self):
+        """ Returns the next frame to be analysed, waiting for one to be captured if necessary.
+            Returns None once capture has stopped and every captured frame has been returned (or dropped).
+            If capture stopped because the capture function raised an exception, that exception is raised here instead.
+        """
+        with self._condition:
+            while not self._queue and not self._finished:
+                self._condition.wait()
+            if not self._queue:
+                if self._error is not None:
+                    raise self._error
+                return None
+            frame = self._queue.popleft()
+            self._condition.notify_all()
+            return frame
+
+    def cancel(self):
+        """ Stop capturing, and discard any frames still waiting to be analysed.
+            get() will then return None (the capture thread exits once any capture in progress has completed).
+        """
+        with self._condition:
+            self._cancelled = True
+            self._queue.clear()
+            self._condition.notify_all()
+
+    def join(self):
+        """Wait for the capture thread to finish (once should_stop() returns True)."""
+        if self._thread is not None:
+            self._thread.join()
+
+    def _put(self, frame):
+        with self._condition:
+            if self.policy == "latest-only":
+                self.num_dropped += len(self._queue)
+                self._queue.clear()
+            elif len(self._queue) >= self.max_queue_length:
+                if self.policy == "block":
+                    while len(self._queue) >= self.max_queue_length and not self._cancelled:
+                        self._condition.wait()
+                else:
+                    self.num_dropped += 1
+                    self._queue.popleft()
+                    logger.debug(
+                        "Frame queue full ({0} frames dropped so far)", self.num_dropped
+                    )
+            if self._cancelled:
+                return
+            self._queue.append(frame)
+            self.num_captured += 1
+            self.max_depth = max(self.max_depth, len(self._queue))
+            self._condition.notify_all()
+
+    def _run(self):
+        try:
+            while not (self._cancelled or self.should_stop()):
+                self._put(self.capture())
+        except Exception as e:
+            logger.error("Frame capture failed: {0}", e)
+            self._error = e
+        finally:
+            with self._condition:
+                self._finished = True
+                self._condition.notify_all()
@@ -0,0 +1,285 @@
+"""Sources of pre-recorded brightfield frames, which provide frames on demand instead of loading a whole file into memory."""
+
+# Python imports
+import glob
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Module imports
+import numpy as np
+from loguru import logger
+
+# Local imports
+from . import frame_pipeline
+
+# See comment in pyproject.toml for why tifffile may not be available
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+# File extensions treated as TIFF files (anything else is treated as a playlist)
+TIFF_EXTENSIONS = (".tif", ".tiff")
+
+
+def frame_count_from_description(description, frame_shape):
+    """ Returns the number of frames recorded in the image description of the first page of a TIFF file,
+        as written by tifffile (JSON including the shape of the whole stack) or ImageJ ("images=" line),
+        or None if the description does not tell us the number of frames.
+        Parameters:
+            description     str     Image description of the first page
+            frame_shape     tuple   Shape of the first page
+    """
+    try:
+        shape = json.loads(description)["shape"]
+        if len(shape) == len(frame_shape) + 1 and tuple(shape[1:]) == tuple(frame_shape):
+            return int(shape[0])
+        return None
+    except (ValueError, TypeError, KeyError):
+        pass
+    for line in description.splitlines():
+        if line.startswith("images="):
+            return int(line[len("images=") :])
+    return None
+
+
+class TiffFrameSource:
+    """ Frames of a multi-page TIFF file, which behaves like a read-only 3D (t by x by y) array
+        (supporting len(), .shape, .dtype and indexing by frame number), but only reads frames when they are asked for.
+
+        If the image data in the file are uncompressed and contiguous, we memory-map the file,
+        and the operating system takes care of reading (and caching) the data as required.
+        Otherwise we decode each page when it is first asked for, and at the same time decode the next few pages
+        (since we expect frames to be asked for in order). Decoded pages are held in a small cache,
+        so the memory used does not depend on the length of the file.
+    """
+
+    def __init__(self, filename, read_ahead=16):
+        """Function inputs:
+            filename    str     Path to the TIFF file
+            read_ahead  int     Number of pages to decode at a time (if the file cannot be memory-mapped)
+        """
+        if tifffile is None:
+            raise ImportError("tifffile is required to read frames on demand")
+        self.filename = filename
+        self.read_ahead = max(int(read_ahead), 1)
+        self._tiff = tifffile.TiffFile(filename)
+        # Finding the number of pages in a TIFF file normally requires us to read the header of every page,
+        # so if possible we take it from the metadata written by tifffile or ImageJ in the first page instead
+        first = self._tiff.pages[0]
+        numFrames = frame_count_from_description(first.description, first.shape)
+        if numFrames is None:
+            numFrames = len(self._tiff.series[0].pages)
+        self.shape = (numFrames,) + tuple(first.shape)
+        self.dtype = first.dtype
+        self._memmap = None
+        if first.compression == 1:
+            try:
+                self._memmap = tifffile.memmap(filename, mode="r")
+            except ValueError:
+                # The image data are not contiguous
+                pass
+        if self._memmap is not None:
+            logger.info("Memory-mapped {0}", filename)
+            self._tiff.close()
+            return
+
+        logger.info("Image data in {0} cannot be memory-mapped; decoding frames on demand", filename)
+        self._pages = self._tiff.pages
+        # Only keep lightweight references to the pages we have read, rather than every page's full header
+        self._pages.useframes = True
+        self._pages.cache = False
+        # Most recently used pages last
+        self._cache = OrderedDict()
+        self._cache_size = 2 * self.read_ahead
+        # The file handle is shared, so pages must not be decoded on two threads at once
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        """Returns frame number 'index' as a 2D array."""
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Frame {0} is out of range (the file has {1} frames)".format(index, len(self)))
+        if self._memmap is not None:
+            return np.asarray(self._memmap[index])
+
+        with self._lock:
+            if index not in self._cache:
+                for i in range(index, min(index + self.read_ahead, len(self))):
+                    if i not in self._cache:
+                        page = self._pages[i].asarray()
+                        # Like the memory-mapped frames, these are shared so must not be modified
+                        page.flags.writeable = False
+                        self._cache[i] = page
+            self._cache.move_to_end(index)
+            frame = self._cache[index]
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return frame
+
+    def close(self):
+        """Close the file, if we opened it to decode frames on demand (memory-mapped frames remain valid)."""
+        if self._memmap is None:
+            self._tiff.close()
+
+
+def is_dataset(path):
+    """Returns True if 'path' refers to several files (see dataset_files), rather than a single TIFF file."""
+    return (
+        os.path.isdir(path)
+        or glob.has_magic(path)
+        or not path.lower().endswith(TIFF_EXTENSIONS)
+    )
+
+
+def dataset_files(path):
+    """ Returns the list of TIFF files making up the dataset at 'path', which may be:
+            a directory         every TIFF file in the directory, in order of filename
+            a glob pattern      every file matching the pattern, in order of filename (e.g. "run1/*.tif")
+            a playlist          text file listing one TIFF file per line, in the order they should be replayed
+                                (blank lines and lines starting with "#" are ignored; relative paths are
+                                treated as relative to the playlist itself)
+            a TIFF file         just that file
+    """
+    if os.path.isdir(path):
+        files = sorted(
+            os.path.join(path, f)
+            for f in os.listdir(path)
+            if f.lower().endswith(TIFF_EXTENSIONS)
+        )
+    elif glob.has_magic(path):
+        files = sorted(glob.glob(path))
+    elif not path.lower().endswith(TIFF_EXTENSIONS):
+        with open(path) as playlist:
+            lines = [line.strip() for line in playlist]
+        files = [
+            os.path.join(os.path.dirname(path), line)
+            for line in lines
+            if line and not line.startswith("#")
+        ]
+    else:
+        files = [path]
+    if len(files) == 0:
+        raise FileNotFoundError("No TIFF files found for dataset {0}".format(path))
+    return files
+
+
+class DatasetFrameSource:
+    """ Frames of several TIFF files (see dataset_files), replayed one after another as if they were a single file.
+        Like TiffFrameSource, this behaves like a read-only 3D (t by x by y) array.
+
+        Frames are read (and decoded, if necessary) in order on a background thread, into a queue of up to
+        'prefetch_length' frames (see frame_pipeline.FramePipeline), so that the caller does not have to wait
+        for the disk or for decompression as long as it asks for frames in order. If the caller asks for a frame
+        other than the next one (e.g. to replay the dataset again from the start), prefetching restarts from there.
+        Occasions when the caller did have to wait (prefetch stalls) are counted in 'num_stalls' and 'stall_time_s'.
+    """
+
+    def __init__(self, path, read_ahead=16, prefetch_length=64):
+        """Function inputs:
+            path            str     Directory, glob pattern, playlist or TIFF file (see dataset_files)
+            read_ahead      int     Number of pages to decode at a time, for files that cannot be memory-mapped
+            prefetch_length int     Maximum number of frames to read in advance
+        """
+        self.files = dataset_files(path)
+        self.read_ahead = read_ahead
+        self.prefetch_length = prefetch_length
+        # Number of frames in each file (and the index of the first frame of each file)
+        lengths = []
+        for filename in self.files:
+            source = TiffFrameSource(filename, read_ahead=read_ahead)
+            if len(lengths) == 0:
+                frame_shape, self.dtype = source.shape[1:], source.dtype
+            elif source.shape[1:] != frame_shape:
+                raise ValueError(
+                    "Frames in {0} have shape {1}, but those in {2} have shape {3}".format(
+                        filename, source.shape[1:], self.files[0], frame_shape
+                    )
+                )
+            lengths.append(len(source))
+            source.close()
+        self.starts = np.concatenate([[0], np.cumsum(lengths)])
+        self.shape = (int(self.starts[-1]),) + tuple(frame_shape)
+        logger.info("Dataset {0} has {1} frames in {2} files", path, self.shape[0], len(self.files))
+        self.num_stalls = 0
+        self.stall_time_s = 0.0
+        self._pipeline = None
+        self._next_index = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        """Returns frame number 'index' as a 2D array."""
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Frame {0} is out of range (the dataset has {1} frames)".format(index, len(self)))
+        if index != self._next_index:
+            self._start_prefetch(index)
+        self._next_index = index + 1
+
+        if self._pipeline.depth == 0:
+            # We have caught up with the prefetching, and will have to wait for the frame to be read
+            t0 = time.perf_counter()
+            frame = self._pipeline.get()
+            self.num_stalls += 1
+            self.stall_time_s += time.perf_counter() - t0
+            logger.debug("Prefetch stall waiting for frame {0}", index)
+        else:
+            frame = self._pipeline.get()
+        return frame
+
+    def _start_prefetch(self, index):
+        self.close()
+        reader = _DatasetReader(self, index)
+        self._pipeline = frame_pipeline.FramePipeline(
+            reader.read,
+            reader.finished,
+            max_queue_length=self.prefetch_length,
+            policy="block",
+        )
+        self._pipeline.start()
+
+    def close(self):
+        """Stop prefetching."""
+        if self._pipeline is not None:
+            self._pipeline.cancel()
+            self._pipeline = None
+            self._next_index = None
+
+
+class _DatasetReader:
+    """Reads the frames of a DatasetFrameSource in order, starting from frame 'index' (used on the prefetch thread)."""
+
+    def __init__(self, dataset, index):
+        self.dataset = dataset
+        self.index = index
+        self.file_index = None
+        self.source = None
+
+    def finished(self):
+        return self.index >= len(self.dataset)
+
+    def read(self):
+        fileIndex = np.searchsorted(self.dataset.starts, self.index, side="right") - 1
+        if fileIndex != self.file_index:
+            # Move on to the next file
+            if self.source is not None:
+                self.source.close()
+            self.file_index = fileIndex
+            self.source = TiffFrameSource(
+                self.dataset.files[fileIndex], read_ahead=self.dataset.read_ahead
+            )
+        frame = self.source[self.index - self.dataset.starts[fileIndex]]
+        self.index += 1
+        if self.finished():
+            self.source.close()
+        return frame
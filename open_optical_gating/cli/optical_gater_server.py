@@ -1,6 +1,7 @@
 """Parent Open Optical Gating Class"""
 
 # Python imports
+import atexit
 import sys
 import json
 import time
@@ -14,10 +15,17 @@ from loguru import logger
 import optical_gating_alignment.optical_gating_alignment as oga
 
 # Local imports
-from . import pixelarray as pa
-from . import determine_reference_period as ref
 from . import prospective_optical_gating as pog
 from . import parameters as parameters
+from . import reference_cache
+from . import ring_buffer
+from . import frame_history
+from . import predictors
+from . import period_archiver
+from . import adaptive_update
+from . import reference_refiner
+from . import frame_pipeline
+from . import qos
 
 logger.remove()
 logger.add(sys.stderr, level="WARNING")
@@ -42,6 +50,12 @@ class OpticalGater:
             "determine" - get period mode (requires user input; needed for "sync")
             "sync" - run prospective gating mode (phase-locked triggering)
             "adapt" - adaptive mode (update period but maintain phase-lock with previous period)
+
+        If settings["background_adapt"] is set, adaptive updates are instead carried out on a background thread
+        (see adaptive_update.BackgroundAdapter) while we remain in "sync" mode using the previous reference sequence.
+        If settings["reference_refinement"] is set, the reference sequence is refined using the frames received in "sync" mode
+        (see reference_refiner.ReferenceRefiner), and at each adaptive update we just switch to the refined reference sequence,
+        unless the drift or the change in heart period has become too large for that to be reliable.
     """
 
     def __init__(self, settings=None, ref_frames=None, ref_frame_period=None):
@@ -59,15 +73,42 @@ class OpticalGater:
             logger.success("Using existing reference frames...")
         self.ref_frames = ref_frames
         self.ref_frame_period = ref_frame_period
+        # Cropped copies of ref_frames used by phase matching (reset whenever ref_frames is replaced)
+        self.ref_cache = reference_cache.ReferenceStackCache(
+            max_entries=self.settings.get("reference_cache_size", 8)
+        )
+        # Reference periods are saved to disk in the background, so that we don't stall frame processing
+        self.period_archiver = period_archiver.PeriodArchiver(
+            self.settings["period_dir"],
+            file_format=self.settings.get("period_archive_format", "tiff"),
+            compress=self.settings.get("period_archive_compress", 0),
+            max_queue_length=self.settings.get("period_archive_queue_length", 4),
+        )
+        # Make sure queued periods are written even if our caller never gets round to calling shutdown()
+        atexit.register(self.shutdown)
         logger.success("Initialising internal parameters...")
         self.initialise_internal_parameters()
+        self.refresh_reference_cache()
+        self.start_reference_refinement()
         self.automatic_target_frame = True
         self.justRefreshedRefFrames = False
+        # FramePipeline used by analyse_until_stopped (if settings["capture_pipeline"] is set)
+        self.frame_pipeline = None
 
     def initialise_internal_parameters(self):
-        """Defines all internal parameters not already initialised"""
-        # Defines an empty list to store past frames with timestamp, phase and argmin(sad) metadata
-        self.frame_history = []
+        """ Defines all internal parameters not already initialised.
+            Any entries in the optional "pog_settings" dictionary within self.settings
+            (e.g. {"sad_backend": "numba"}) override the defaults in parameters.initialise().
+        """
+        # Defines an empty history to store past frames with timestamp, phase and argmin(sad) metadata.
+        # In "metadata" mode we only keep the pixels for the last few frames (e.g. for GUI preview)
+        if self.settings.get("frame_history_mode", "pixels") == "metadata":
+            pixel_capacity = self.settings.get("frame_history_pixel_window", 0)
+        else:
+            pixel_capacity = None
+        self.frame_history = frame_history.FrameHistory(
+            self.settings["frame_buffer_length"], pixel_capacity=pixel_capacity
+        )
         self.pixel_dtype = "uint8"
 
         # Variables for adaptive algorithm
@@ -76,6 +117,10 @@ class OpticalGater:
         self.period_history = None
         self.shift_history = None
         self.drift_history = None
+        # BackgroundAdapter for an adaptive update in progress (if settings["background_adapt"] is set)
+        self.adapter = None
+        # ReferenceRefiner for the current reference sequence (if settings["reference_refinement"] is set)
+        self.refiner = None
 
         # TODO: JT writes: this seems as good a place as any to flag the fact that I don't think barrier frames are being implemented properly.
         # There is a call to determine_barrier_frames, but I don't think the *value* for the barrier frame parameter is ever computed, is it?
@@ -89,7 +134,8 @@ class OpticalGater:
             )
             self.state = "reset"
             self.pog_settings = parameters.initialise(
-                framerate=self.settings["brightfield_framerate"]
+                framerate=self.settings["brightfield_framerate"],
+                **self.settings.get("pog_settings", {})
             )
         else:
             logger.info(
@@ -105,9 +151,29 @@ class OpticalGater:
                 rp = self.ref_frame_period
 
             self.pog_settings = parameters.initialise(
-                framerate=self.settings["brightfield_framerate"], reference_period=rp,
+                framerate=self.settings["brightfield_framerate"],
+                reference_period=rp,
+                **self.settings.get("pog_settings", {})
             )
             self.pog_settings = pog.determine_barrier_frames(self.pog_settings)
+            if self.pog_settings["auto_roi"]:
+                self.pog_settings["roi"] = pog.determine_roi(
+                    self.ref_frames, self.pog_settings
+                )
+
+        # Strategy for predicting trigger times from the phase history
+        self.predictor = predictors.get_predictor(self.pog_settings["phase_predictor"])
+
+        # Controller that sheds load if we cannot process frames as fast as they arrive (if settings["qos"] is set)
+        if self.settings.get("qos", False):
+            self.qos = qos.QoSController(
+                1.0 / self.settings["brightfield_framerate"],
+                degrade_load=self.settings.get("qos_degrade_load", 0.9),
+                restore_load=self.settings.get("qos_restore_load", 0.6),
+                patience=self.settings.get("qos_patience_frames", 10),
+            )
+        else:
+            self.qos = None
 
         # Start experiment timer
         self.initial_process_time_s = time.time()
@@ -129,6 +195,7 @@ class OpticalGater:
 
         # For logging processing time
         time_init = time.perf_counter()
+        num_in_history = self.frame_history.num_appended
 
         # TODO: These lines need to be moved into the eventual
         # pi_optical_gater analyze (inherited from picamera) method
@@ -145,15 +212,37 @@ class OpticalGater:
         # else:
         #     logger.critical('Frame of unknown type passed to analyze.')
 
+        if self.adapter is not None:
+            # An adaptive update is in progress in the background. If it has finished, swap in the
+            # new reference sequence before we analyse this frame; otherwise, pass this frame on to it
+            self.check_background_adapter(pixelArray)
+
         if self.trigger_num >= self.settings["update_after_n_triggers"]:
             # It is time to update the reference period (whilst maintaining phase lock)
-            # Set state to "reset" (so we clear things for a new reference period)
-            # As part of this reset, trigger_num will be reset
-            logger.info(
-                "At least {0} triggers have been sent; resetting before switching to adaptive mode.",
-                self.settings["update_after_n_triggers"],
-            )
-            self.state = "reset"
+            if (
+                self.refiner is not None
+                and self.state == "sync"
+                and not self.refinement_needs_realignment()
+            ):
+                # Just switch to our refined copy of the current reference sequence
+                self.apply_refined_reference()
+            elif self.settings.get("background_adapt", False) and self.state == "sync":
+                if self.adapter is None:
+                    # Carry on syncing with the current reference sequence while a new one is determined in the background
+                    logger.info(
+                        "At least {0} triggers have been sent; starting a background adaptive update.",
+                        self.settings["update_after_n_triggers"],
+                    )
+                    self.start_background_adapter()
+                    self.adapter.submit(pixelArray, pixelArray.metadata["timestamp"])
+            else:
+                # Set state to "reset" (so we clear things for a new reference period)
+                # As part of this reset, trigger_num will be reset
+                logger.info(
+                    "At least {0} triggers have been sent; resetting before switching to adaptive mode.",
+                    self.settings["update_after_n_triggers"],
+                )
+                self.state = "reset"
 
         pixelArray.metadata["optical_gating_state"] = self.state
 
@@ -187,6 +276,57 @@ class OpticalGater:
         pixelArray.metadata["processing_rate_fps"] = 1 / (
                 time_fin - time_init
             )
+        if self.frame_history.num_appended > num_in_history:
+            # This frame was added to frame_history (i.e. it was processed in sync mode)
+            if self.qos is not None and not self.justRefreshedRefFrames:
+                # Degrade (or restore) the quality of phase matching if necessary.
+                # Frames where we swapped in a new reference sequence are unrepresentative, so are ignored
+                decision = self.qos.update(time_fin - time_init, self.pog_settings)
+                if decision is not None:
+                    pixelArray.metadata["qos_decision"] = decision
+                pixelArray.metadata["qos_level"] = self.qos.level
+            self.frame_history.set_last(
+                processing_rate_fps=pixelArray.metadata["processing_rate_fps"],
+                qos_level=pixelArray.metadata.get("qos_level"),
+            )
+
+    def analyse_until_stopped(self, next_frame):
+        """ Repeatedly obtain frames by calling next_frame(), and analyse them, until self.stop is set.
+            If settings["capture_pipeline"] is set, frames are captured on a separate thread and queued
+            for analysis (see frame_pipeline.FramePipeline), so that slow analysis steps do not delay capture.
+            In that case every frame that has been captured is analysed (or dropped) before we return.
+            Parameters:
+                next_frame  function    Returns the next PixelArray to analyse
+        """
+        if not self.settings.get("capture_pipeline", False):
+            while not self.stop:
+                self.analyze_pixelarray(next_frame())
+            return
+
+        self.frame_pipeline = frame_pipeline.FramePipeline(
+            next_frame,
+            lambda: self.stop,
+            max_queue_length=self.settings.get("capture_queue_length", 8),
+            policy=self.settings.get("capture_overflow_policy", "drop-oldest"),
+        )
+        self.frame_pipeline.start()
+        try:
+            while True:
+                pixelArray = self.frame_pipeline.get()
+                if pixelArray is None:
+                    break
+                self.analyze_pixelarray(pixelArray)
+        finally:
+            # If analysis failed (or we were interrupted), the capture thread would otherwise carry on capturing
+            # (and, with the "block" policy, wait forever for space in the queue). This does nothing if capture has finished
+            self.frame_pipeline.cancel()
+            self.frame_pipeline.join()
+        logger.info(
+            "Captured {0} frames, of which {1} were dropped (maximum queue depth {2})",
+            self.frame_pipeline.num_captured,
+            self.frame_pipeline.num_dropped,
+            self.frame_pipeline.max_depth,
+        )
 
     def sync_state(self, pixelArray):
         """ Code to run when in "sync" state
@@ -195,10 +335,30 @@ class OpticalGater:
         logger.debug("Processing frame in prospective optical gating mode.")
 
         # Gets the phase (in frames) and arrays of SADs between the current frame and the referencesequence
+        # (we can predict roughly where the best match should be, based on the best match for the previous frame)
+        if len(self.frame_history) > 0:
+            predicted_index = pog.predict_reference_index(
+                self.frame_history.last("sad_min"),
+                self.frame_history.last("timestamp"),
+                pixelArray.metadata["timestamp"],
+                self.pog_settings,
+                radsPerSec=self.predictor.rads_per_sec,
+            )
+        else:
+            predicted_index = None
         currentPhaseInFrames, sad, self.pog_settings = pog.phase_matching(
-            pixelArray, self.ref_frames, settings=self.pog_settings
+            pixelArray,
+            self.ref_frames,
+            settings=self.pog_settings,
+            reference_cache=self.ref_cache,
+            predicted_index=predicted_index,
         )
         logger.trace(sad)
+        skipBookkeeping = self.qos is not None and self.qos.skip_bookkeeping
+        if self.refiner is not None and not skipBookkeeping:
+            self.refiner.add_frame(
+                pixelArray, currentPhaseInFrames, self.pog_settings["drift"]
+            )
 
         # Convert phase to 2pi base
         current_phase = (
@@ -212,32 +372,47 @@ class OpticalGater:
         if len(self.frame_history) == 0:  # i.e. first frame
             logger.debug("First frame, using current phase as cumulative phase.")
             delta_phase = 0
+            frames_missed = 0
             phase = current_phase
             self.last_phase = current_phase
         else:
-            delta_phase = current_phase - self.last_phase
-            while delta_phase < -np.pi:
-                delta_phase += 2 * np.pi
-            phase = self.frame_history[-1].metadata["unwrapped_phase"] + delta_phase
+            # If frames have been missed since the previous one, the phase may have advanced by more than a whole cycle
+            delta_phase, frames_missed = pog.unwrap_phase_delta(
+                current_phase - self.last_phase,
+                pixelArray.metadata["timestamp"] - self.frame_history.last("timestamp"),
+                self.pog_settings,
+                radsPerSec=self.predictor.rads_per_sec,
+            )
+            phase = self.frame_history.last("unwrapped_phase") + delta_phase
             self.last_phase = current_phase
 
-        # Evicts the oldest entry in frame_history if it exceeds the history length that we are meant to be retaining
-        # Note: deletion of first list element is potentially a performance issue,
-        # although we are hopefully capping the length low enough that it doesn't become a real bottleneck
-        if len(self.frame_history) >= self.settings["frame_buffer_length"]:
-            del self.frame_history[0]
-
-        # Append PixelArray object to frame_history list with its metadata
+        # Append PixelArray object and its metadata to frame_history
+        # (this evicts the oldest entry if we already hold frame_buffer_length frames)
         pixelArray.metadata["unwrapped_phase"] = phase
         pixelArray.metadata["sad_min"] = np.argmin(sad)
-        self.frame_history.append(pixelArray)
+        pixelArray.metadata["frames_missed"] = frames_missed
+        # (if the QoS controller is shedding load, we do not retain the pixel data)
+        self.frame_history.append(
+            None if skipBookkeeping else pixelArray,
+            timestamp=pixelArray.metadata["timestamp"],
+            unwrapped_phase=phase,
+            sad_min=pixelArray.metadata["sad_min"],
+            frames_missed=frames_missed,
+        )
+        # Phases following missed frames are less certain, so are given less weight
+        self.predictor.update(
+            pixelArray.metadata["timestamp"],
+            phase,
+            self.pog_settings,
+            weight=self.pog_settings["missed_frame_weight"] if frames_missed > 0 else 1.0,
+        )
 
         logger.debug(
             "Current time: {0} s; cumulative phase: {1} (delta:{2:+f}) rad; sad: {3}",
-            self.frame_history[-1].metadata["timestamp"],
-            self.frame_history[-1].metadata["unwrapped_phase"],
+            pixelArray.metadata["timestamp"],
+            phase,
             delta_phase,
-            self.frame_history[-1].metadata["sad_min"],
+            pixelArray.metadata["sad_min"],
         )
 
         # If we have at least one period of phase history, have a go at predicting a future trigger time
@@ -257,20 +432,16 @@ class OpticalGater:
 
             # Gets the trigger response
             logger.trace("Predicting next trigger.")
-            time_to_wait_seconds = pog.predict_trigger_wait(
-                pa.get_metadata_from_list(
-                    self.frame_history, ["timestamp", "unwrapped_phase", "sad_min"]
-                ),
-                self.pog_settings,
-                fitBackToBarrier=True,
+            time_to_wait_seconds, uncertainty_s = self.predictor.predict_trigger_wait(
+                self.frame_history, self.pog_settings
             )
             logger.trace("Time to wait: {0} s.".format(time_to_wait_seconds))
-            # frame_history is an nx3 array of [timestamp, phase, argmin(SAD)]
-            # phase (i.e. frame_history[:,1]) should be cumulative 2Pi phase
+            # frame_history holds [timestamp, phase, argmin(SAD)] for each frame (plus other metadata)
+            # phase (i.e. frame_history["unwrapped_phase"]) should be cumulative 2Pi phase
             # targetSyncPhase should be in [0,2pi]
 
             this_predicted_trigger_time_s = (
-                self.frame_history[-1].metadata["timestamp"] + time_to_wait_seconds
+                pixelArray.metadata["timestamp"] + time_to_wait_seconds
             )
 
             # Captures the image
@@ -282,15 +453,16 @@ class OpticalGater:
                     sendTriggerNow,
                     self.pog_settings,
                 ) = pog.decide_trigger(
-                    self.frame_history[-1].metadata["timestamp"],
+                    pixelArray.metadata["timestamp"],
                     time_to_wait_seconds,
                     self.pog_settings,
+                    uncertainty_s=uncertainty_s,
                 )
                 if sendTriggerNow != 0:
                     logger.success(
                         "Sending trigger (reason: {0}) at time ({1} plus {2}) s",
                         sendTriggerNow,
-                        self.frame_history[-1].metadata["timestamp"],
+                        pixelArray.metadata["timestamp"],
                         time_to_wait_seconds,
                     )
                     # Trigger only
@@ -301,16 +473,18 @@ class OpticalGater:
                     # Update trigger iterator (for adaptive algorithm)
                     self.trigger_num += 1
 
-        # Update PixelArray with predicted trigger time and trigger type
-        self.frame_history[-1].metadata[
-            "predicted_trigger_time_s"
-        ] = this_predicted_trigger_time_s
-        self.frame_history[-1].metadata["trigger_type_sent"] = sendTriggerNow
+        # Update PixelArray and frame_history with predicted trigger time and trigger type
+        pixelArray.metadata["predicted_trigger_time_s"] = this_predicted_trigger_time_s
+        pixelArray.metadata["trigger_type_sent"] = sendTriggerNow
+        self.frame_history.set_last(
+            predicted_trigger_time_s=this_predicted_trigger_time_s,
+            trigger_type_sent=sendTriggerNow,
+        )
         logger.debug(
             "Current time: {0} s; predicted trigger time: {1} s; trigger type: {2}",
-            self.frame_history[-1].metadata["timestamp"],
-            self.frame_history[-1].metadata["predicted_trigger_time_s"],
-            self.frame_history[-1].metadata["trigger_type_sent"],
+            pixelArray.metadata["timestamp"],
+            this_predicted_trigger_time_s,
+            sendTriggerNow,
         )
 
         # store this phase now to calculate the delta phase for the next frame
@@ -324,8 +498,16 @@ class OpticalGater:
             or before getting a new reference period in the adaptive mode.
         """
         logger.info("Resetting for new period determination.")
+        if self.adapter is not None:
+            # We are replacing the reference sequence anyway
+            self.adapter.cancel()
+            self.adapter = None
+        self.refiner = None
         self.ref_frames = None
-        self.ref_buffer = []
+        self.refresh_reference_cache()
+        # Start a new buffer (rather than clearing the old one), because our previous
+        # reference frames may still be a view onto the old buffer
+        self.ref_buffer = ring_buffer.FrameRingBuffer(self.ref_buffer_capacity())
         self.period_guesses = []
 
         # TODO: JT writes: I don't like this logic - I don't feel this is the right place for it.
@@ -350,6 +532,8 @@ class OpticalGater:
             self.state = "adapt"
         else:
             logger.info("Switching to determine period mode.")
+            # We are starting from scratch, so should not assume the heart is still where it was
+            self.pog_settings["roi"] = None
             self.state = "determine"
 
     def determine_state(self, pixelArray, modeString="determine period"):
@@ -363,46 +547,25 @@ class OpticalGater:
         """
         logger.debug("Processing frame in {0} mode.".format(modeString))
 
-        # Adds new frame to buffer
-        self.ref_buffer.append(pixelArray)
-        # Impose an upper limit on the buffer length, to protect against performance degradation
-        # in cases where we are not succeeding in identifying a period
-        # Note: deletion of first list element is potentially a performance issue,
-        # although we are hopefully capping the length low enough that it doesn't become a real bottleneck
-        ref_buffer_duration = (self.ref_buffer[-1].metadata["timestamp"]
-                               - self.ref_buffer[0].metadata["timestamp"])
-        if (
-            ("min_heart_rate_hz" in self.settings) and
-            (ref_buffer_duration > 1.0/self.settings["min_heart_rate_hz"])
-           ):
-            logger.debug("Trimming buffer to duration {0}".format(1.0/self.settings["min_heart_rate_hz"]))
-            del self.ref_buffer[0]
-
-        # Calculate period from determine_reference_period.py
-        logger.info("Attempting to determine new reference period.")
-        self.ref_frames, self.pog_settings = ref.establish(
-            self.ref_buffer, self.period_guesses, self.pog_settings
+        # Add the new frame to our buffer, and try to establish a reference sequence (and target frame) from it
+        ref_frames, self.pog_settings = adaptive_update.establish_reference(
+            self.ref_buffer,
+            pixelArray,
+            pixelArray.metadata["timestamp"],
+            self.period_guesses,
+            self.pog_settings,
+            max_duration=self.ref_buffer_max_duration(),
         )
 
-        if self.ref_frames is not None:
-            # We were provided with ref_frames as a list, and this is helpful because it means we could still access
-            # the PixelArray metadata at this point if we wished.
-
-            # However, long-term we want to store a 3D array because that is what oga expects to work with.
-            # We therefore make that conversion here
-            self.ref_frames = np.array(self.ref_frames)
-
-            # Automatically select a target frame and barrier
-            # This can be overriden by the user/controller later
-            self.pog_settings = pog.pick_target_and_barrier_frames(
-                self.ref_frames, self.pog_settings
-            )
-
-            # Determine barrier frames
-            self.pog_settings = pog.determine_barrier_frames(self.pog_settings)
-
-            # Save the period
-            ref.save_period(self.ref_frames, self.settings["period_dir"])
+        if ref_frames is not None:
+            # ref_frames is a view onto self.ref_buffer. No copy is needed,
+            # because we will start a new buffer next time we need one (see reset_state)
+            self.ref_frames = ref_frames
+            self.refresh_reference_cache()
+            self.predictor.reset()
+
+            # Save the period (on a background thread)
+            self.period_archiver.submit(self.ref_frames, self.pog_settings)
             logger.success("Period determined.")
             self.justRefreshedRefFrames = True   # Flag that a slow action took place
 
@@ -443,39 +606,192 @@ class OpticalGater:
                 self.shift_history,
                 self.global_solution,
                 self.target,
-            ) = oga.process_sequence(
+                self.pog_settings,
+            ) = adaptive_update.align_reference(
                 self.ref_frames,
-                self.pog_settings["reference_period"],
-                self.pog_settings["drift"],
-                sequence_history=self.sequence_history,
-                period_history=self.period_history,
-                drift_history=self.drift_history,
-                shift_history=self.shift_history,
-                global_solution=self.global_solution,
-                max_offset=3,
-                ref_seq_id=0,
-                ref_seq_phase=self.pog_settings["referenceFrame"],
-            )
-            self.justRefreshedRefFrames = True   # Flag that a slow action took place
-            self.pog_settings = parameters.update(
                 self.pog_settings,
-                referenceFrame=(
-                    self.pog_settings["reference_period"] * self.target / 80
-                )  # TODO 80 here should be a user-defined variable; we tend not to change it but let's give them the option
-                % self.pog_settings["reference_period"],
+                self.sequence_history,
+                self.period_history,
+                self.drift_history,
+                self.shift_history,
+                self.global_solution,
+                max_sequences=self.settings.get("alignment_history_length", None),
             )
+            self.justRefreshedRefFrames = True   # Flag that a slow action took place
             logger.success(
                 "Reference period updated. New period of length {0} with reference frame at {1}",
                 self.pog_settings["reference_period"],
                 self.pog_settings["referenceFrame"],
             )
 
+            self.start_reference_refinement()
+
             # Switch back to the sync state
             logger.info(
                 "Period updated and adaptive phase-lock successful; switching back to prospective optical gating mode."
             )
             self.state = "sync"
 
+    def start_background_adapter(self):
+        """ Start an adaptive update of the reference sequence on a background thread.
+            We continue to sync using the current reference sequence until check_background_adapter swaps in the new one.
+        """
+        self.adapter = adaptive_update.BackgroundAdapter(
+            self.pog_settings,
+            (
+                self.sequence_history,
+                self.period_history,
+                self.drift_history,
+                self.shift_history,
+                self.global_solution,
+            ),
+            self.ref_buffer_capacity(),
+            max_duration=self.ref_buffer_max_duration(),
+            max_sequences=self.settings.get("alignment_history_length", None),
+        )
+
+    def check_background_adapter(self, pixelArray):
+        """ If the background adaptive update has finished, swap in the new reference sequence.
+            Otherwise, pass the current frame on to it.
+        """
+        if not self.adapter.finished():
+            self.adapter.submit(pixelArray, pixelArray.metadata["timestamp"])
+            return
+
+        adapter = self.adapter
+        self.adapter = None
+        if adapter.result is None:
+            # The update failed. Carry on with our current reference sequence, and try again after another update_after_n_triggers triggers
+            self.trigger_num = 0
+            return
+
+        result = adapter.result
+        old_target_phase = self.pog_settings["targetSyncPhase"]
+        self.ref_frames = result["ref_frames"]
+        (
+            self.sequence_history,
+            self.period_history,
+            self.drift_history,
+            self.shift_history,
+            self.global_solution,
+        ) = result["oga_history"]
+        self.target = result["target"]
+        # Only take the settings describing the new reference sequence: the rest (e.g. drift)
+        # have continued to be updated by sync_state while the adapter was working
+        for key in adaptive_update.REFERENCE_KEYS:
+            self.pog_settings[key] = result["settings"][key]
+        self.refresh_reference_cache()
+        self.predictor.reset()
+
+        # Phases measured against the new reference sequence are offset from those measured against the old one.
+        # The alignment ensures that both target phases correspond to the same point in the heart cycle, so we use
+        # the difference between them to shift our phase history, keeping it continuous for forward-prediction.
+        # last_phase is a wrapped phase (compared with that of the next frame), so it must stay in the range 0 to 2pi
+        phase_offset = self.pog_settings["targetSyncPhase"] - old_target_phase
+        self.frame_history.shift_phases(phase_offset)
+        self.last_phase = (self.last_phase + phase_offset) % (2 * np.pi)
+
+        self.start_reference_refinement()
+
+        self.period_archiver.submit(self.ref_frames, self.pog_settings)
+        self.trigger_num = 0
+        self.justRefreshedRefFrames = True   # Flag that a slow action took place
+        logger.success(
+            "Reference period updated in background. New period of length {0} with reference frame at {1}",
+            self.pog_settings["reference_period"],
+            self.pog_settings["referenceFrame"],
+        )
+
+    def start_reference_refinement(self):
+        """ Start refining the current reference sequence, if settings["reference_refinement"] is set.
+            This should be called whenever a new reference sequence is established.
+        """
+        if self.settings.get("reference_refinement", False) and self.ref_frames is not None:
+            self.refiner = reference_refiner.ReferenceRefiner(
+                self.ref_frames,
+                self.pog_settings["reference_period"],
+                forgetting_factor=self.settings.get("refinement_forgetting_factor", 0.05),
+            )
+        else:
+            self.refiner = None
+
+    def refinement_needs_realignment(self):
+        """ Decide whether the refined reference sequence is still good enough to use, or whether
+            we need to establish a new reference sequence and realign it with the previous ones (a full adaptive update).
+            This is the case if the sample has drifted by more than settings["refinement_max_drift"] pixels,
+            or the heart period (estimated from our recent phase predictions) differs from the reference period
+            by more than a fraction settings["refinement_max_period_change"].
+        """
+        maxDrift = self.settings.get("refinement_max_drift", 2)
+        if max(abs(d) for d in self.pog_settings["drift"]) > maxDrift:
+            logger.info(
+                "Drift {0} exceeds {1} pixels; carrying out full adaptive update",
+                self.pog_settings["drift"],
+                maxDrift,
+            )
+            return True
+        radsPerSec = self.predictor.rads_per_sec
+        if radsPerSec is not None and radsPerSec > 0:
+            period = 2 * np.pi * self.pog_settings["framerate"] / radsPerSec
+            change = abs(period / self.pog_settings["reference_period"] - 1)
+            if change > self.settings.get("refinement_max_period_change", 0.05):
+                logger.info(
+                    "Heart period {0} differs from reference period {1}; carrying out full adaptive update",
+                    period,
+                    self.pog_settings["reference_period"],
+                )
+                return True
+        return False
+
+    def apply_refined_reference(self):
+        """ Switch to the refined copy of the current reference sequence (see reference_refiner).
+            The phase of each reference frame is unchanged, so we can carry on syncing without interruption.
+        """
+        self.ref_frames = self.refiner.reference_frames(self.ref_frames.dtype)
+        self.refresh_reference_cache()
+        self.period_archiver.submit(self.ref_frames, self.pog_settings)
+        self.trigger_num = 0
+        self.justRefreshedRefFrames = True   # Flag that a slow action took place
+        logger.success(
+            "Reference sequence refined, using {0} frames received since it was established",
+            self.refiner.num_blended,
+        )
+
+    def ref_buffer_capacity(self):
+        """ Number of frames to allocate for self.ref_buffer: enough to hold one beat
+            at the slowest heart rate we expect (or frame_buffer_length frames, if no minimum heart rate is set).
+        """
+        if "min_heart_rate_hz" in self.settings:
+            return (
+                int(
+                    np.ceil(
+                        self.settings["brightfield_framerate"]
+                        / self.settings["min_heart_rate_hz"]
+                    )
+                )
+                + 1
+            )
+        return self.settings["frame_buffer_length"]
+
+    def ref_buffer_max_duration(self):
+        """ Upper limit on the time spanned by self.ref_buffer (or None for no limit), to protect against
+            performance degradation in cases where we are not succeeding in identifying a period.
+        """
+        if "min_heart_rate_hz" in self.settings:
+            return 1.0 / self.settings["min_heart_rate_hz"]
+        return None
+
+    def refresh_reference_cache(self):
+        """ Discard any data derived from a previous reference sequence, and (if we have one)
+            prepare the cropped stacks and downsampled pyramid for the current self.ref_frames.
+            This must be called whenever self.ref_frames is replaced.
+        """
+        pyramidLevels = self.pog_settings["pyramid_levels"]
+        if self.qos is not None:
+            # Build the downsampled levels in advance, in case the QoS controller needs to fall back on them
+            pyramidLevels = max(pyramidLevels, qos.PYRAMID_LEVELS)
+        self.ref_cache.reset(self.ref_frames, pyramid_levels=pyramidLevels)
+
     def start_sync_with_ref_frame(self, ref_frame_number):
         self.pog_settings = parameters.update(self.pog_settings, referenceFrame=ref_frame_number)
         # add to periods history for adaptive updates
@@ -494,6 +810,7 @@ class OpticalGater:
                                   ref_seq_id=0,
                                   ref_seq_phase=ref_frame_number,
                                   )
+        self.start_reference_refinement()
 
         # Turn recording back on for rest of run
         self.stop = False
@@ -527,6 +844,16 @@ class OpticalGater:
             # Commit to using this reference frame
             self.start_sync_with_ref_frame(ref_frame_number)
 
+    def shutdown(self):
+        """ Finish any background work (e.g. saving reference periods to disk).
+            Should be called once we have finished analysing frames (otherwise it is called when the interpreter exits).
+        """
+        atexit.unregister(self.shutdown)
+        if self.adapter is not None:
+            self.adapter.cancel()
+            self.adapter = None
+        self.period_archiver.shutdown()
+
     def trigger_fluorescence_image_capture(self, delay):
         """As this is the base server, this function just outputs a log that a trigger would have been sent."""
         logger.success("A fluorescence image would be triggered now.")
@@ -535,15 +862,15 @@ class OpticalGater:
         """Plot the phase vs. time sawtooth line with trigger events."""
 
         # get trigger times from predicted triggers time and trigger types sent (e.g. not 0)
-        sent_trigger_times = pa.get_metadata_from_list(
-            self.frame_history, "predicted_trigger_time_s"
-        )[pa.get_metadata_from_list(self.frame_history, "trigger_type_sent") > 0]
+        sent_trigger_times = self.frame_history["predicted_trigger_time_s"][
+            self.frame_history["trigger_type_sent"] > 0
+        ]
 
         plt.figure()
         plt.title("Zebrafish heart phase with trigger fires")
         plt.plot(
-            pa.get_metadata_from_list(self.frame_history, "timestamp"),
-            pa.get_metadata_from_list(self.frame_history, "unwrapped_phase")
+            self.frame_history["timestamp"],
+            self.frame_history["unwrapped_phase"]
             % (2 * np.pi),
             label="Heart phase",
         )
@@ -568,14 +895,12 @@ class OpticalGater:
 
     def plot_accuracy(self, outfile="accuracy.png"):
         """Plot the target phase and adjusted real phase of trigger events."""
-        wrapped_phase = pa.get_metadata_from_list(
-            self.frame_history, "unwrapped_phase"
-        ) % (2 * np.pi)
+        wrapped_phase = self.frame_history["unwrapped_phase"] % (2 * np.pi)
 
         # get trigger times from predicted triggers time and trigger types sent (e.g. not 0)
-        sent_trigger_times = pa.get_metadata_from_list(
-            self.frame_history, "predicted_trigger_time_s"
-        )[pa.get_metadata_from_list(self.frame_history, "trigger_type_sent") > 0]
+        sent_trigger_times = self.frame_history["predicted_trigger_time_s"][
+            self.frame_history["trigger_type_sent"] > 0
+        ]
 
         triggeredPhase = []
         for i in range(len(sent_trigger_times)):
@@ -584,7 +909,7 @@ class OpticalGater:
                 wrapped_phase[
                     (
                         np.abs(
-                            pa.get_metadata_from_list(self.frame_history, "timestamp")
+                            self.frame_history["timestamp"]
                             - sent_trigger_times[i]
                         )
                     ).argmin()
@@ -615,8 +940,8 @@ class OpticalGater:
         plt.figure()
         plt.title("Predicted Trigger Times")
         plt.plot(
-            pa.get_metadata_from_list(self.frame_history, "timestamp"),
-            pa.get_metadata_from_list(self.frame_history, "predicted_trigger_time_s"),
+            self.frame_history["timestamp"],
+            self.frame_history["predicted_trigger_time_s"],
         )
         # Add labels etc
         plt.xlabel("Time (s)")
@@ -630,8 +955,8 @@ class OpticalGater:
         plt.figure()
         plt.title("Frame processing rate")
         plt.plot(
-            pa.get_metadata_from_list(self.frame_history, "timestamp"),
-            pa.get_metadata_from_list(self.frame_history, "processing_rate_fps"),
+            self.frame_history["timestamp"],
+            self.frame_history["processing_rate_fps"],
         )
         # Add labels etc
         plt.xlabel("Time (s)")
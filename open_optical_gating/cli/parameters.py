@@ -6,6 +6,7 @@
 # ... but I expect to tackle all of this in a refactor, so probably just leave this comment as a reminder for now.
 
 ## Imports
+import json
 import numpy as np
 
 
@@ -19,6 +20,18 @@ def save():
     return
 
 
+def to_json(parameters):
+    """ Returns a JSON string representing our custom settings dict
+        (NumPy arrays and scalars are converted to the equivalent lists and numbers).
+    """
+    def convert(value):
+        if hasattr(value, "tolist"):
+            return value.tolist()
+        return str(value)
+
+    return json.dumps(parameters, default=convert, indent=4)
+
+
 def initialise(
     drift=[0, 0],
     framerate=80,
@@ -35,6 +48,27 @@ def initialise(
     minPeriod=5,
     lowerThresholdFactor=0.5,
     upperThresholdFactor=0.75,
+    sad_backend="auto",
+    fused_drift_search=False,
+    fused_drift_neighbours=2,
+    pyramid_levels=0,
+    pyramid_shortlist_width=3,
+    phase_search_window=0,
+    phase_search_sad_factor=1.5,
+    auto_roi=False,
+    roi_variance_fraction=0.1,
+    roi_margin=4,
+    sad_early_abandon=False,
+    sad_abandon_margin=0.1,
+    sad_block_rows=8,
+    phase_predictor="linear",
+    kalman_process_noise=1.0,
+    kalman_measurement_noise=1e-3,
+    trigger_uncertainty_factor=2.0,
+    period_method="fast",
+    frame_gap_factor=1.5,
+    missed_frame_weight=0.25,
+    drift_update_interval=1,
 ):
     """Function to initialise our custom settings dict with sensible pre-sets."""
     parameters = {}
@@ -78,6 +112,67 @@ def initialise(
     parameters.update({"minPeriod": minPeriod})
     parameters.update({"lowerThresholdFactor": lowerThresholdFactor})
     parameters.update({"upperThresholdFactor": upperThresholdFactor})
+    parameters.update(
+        {"sad_backend": sad_backend}
+    )  # SAD implementation to use (see sad_backends.py)
+    parameters.update(
+        {"fused_drift_search": fused_drift_search}
+    )  # do phase matching and drift update in a single pass (see phase_matching_fused)
+    parameters.update(
+        {"fused_drift_neighbours": fused_drift_neighbours}
+    )  # reference frames either side of the predicted match to use for the fused drift update
+    parameters.update(
+        {"pyramid_levels": pyramid_levels}
+    )  # number of 2x downsampled levels for coarse-to-fine phase matching (0 to disable)
+    parameters.update(
+        {"pyramid_shortlist_width": pyramid_shortlist_width}
+    )  # reference frames either side of the coarse best match to re-check at the next finer level
+    parameters.update(
+        {"phase_search_window": phase_search_window}
+    )  # reference frames either side of the predicted match to search first (0 to always do a full search)
+    parameters.update(
+        {"phase_search_sad_factor": phase_search_sad_factor}
+    )  # fall back to a full search if the windowed best SAD exceeds this multiple of the previous best SAD
+    parameters.update(
+        {"auto_roi": auto_roi}
+    )  # restrict phase matching to a region of interest around the moving heart
+    parameters.update(
+        {"roi_variance_fraction": roi_variance_fraction}
+    )  # pixels whose temporal variance exceeds this fraction of the maximum are included in the ROI
+    parameters.update({"roi_margin": roi_margin})  # pixels to add around the ROI
+    parameters.update(
+        {"sad_early_abandon": sad_early_abandon}
+    )  # abandon SADs against reference frames that are clearly worse than the best match so far
+    parameters.update(
+        {"sad_abandon_margin": sad_abandon_margin}
+    )  # fractional margin above the best SAD so far before a reference frame is abandoned
+    parameters.update(
+        {"sad_block_rows": sad_block_rows}
+    )  # rows accumulated between checks against the best SAD so far
+    parameters.update(
+        {"phase_predictor": phase_predictor}
+    )  # strategy used to predict trigger times (see predictors.py)
+    parameters.update(
+        {"kalman_process_noise": kalman_process_noise}
+    )  # spectral density of random changes in heart rate for the "kalman" predictor (rad^2/s^3)
+    parameters.update(
+        {"kalman_measurement_noise": kalman_measurement_noise}
+    )  # variance of each phase measurement for the "kalman" predictor (rad^2)
+    parameters.update(
+        {"trigger_uncertainty_factor": trigger_uncertainty_factor}
+    )  # number of standard deviations of prediction uncertainty to allow for when deciding to trigger
+    parameters.update(
+        {"period_method": period_method}
+    )  # "fast" or "reference" implementation of determine_reference_period.calculate_period_length
+    parameters.update(
+        {"frame_gap_factor": frame_gap_factor}
+    )  # a gap between frames longer than this many frame intervals means that frames have been missed
+    parameters.update(
+        {"missed_frame_weight": missed_frame_weight}
+    )  # relative weight given (in phase fits) to frames that follow missed frames
+    parameters.update(
+        {"drift_update_interval": drift_update_interval}
+    )  # only update the drift estimate every this many frames in phase_matching
 
     # automatically added keys
     # DevNote: int(x+1) is the same as np.ceil(x).astype(np.int)
@@ -98,6 +193,9 @@ def initialise(
     else:
         parameters.update({"targetSyncPhase": 0})  # target phase in rads
     parameters.update({"lastSent": 0.0})
+    parameters.update({"roi": None})  # X1,X2,Y1,Y2 region of interest (None for whole frame)
+    parameters.update({"lastSADMin": 0})  # best SAD for the most recent frame
+    parameters.update({"framesSinceDriftUpdate": 0})  # frames since phase_matching last updated the drift
     # parameters.update({'frameToUseArray':[0]})#this should be created locally when needed
 
     return parameters
@@ -120,6 +218,27 @@ def update(
     minPeriod=None,
     lowerThresholdFactor=None,
     upperThresholdFactor=None,
+    sad_backend=None,
+    fused_drift_search=None,
+    fused_drift_neighbours=None,
+    pyramid_levels=None,
+    pyramid_shortlist_width=None,
+    phase_search_window=None,
+    phase_search_sad_factor=None,
+    auto_roi=None,
+    roi_variance_fraction=None,
+    roi_margin=None,
+    sad_early_abandon=None,
+    sad_abandon_margin=None,
+    sad_block_rows=None,
+    phase_predictor=None,
+    kalman_process_noise=None,
+    kalman_measurement_noise=None,
+    trigger_uncertainty_factor=None,
+    period_method=None,
+    frame_gap_factor=None,
+    missed_frame_weight=None,
+    drift_update_interval=None,
 ):
     """Function to update our custom settings dict with sensible pre-sets.
     Note: users should not use parameters.update(), i.e. a dictionary update
@@ -145,6 +264,48 @@ def update(
         parameters["lowerThresholdFactor"] = lowerThresholdFactor
     if upperThresholdFactor is not None:
         parameters["upperThresholdFactor"] = upperThresholdFactor
+    if sad_backend is not None:
+        parameters["sad_backend"] = sad_backend
+    if fused_drift_search is not None:
+        parameters["fused_drift_search"] = fused_drift_search
+    if fused_drift_neighbours is not None:
+        parameters["fused_drift_neighbours"] = fused_drift_neighbours
+    if pyramid_levels is not None:
+        parameters["pyramid_levels"] = pyramid_levels
+    if pyramid_shortlist_width is not None:
+        parameters["pyramid_shortlist_width"] = pyramid_shortlist_width
+    if phase_search_window is not None:
+        parameters["phase_search_window"] = phase_search_window
+    if phase_search_sad_factor is not None:
+        parameters["phase_search_sad_factor"] = phase_search_sad_factor
+    if auto_roi is not None:
+        parameters["auto_roi"] = auto_roi
+    if roi_variance_fraction is not None:
+        parameters["roi_variance_fraction"] = roi_variance_fraction
+    if roi_margin is not None:
+        parameters["roi_margin"] = roi_margin
+    if sad_early_abandon is not None:
+        parameters["sad_early_abandon"] = sad_early_abandon
+    if sad_abandon_margin is not None:
+        parameters["sad_abandon_margin"] = sad_abandon_margin
+    if sad_block_rows is not None:
+        parameters["sad_block_rows"] = sad_block_rows
+    if phase_predictor is not None:
+        parameters["phase_predictor"] = phase_predictor
+    if kalman_process_noise is not None:
+        parameters["kalman_process_noise"] = kalman_process_noise
+    if kalman_measurement_noise is not None:
+        parameters["kalman_measurement_noise"] = kalman_measurement_noise
+    if trigger_uncertainty_factor is not None:
+        parameters["trigger_uncertainty_factor"] = trigger_uncertainty_factor
+    if period_method is not None:
+        parameters["period_method"] = period_method
+    if frame_gap_factor is not None:
+        parameters["frame_gap_factor"] = frame_gap_factor
+    if missed_frame_weight is not None:
+        parameters["missed_frame_weight"] = missed_frame_weight
+    if drift_update_interval is not None:
+        parameters["drift_update_interval"] = drift_update_interval
 
     if barrierFrame is not None:
         parameters["barrierFrame"] = (
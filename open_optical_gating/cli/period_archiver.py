@@ -0,0 +1,98 @@
+"""Background thread for saving reference periods to disk, off the frame-processing path."""
+
+# Python imports
+import queue
+import threading
+from datetime import datetime
+
+# Module imports
+import numpy as np
+from loguru import logger
+
+# Local imports
+from . import determine_reference_period as ref
+from . import parameters
+
+
+class PeriodArchiver:
+    """ Saves reference periods (see ref.save_period) on a background thread.
+
+        submit() never blocks: periods are placed on a bounded queue, and if the writer has fallen
+        so far behind that the queue is full, the new period is dropped (with a warning) rather
+        than stalling the caller. The frames passed to submit() are not copied, so the caller must
+        not modify them afterwards (replacing them with a new array is fine).
+        Call flush() to wait for all queued periods to be written, and shutdown() before exiting.
+    """
+
+    def __init__(self, parent_dir, file_format="tiff", compress=0, max_queue_length=4):
+        """Function inputs:
+            parent_dir          str     Directory within which to store the periods
+            file_format         str     "tiff", "npz" or "frames" (see ref.save_period)
+            compress            int     zlib compression level for "tiff" files (0 for no compression)
+            max_queue_length    int     Maximum number of periods waiting to be written
+        """
+        self.parent_dir = parent_dir
+        self.file_format = file_format
+        self.compress = compress
+        self._queue = queue.Queue(maxsize=max(int(max_queue_length), 1))
+        self._thread = None
+        self.num_dropped = 0
+
+    def submit(self, reference_period, settings=None):
+        """ Queue a reference period to be written to disk.
+            Parameters:
+                reference_period    ndarray     t by x by y 3d array of reference frames
+                settings            dict        Parameters controlling the sync algorithms (a snapshot is saved alongside)
+            Returns:
+                True if the period was queued, False if it was dropped because the queue is full
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="PeriodArchiver", daemon=True
+            )
+            self._thread.start()
+        # Take the time stamp and settings snapshot now, since settings will continue to change
+        dt = datetime.now().strftime("%Y-%m-%dT%H%M%S.%f")
+        snapshot = None if settings is None else parameters.to_json(settings)
+        try:
+            self._queue.put_nowait((np.asarray(reference_period), snapshot, dt))
+        except queue.Full:
+            self.num_dropped += 1
+            logger.warning(
+                "Period archive queue is full; not saving reference period {0}", dt
+            )
+            return False
+        return True
+
+    def flush(self):
+        """Block until all queued periods have been written."""
+        if self._thread is not None:
+            self._queue.join()
+
+    def shutdown(self):
+        """Write any queued periods, and then stop the background thread."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                reference_period, snapshot, dt = item
+                path = ref.save_period(
+                    reference_period,
+                    self.parent_dir,
+                    file_format=self.file_format,
+                    compress=self.compress,
+                    settings=snapshot,
+                    dt=dt,
+                )
+                logger.info("Saved reference period to {0}", path)
+            except Exception as e:
+                logger.error("Failed to save reference period: {0}", e)
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,348 @@
+"""Post-acquisition phase stamping of recorded brightfield data: determines the phase of every frame in a file
+(or dataset, see frame_sources.dataset_files), without sending any triggers.
+
+Rather than pushing every frame through an OpticalGater, the frames are split into chunks that are
+phase-matched in parallel, in separate processes that share a single copy of the reference sequence.
+Phase matching carries some state from one frame to the next (most importantly the drift estimate),
+so each chunk starts by processing a few "warmup" frames before the chunk itself to establish that state.
+If that does not reproduce the state at the end of the previous chunk (e.g. because the sample was drifting),
+the chunk is processed again starting from that state. The (wrapped) phases from all the chunks are then
+unwrapped together, so the result is the same as if the frames had been processed one after another.
+
+Run with, e.g.:
+    python -m open_optical_gating.cli.phase_stamp optical_gating_data/example_data_settings.json --output phases.npz
+The reference sequence is determined from the start of the data, unless one is provided with --reference."""
+
+# Python imports
+import concurrent.futures
+import copy
+import multiprocessing
+import sys
+
+# Module imports
+import numpy as np
+from loguru import logger
+from tqdm.auto import tqdm
+
+# Shared memory requires python 3.8. Without it, each worker process gets its own copy of the reference sequence
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+# Local imports
+from . import adaptive_update
+from . import file_optical_gater
+from . import frame_sources
+from . import parameters
+from . import prospective_optical_gating as pog
+from . import reference_cache
+from . import ring_buffer
+
+# State of each worker process (set up by _init_worker)
+_worker = {}
+
+# Entries in the settings that phase matching updates as it goes along
+# (together with the best-matching reference frame for the previous frame, these determine the result for the next frame)
+STATE_KEYS = ("drift", "framesSinceDriftUpdate", "lastSADMin")
+
+
+def open_frames(path, read_ahead=16):
+    """Returns the frames at 'path' (a TIFF file, or a directory, glob pattern or playlist of them) as a 3D array-like object."""
+    if frame_sources.is_dataset(path):
+        return frame_sources.DatasetFrameSource(path, read_ahead=read_ahead)
+    return frame_sources.TiffFrameSource(path, read_ahead=read_ahead)
+
+
+def determine_reference(frames, settings, max_frames):
+    """ Establish a reference sequence from the first frames of 'frames' (as OpticalGater does in "determine" mode).
+        Parameters:
+            frames          array-like  3D frame pixel data
+            settings        dict        Parameters controlling the sync algorithms
+            max_frames      int         Maximum number of frames to use
+        Returns:
+            ref_frames      ndarray     3D frame pixel data for the reference sequence
+            settings        dict        Updated settings
+    """
+    ref_buffer = ring_buffer.FrameRingBuffer(max_frames)
+    period_guesses = []
+    for i in range(min(max_frames, len(frames))):
+        ref_frames, settings = adaptive_update.establish_reference(
+            ref_buffer, frames[i], i / settings["framerate"], period_guesses, settings
+        )
+        if ref_frames is not None:
+            logger.success(
+                "Reference period of {0} frames determined from the first {1} frames",
+                settings["reference_period"],
+                i + 1,
+            )
+            # Copy, because ref_frames is a view onto ref_buffer
+            return np.array(ref_frames), settings
+    raise RuntimeError(
+        "Unable to determine a reference period from the first {0} frames".format(max_frames)
+    )
+
+
+def unwrap_phases(wrapped):
+    """ Unwrap the phases (in radians, in the range 0 to 2pi) of consecutive frames, using the same rule as
+        OpticalGater in "sync" mode: the phase is assumed to have wrapped round if it decreases by more than pi.
+        Parameters:
+            wrapped     ndarray     1D array of phases
+        Returns:
+            1D array of unwrapped phases (the first being the same as the first wrapped phase)
+    """
+    deltas = np.diff(wrapped)
+    deltas[deltas < -np.pi] += 2 * np.pi
+    # Accumulate in order (from the first phase), so the result is identical to unwrapping one frame at a time
+    return np.cumsum(np.concatenate([wrapped[:1], deltas]))
+
+
+def _init_worker(path, read_ahead, settings, shared_name, shape, dtype, ref_frames):
+    # Attach to the reference sequence (in shared memory, if available), and open the data file
+    if shared_name is not None:
+        _worker["shared"] = shared_memory.SharedMemory(name=shared_name)
+        ref_frames = np.ndarray(shape, dtype=dtype, buffer=_worker["shared"].buf)
+    _worker["ref_frames"] = ref_frames
+    _worker["ref_cache"] = reference_cache.ReferenceStackCache(
+        ref_frames, pyramid_levels=settings["pyramid_levels"]
+    )
+    _worker["settings"] = settings
+    _worker["frames"] = open_frames(path, read_ahead)
+
+
+def _phase_matching_state(settings, lastIndex):
+    # Hashable snapshot of the state carried from one frame to the next (see STATE_KEYS)
+    return tuple(
+        tuple(settings[k]) if k == "drift" else settings[k] for k in STATE_KEYS
+    ) + (lastIndex,)
+
+
+def phase_stamp_chunk(start, stop, warmup, state=None):
+    """ Phase-match frames start to stop-1 (in a worker process).
+        If 'state' is given, we carry on from that state (as returned by a previous call for the frames before 'start').
+        Otherwise we start by processing the 'warmup' frames before 'start' (and discarding the results),
+        so that the drift estimate has settled by the time we reach the chunk itself.
+        Returns:
+            phases      ndarray     Wrapped phase of each frame (radians)
+            sad_min     ndarray     Index of the best-matching reference frame for each frame
+            drift       ndarray     Drift estimate (x, y) after processing each frame
+            entry_state tuple       Phase matching state on reaching frame 'start'
+            final_state tuple       Phase matching state after processing frame stop-1
+    """
+    frames = _worker["frames"]
+    ref_frames = _worker["ref_frames"]
+    settings = copy.deepcopy(_worker["settings"])
+    phases = np.zeros(stop - start)
+    sad_min = np.zeros(stop - start, dtype=int)
+    drift = np.zeros((stop - start, 2), dtype=int)
+    if state is None:
+        first = max(start - warmup, 0)
+        lastIndex = None
+    else:
+        first = start
+        for k, value in zip(STATE_KEYS, state):
+            settings[k] = list(value) if k == "drift" else value
+        lastIndex = state[-1]
+    for i in range(first, stop):
+        if i == start:
+            entry_state = _phase_matching_state(settings, lastIndex)
+        if lastIndex is not None:
+            predicted_index = pog.predict_reference_index(
+                lastIndex, (i - 1) / settings["framerate"], i / settings["framerate"], settings
+            )
+        else:
+            predicted_index = None
+        phaseInFrames, sad, settings = pog.phase_matching(
+            frames[i],
+            ref_frames,
+            settings=settings,
+            reference_cache=_worker["ref_cache"],
+            predicted_index=predicted_index,
+        )
+        lastIndex = np.argmin(sad)
+        if i >= start:
+            phases[i - start] = (
+                2
+                * np.pi
+                * (phaseInFrames - settings["numExtraRefFrames"])
+                / settings["reference_period"]
+            )
+            sad_min[i - start] = lastIndex
+            drift[i - start] = settings["drift"]
+    return phases, sad_min, drift, entry_state, _phase_matching_state(settings, lastIndex)
+
+
+def phase_stamp(path, ref_frames, settings, chunk_size=1000, warmup=32, workers=None, read_ahead=16):
+    """ Determine the phase of every frame at 'path', by phase-matching chunks of frames in parallel.
+        Parameters:
+            path        str         TIFF file, or directory, glob pattern or playlist of TIFF files
+            ref_frames  ndarray     3D frame pixel data for the reference sequence
+            settings    dict        Parameters controlling the sync algorithms
+            chunk_size  int         Number of frames to phase-match in each task
+            warmup      int         Number of frames before each chunk to process first (see phase_stamp_chunk).
+                                    Chunks whose warmup does not reproduce the state at the end of the previous chunk
+                                    are processed again (one after another), so a longer warmup can save time
+                                    if the sample is drifting, but does not change the result
+            workers     int         Number of worker processes (default: the number of CPUs)
+            read_ahead  int         Number of pages to decode at a time, for files that cannot be memory-mapped
+        Returns:
+            dict of 1D arrays "timestamp", "phase", "unwrapped_phase", "sad_min", and 2D array "drift" (one row per frame)
+    """
+    numFrames = len(open_frames(path, read_ahead))
+    starts = list(range(0, numFrames, chunk_size))
+
+    ref_frames = np.ascontiguousarray(ref_frames)
+    shared = None
+    if shared_memory is not None:
+        shared = shared_memory.SharedMemory(create=True, size=ref_frames.nbytes)
+        np.ndarray(ref_frames.shape, dtype=ref_frames.dtype, buffer=shared.buf)[:] = ref_frames
+        initargs = (path, read_ahead, settings, shared.name, ref_frames.shape, ref_frames.dtype, None)
+    else:
+        initargs = (path, read_ahead, settings, None, None, None, ref_frames)
+
+    try:
+        # The caller may already have threads running (e.g. an OpticalGater's frame pipeline or period archiver),
+        # and forking a process with threads running can leave locks held forever, so we start fresh worker processes
+        # (_init_worker is given everything they need)
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=initargs,
+        ) as executor:
+            futures = {
+                executor.submit(phase_stamp_chunk, start, min(start + chunk_size, numFrames), warmup): start
+                for start in starts
+            }
+            with tqdm(total=numFrames, unit="frame", desc="Phase stamping") as progress:
+                for future in concurrent.futures.as_completed(futures):
+                    progress.update(min(chunk_size, numFrames - futures[future]))
+            # Collect the results in order of frame number
+            results = [future.result() for future in sorted(futures, key=futures.get)]
+            # Check that each chunk started from the state reached at the end of the previous one,
+            # and if not, process it again from that state (this may then change the state at the end of the chunk)
+            numRepeated = 0
+            for n in range(1, len(results)):
+                if results[n][3] != results[n - 1][4]:
+                    start = starts[n]
+                    results[n] = executor.submit(
+                        phase_stamp_chunk, start, min(start + chunk_size, numFrames), warmup, results[n - 1][4]
+                    ).result()
+                    numRepeated += 1
+            if numRepeated > 0:
+                logger.info(
+                    "Processed {0} of {1} chunks again, because their warmup did not reproduce the drift estimate",
+                    numRepeated,
+                    len(results),
+                )
+    finally:
+        if shared is not None:
+            shared.close()
+            shared.unlink()
+
+    phases = np.concatenate([r[0] for r in results])
+    return {
+        "timestamp": np.arange(numFrames) / settings["framerate"],
+        "phase": phases,
+        "unwrapped_phase": unwrap_phases(phases),
+        "sad_min": np.concatenate([r[1] for r in results]),
+        "drift": np.concatenate([r[2] for r in results]),
+    }
+
+
+def save_results(results, filename, reference_period):
+    """Save the results of phase_stamp() as a NumPy .npz file or (if 'filename' ends in ".csv") as a CSV file."""
+    if filename.lower().endswith(".csv"):
+        columns = np.column_stack(
+            [
+                results["timestamp"],
+                results["phase"],
+                results["unwrapped_phase"],
+                results["sad_min"],
+                results["drift"],
+            ]
+        )
+        np.savetxt(
+            filename,
+            columns,
+            delimiter=",",
+            fmt=["%.6f", "%.9f", "%.9f", "%d", "%d", "%d"],
+            header="timestamp,phase,unwrapped_phase,sad_min,drift_x,drift_y",
+            comments="",
+        )
+    else:
+        np.savez(filename, reference_period=reference_period, **results)
+    logger.success("Saved phase stamps for {0} frames to {1}", len(results["phase"]), filename)
+
+
+def add_extra_args(parser):
+    parser.add_argument("--output", default="phase_stamps.npz", help="Output file (.npz or .csv)")
+    parser.add_argument(
+        "--reference",
+        help="TIFF file containing the reference sequence (if not given, it is determined from the start of the data)",
+    )
+    parser.add_argument(
+        "--reference-period",
+        type=float,
+        help="Period (in frames) of the reference sequence given by --reference (default: its length minus the padding frames)",
+    )
+    parser.add_argument(
+        "--head-frames",
+        type=int,
+        default=1000,
+        help="Maximum number of frames to use when determining the reference sequence",
+    )
+    parser.add_argument("--chunk-size", type=int, default=1000, help="Number of frames in each parallel task")
+    parser.add_argument(
+        "--warmup",
+        type=int,
+        default=32,
+        help="Number of frames before each chunk used to settle the drift estimate (chunks for which this is not enough are processed again)",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None, help="Number of worker processes (default: number of CPUs)"
+    )
+
+
+def run(args, desc):
+    """ Run phase stamping based on a settings.json file which includes the path to the data to be processed.
+        Params:   args       list    Caller should normally pass sys.argv[1:] here
+                  desc       str     Description to provide as command line help description
+    """
+    settings = file_optical_gater.load_settings(args, desc, add_extra_args)
+    args = settings["parsed_args"]
+    read_ahead = settings.get("read_ahead_frames", 16)
+    pog_settings = parameters.initialise(
+        framerate=settings["brightfield_framerate"], **settings.get("pog_settings", {})
+    )
+
+    if args.reference is not None:
+        ref_frames = open_frames(args.reference, read_ahead)
+        ref_frames = np.array([ref_frames[i] for i in range(len(ref_frames))])
+        period = args.reference_period
+        if period is None:
+            period = len(ref_frames) - 2 * pog_settings["numExtraRefFrames"]
+        pog_settings = parameters.update(pog_settings, reference_period=period)
+        pog_settings = pog.determine_barrier_frames(pog_settings)
+        if pog_settings["auto_roi"]:
+            pog_settings["roi"] = pog.determine_roi(ref_frames, pog_settings)
+    else:
+        ref_frames, pog_settings = determine_reference(
+            open_frames(settings["path"], read_ahead), pog_settings, args.head_frames
+        )
+
+    results = phase_stamp(
+        settings["path"],
+        ref_frames,
+        pog_settings,
+        chunk_size=args.chunk_size,
+        warmup=args.warmup,
+        workers=args.workers,
+        read_ahead=read_ahead,
+    )
+    save_results(results, args.output, pog_settings["reference_period"])
+    return True
+
+
+if __name__ == "__main__":
+    run(sys.argv[1:], "Determine the phase of every frame in recorded brightfield data")
@@ -124,8 +124,9 @@ class PiOpticalGater(server.OpticalGater):
             )
 
         logger.success("Emulating...")
-        while not self.stop:
-            self.analyze_pixelarray(self.next_frame(force_framerate=force_framerate))
+        self.analyse_until_stopped(
+            lambda: self.next_frame(force_framerate=force_framerate)
+        )
 
     def next_frame(self, force_framerate=False):
         """This function gets the next frame from the data source, which can be passed to analyze()"""
@@ -217,6 +218,7 @@ def run(args, desc):
 
     logger.success("Running server...")
     analyser.run_server(force_framerate=True)
+    analyser.shutdown()
 
     logger.success("Plotting summaries...")
     analyser.plot_triggers()
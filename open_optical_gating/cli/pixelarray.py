@@ -10,6 +10,9 @@ Frame metadata:
         "predicted_trigger_time_s"  The predicted trigger as determined by prospective optical gating
         "trigger_type_sent"         Trigger type sent; 0 is no trigger; 1 and 2 are a sent trigger
         "processing_rate_fps"       Current frame processing rate in frames per second
+        "frames_missed"             Number of frames we believe were missed (e.g. dropped) immediately before this one
+        "qos_level"                 Quality-of-service degradation level in use (0 is full quality; see qos.py)
+        "qos_decision"              Description of a change in QoS level made after processing this frame (if any)
 """
 
 import numpy as np
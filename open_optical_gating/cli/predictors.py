@@ -0,0 +1,163 @@
+"""Registry of interchangeable strategies for predicting when the heart will next reach the target phase.
+
+Each predictor provides:
+    reset()                                             Called whenever the reference sequence changes
+    update(timestamp, unwrapped_phase, settings,        Called once for every frame analysed in sync mode
+           weight=1.0)                                  (weight < 1 for frames whose phase is less certain)
+    predict_trigger_wait(frame_history, settings)       Returns (time to wait in seconds, uncertainty in seconds or None)
+    rads_per_sec                                        Rate of change of phase used for the most recent prediction
+                                                        (None until a prediction has been made)
+
+Available predictors:
+    "linear"    Linear fit to recent phases, using the barrier frame logic (see pog.predict_trigger_wait)
+    "kalman"    Constant-velocity Kalman filter tracking unwrapped phase and its rate of change
+"""
+
+# Module imports
+import numpy as np
+from loguru import logger
+
+# Local imports
+from . import prospective_optical_gating as pog
+
+
+_predictors = {}
+
+
+def register_predictor(name, predictor_class):
+    """ Register a predictor class under 'name', so that it can be selected with the "phase_predictor" setting.
+        Registering under an existing name replaces that predictor.
+    """
+    _predictors[name] = predictor_class
+    return predictor_class
+
+
+def available_predictors():
+    """Returns a list of the names of the registered predictors."""
+    return list(_predictors.keys())
+
+
+def get_predictor(name="linear"):
+    """ Create a new predictor object (predictors hold state, so each OpticalGater needs its own).
+        Parameters:
+            name    str     One of available_predictors()
+        Returns:
+            predictor object
+    """
+    try:
+        return _predictors[name]()
+    except KeyError:
+        raise ValueError(
+            "Unknown phase predictor '{0}' (available predictors are: {1})".format(
+                name, ", ".join(available_predictors())
+            )
+        )
+
+
+class LinearPredictor:
+    """ The original prediction strategy: a least-squares linear fit to the recent unwrapped phases
+        (fitting back as far as the barrier frame), extrapolated forward to the target phase.
+        This does not provide an estimate of its uncertainty.
+    """
+
+    def __init__(self):
+        self.rads_per_sec = None
+
+    def reset(self):
+        # The heart rate does not change just because the reference sequence has, so we keep rads_per_sec
+        pass
+
+    def update(self, timestamp, unwrapped_phase, settings, weight=1.0):
+        # The fit is carried out from frame_history when we need a prediction
+        # (taking account of the weights, see pog.linear_fit)
+        pass
+
+    def predict_trigger_wait(self, frame_history, settings):
+        time_to_wait_seconds, radsPerSec = pog.predict_trigger_wait(
+            frame_history, settings, fitBackToBarrier=True
+        )
+        if radsPerSec is not None:
+            self.rads_per_sec = radsPerSec
+        return time_to_wait_seconds, None
+
+
+class KalmanPredictor:
+    """ Constant-velocity Kalman filter on unwrapped phase. The state is [phase, radsPerSec];
+        the phase velocity is modelled as a random walk with spectral density settings["kalman_process_noise"]
+        (rad^2/s^3), and each phase measurement has variance settings["kalman_measurement_noise"] (rad^2),
+        divided by the weight given to that measurement.
+
+        Each update takes constant time, and the filter covariance gives an estimate of the
+        uncertainty in the predicted trigger time, which decide_trigger can use to decide whether
+        it is safe to wait for another frame before committing to a trigger.
+    """
+
+    def __init__(self):
+        self.rads_per_sec = None
+        self.reset()
+
+    def reset(self):
+        # Phases measured against a new reference sequence are not directly comparable with the old ones,
+        # so we start again from scratch (but the heart rate has not changed, so we keep rads_per_sec)
+        self.state = None
+        self.covariance = None
+        self.last_timestamp = None
+
+    def update(self, timestamp, unwrapped_phase, settings, weight=1.0):
+        if self.state is None:
+            # Start from the heart rate implied by the reference sequence, with a generous uncertainty
+            radsPerSec = 2 * np.pi * settings["framerate"] / settings["reference_period"]
+            self.state = np.array([unwrapped_phase, radsPerSec])
+            self.covariance = np.diag(
+                [settings["kalman_measurement_noise"], (0.5 * radsPerSec) ** 2]
+            )
+            self.last_timestamp = timestamp
+            return
+
+        # Predict forward to this frame
+        dt = timestamp - self.last_timestamp
+        self.last_timestamp = timestamp
+        F = np.array([[1.0, dt], [0.0, 1.0]])
+        self.state = F @ self.state
+        self.covariance = F @ self.covariance @ F.T + self._process_noise(dt, settings)
+
+        # Incorporate the measured phase
+        residual = unwrapped_phase - self.state[0]
+        innovationVariance = self.covariance[0, 0] + settings["kalman_measurement_noise"] / weight
+        gain = self.covariance[:, 0] / innovationVariance
+        self.state = self.state + gain * residual
+        self.covariance = self.covariance - np.outer(gain, self.covariance[0, :])
+        logger.trace(
+            "Kalman phase {0}, velocity {1} rad/s (residual {2})",
+            self.state[0],
+            self.state[1],
+            residual,
+        )
+
+    def predict_trigger_wait(self, frame_history, settings):
+        if self.state is None:
+            return -1, None
+        phase, radsPerSec = self.state
+        self.rads_per_sec = radsPerSec
+        time_to_wait_seconds = pog.time_to_target_phase(
+            phase, radsPerSec, self.last_timestamp, settings
+        )
+        if radsPerSec <= 0:
+            return time_to_wait_seconds, None
+
+        # Propagate the covariance forward to the predicted trigger time, and convert the
+        # resulting uncertainty in phase into an uncertainty in time
+        dt = time_to_wait_seconds
+        F = np.array([[1.0, dt], [0.0, 1.0]])
+        covariance = F @ self.covariance @ F.T + self._process_noise(dt, settings)
+        uncertainty_s = np.sqrt(covariance[0, 0]) / radsPerSec
+        logger.debug("Predicted trigger time uncertainty: {0} s", uncertainty_s)
+        return time_to_wait_seconds, uncertainty_s
+
+    def _process_noise(self, dt, settings):
+        q = settings["kalman_process_noise"]
+        return q * np.array([[dt ** 3 / 3, dt ** 2 / 2], [dt ** 2 / 2, dt]])
+
+
+register_predictor("linear", LinearPredictor)
+register_predictor("kalman", KalmanPredictor)
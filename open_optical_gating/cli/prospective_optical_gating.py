@@ -6,56 +6,102 @@ import numpy as np
 
 # Module imports
 from loguru import logger
-import j_py_sad_correlation as jps
 
 # Local imports
 from . import parameters as parameters
-
-try:
-    _ = jps.windows_fallback
-    logger.warning("Using fallback code for temporary Windows support (slower - not suitable for realtime operation")
-except:
-    # Standard code
-    pass
+from . import sad_backends
 
 # TODO: JT writes: numExtraRefFrames should really be a global constant, not a parameter in settings.
 # Really the only reason that parameter exists at all in the C code is to self-document all the +-2 arithmetic that would otherwise appear.
 # In the C code it is declared as a const int.
 
 
-def update_drift(frame0, bestMatch0, settings):
-    """ Updates the 'settings' dictionary to reflect our latest estimate of the sample drift.
-        We do this by trying variations on the relative shift between frame0 and the best-matching frame in the reference sequence.
+# Relative shifts (in x and y) that we try when updating our drift estimate
+candidateDriftShifts = [[0, 0], [1, 0], [-1, 0], [0, 1], [0, -1]]
+
+
+def drift_search_rect(shape, drift, roi=None):
+    """ Identify the region within a reference frame that we will use when evaluating candidate drifts.
+        The logic here basically follows that in phase_matching, but allows for extra slop space
+        since we will be evaluating various different candidate drifts
         
         Parameters:
-            frame0      array-like      2D frame pixel data for our most recently-received frame
-            bestMatch0  array-like      2D frame pixel data for the best match within our reference sequence
-            settings    dict            Parameters controlling the sync algorithms
+            shape       tuple           Shape of the 2D frames
+            drift       list            Current [dx, dy] drift estimate
+            roi         list            Optional X1,X2,Y1,Y2 region of interest to restrict ourselves to
         Returns:
-            updated settings dictionary
+            X1,X2,Y1,Y2 rect within the reference frame
         """
-    # frame0 and bestMatch0 must be numpy arrays of the same size
-    assert frame0.shape == bestMatch0.shape
-
-    # Start with the existing drift parameters in the settings dictionary
-    dx, dy = settings["drift"]
-
-    # Identify region within bestMatch that we will use for comparison.
-    # The logic here basically follows that in phase_matching, but allows for extra slop space
-    # since we will be evaluating various different candidate drifts
-    rect = [
+    if roi is not None:
+        return offset_rect(
+            drift_search_rect((roi[1] - roi[0], roi[3] - roi[2]), drift), roi
+        )
+    dx, dy = drift
+    return [
         abs(dx) + 1,
-        frame0.shape[0] - abs(dx) - 1,
+        shape[0] - abs(dx) - 1,
         abs(dy) + 1,
-        frame0.shape[1] - abs(dy) - 1,
+        shape[1] - abs(dy) - 1,
     ]  # X1,X2,Y1,Y2
-    bestMatch = bestMatch0[rect[0] : rect[1], rect[2] : rect[3]]
 
-    candidateShifts = [[0, 0], [1, 0], [-1, 0], [0, 1], [0, -1]]
 
-    # Build up a list of frames, each representing a window into frame0 with slightly different drift offsets
+def offset_rect(rect, roi):
+    """Convert an X1,X2,Y1,Y2 rect relative to the corner of 'roi' into absolute coordinates."""
+    return [rect[0] + roi[0], rect[1] + roi[0], rect[2] + roi[2], rect[3] + roi[2]]
+
+
+def scaled_roi(roi, level):
+    """Returns 'roi' scaled to match a frame downsampled 'level' times (see downsample), or None if roi is None."""
+    if roi is None:
+        return None
+    return [r // (2 ** level) for r in roi]
+
+
+def determine_roi(reference_frames, settings):
+    """ Identify a region of interest that contains the moving heart, so that we can ignore the
+        (static) remainder of each frame when phase matching.
+        We compute the temporal variance of each pixel across the reference sequence (excluding padding frames),
+        and take the bounding box of all pixels whose variance exceeds settings["roi_variance_fraction"] times the
+        (near-)maximum variance, expanded by settings["roi_margin"] pixels on each side.
+        
+        Parameters:
+            reference_frames    array-like  3D (t by x by y) frame pixel data for our reference period
+            settings            dict        Parameters controlling the sync algorithms
+        Returns:
+            X1,X2,Y1,Y2 list, or None if no sensible ROI was found (in which case the whole frame should be used)
+        """
+    numExtra = settings["numExtraRefFrames"]
+    frames = np.asarray(reference_frames)[numExtra : len(reference_frames) - numExtra]
+    variance = np.var(frames.astype(np.float32), axis=0)
+    # Use a high percentile rather than the maximum, so that a few noisy pixels don't dominate
+    threshold = settings["roi_variance_fraction"] * np.percentile(variance, 99.5)
+    xs, ys = np.nonzero(variance > threshold)
+    if threshold <= 0 or xs.size == 0:
+        logger.warning("Unable to identify a region of interest; using whole frame")
+        return None
+
+    margin = settings["roi_margin"]
+    roi = [
+        max(int(xs.min()) - margin, 0),
+        min(int(xs.max()) + 1 + margin, variance.shape[0]),
+        max(int(ys.min()) - margin, 0),
+        min(int(ys.max()) + 1 + margin, variance.shape[1]),
+    ]
+    logger.info(
+        "Region of interest {0} covers {1:.1f}% of frame",
+        roi,
+        100.0 * (roi[1] - roi[0]) * (roi[3] - roi[2]) / variance.size,
+    )
+    return roi
+
+
+def candidate_drift_windows(frame0, rect, drift):
+    """ Build up a list of frames, each representing a window into frame0 with slightly different drift offsets
+        (one for each entry in candidateDriftShifts), for comparison against 'rect' within a reference frame.
+        """
+    dx, dy = drift
     frames = []
-    for shft in candidateShifts:
+    for shft in candidateDriftShifts:
         dxp = dx + shft[0]
         dyp = dy + shft[1]
 
@@ -67,13 +113,41 @@ def update_drift(frame0, bestMatch0, settings):
         rectF[3] -= dyp
 
         frames.append(frame0[rectF[0] : rectF[1], rectF[2] : rectF[3]])
+    return frames
+
+
+def update_drift(frame0, bestMatch0, settings):
+    """ Updates the 'settings' dictionary to reflect our latest estimate of the sample drift.
+        We do this by trying variations on the relative shift between frame0 and the best-matching frame in the reference sequence.
+        
+        Parameters:
+            frame0      array-like      2D frame pixel data for our most recently-received frame
+            bestMatch0  array-like      2D frame pixel data for the best match within our reference sequence
+            settings    dict            Parameters controlling the sync algorithms
+        Returns:
+            updated settings dictionary
+        """
+    # frame0 and bestMatch0 must be numpy arrays of the same size
+    assert frame0.shape == bestMatch0.shape
+
+    # Start with the existing drift parameters in the settings dictionary
+    dx, dy = settings["drift"]
+
+    # Identify region within bestMatch that we will use for comparison.
+    rect = drift_search_rect(frame0.shape, settings["drift"], settings["roi"])
+    bestMatch = bestMatch0[rect[0] : rect[1], rect[2] : rect[3]]
+
+    # Build up a list of frames, each representing a window into frame0 with slightly different drift offsets
+    frames = candidate_drift_windows(frame0, rect, settings["drift"])
 
     # Compare all these candidate shifted images against the matching reference frame, and find the best-matching shift
-    sad = jps.sad_with_references(bestMatch, frames)
+    sad = sad_backends.get_backend(settings["sad_backend"]).sad_with_references(
+        bestMatch, frames
+    )
     best = np.argmin(sad)
 
-    settings["drift"][0] = dx + candidateShifts[best][0]
-    settings["drift"][1] = dy + candidateShifts[best][1]
+    settings["drift"][0] = dx + candidateDriftShifts[best][0]
+    settings["drift"][1] = dy + candidateDriftShifts[best][1]
 
     return settings
 
@@ -132,33 +206,31 @@ def v_fitting(y_1, y_2, y_3):
     return x, y
 
 
-def phase_matching(frame, reference_frames, settings=None):
-    """Phase match a new frame based on a reference period.
+def drift_crop_rects(frame_shape, reference_shape, drift, roi=None):
+    """ Identify crop rects for a frame and the reference frames, representing the area
+        intersection between them once the drift has been accounted for.
         
         Parameters:
-            frame               array-like      2D frame pixel data for our most recently-received frame
-            reference_frames    array-like      3D (t by x by y) frame pixel data for our reference period
-            settings            dict            Parameters controlling the sync algorithms
+            frame_shape         tuple   Shape of the 2D frame
+            reference_shape     tuple   Shape of each 2D reference frame
+            drift               list    Current [dx, dy] drift estimate
+            roi                 list    Optional X1,X2,Y1,Y2 region of interest to restrict ourselves to
         Returns:
-            phase               float           phase matching results
-            SADs                ndarray         1D sum of absolute differences between frame and each reference_frames[t,...]
-            settings            dict            updated parameters controlling the sync algorithms
-    """
-    if settings == None:
-        logger.warning("No settings provided. Using sensible defaults.")
-        settings = parameters.initialise()
-
-    dx, dy = settings["drift"]
+            rectF               list    X1,X2,Y1,Y2 crop rect for the frame
+            rect                list    X1,X2,Y1,Y2 crop rect for the reference frames
+        """
+    if roi is not None:
+        roiShape = (roi[1] - roi[0], roi[3] - roi[2])
+        rectF, rect = drift_crop_rects(roiShape, roiShape, drift)
+        return offset_rect(rectF, roi), offset_rect(rect, roi)
 
-    # Apply drift correction, identifying a crop rect for the frame and/or reference frames,
-    # representing the area intersection between them once drift is accounted for.
-    logger.info("Applying drift correction of ({0},{1})", dx, dy)
-    rectF = [0, frame.shape[0], 0, frame.shape[1]]  # X1,X2,Y1,Y2
+    dx, dy = drift
+    rectF = [0, frame_shape[0], 0, frame_shape[1]]  # X1,X2,Y1,Y2
     rect = [
         0,
-        reference_frames[0].shape[0],
+        reference_shape[0],
         0,
-        reference_frames[0].shape[1],
+        reference_shape[1],
     ]  # X1,X2,Y1,Y2
 
     if dx <= 0:
@@ -173,11 +245,277 @@ def phase_matching(frame, reference_frames, settings=None):
     else:
         rectF[3] = rectF[3] - dy
         rect[2] = +dy
+    return rectF, rect
+
+
+def downsample(pixels, levels=1):
+    """ Downsample a 2D frame (or a 3D stack of frames) by averaging over 2x2 pixel blocks, 'levels' times.
+        Integer pixel types are preserved (the average is rounded down).
+        """
+    pixels = np.asarray(pixels)
+    for _ in range(levels):
+        h = (pixels.shape[-2] // 2) * 2
+        w = (pixels.shape[-1] // 2) * 2
+        if pixels.dtype.kind in ("i", "u"):
+            p = pixels[..., :h, :w].astype(np.int64)
+        else:
+            p = pixels[..., :h, :w].astype(np.float64)
+        blockSum = (
+            p[..., 0::2, 0::2] + p[..., 1::2, 0::2] + p[..., 0::2, 1::2] + p[..., 1::2, 1::2]
+        )
+        if pixels.dtype.kind in ("i", "u"):
+            pixels = (blockSum // 4).astype(pixels.dtype)
+        else:
+            pixels = (blockSum / 4).astype(pixels.dtype)
+    return pixels
+
+
+def wrapped_window(centre, half_width, num_refs, settings):
+    """ Indices of the reference frames within 'half_width' of reference frame 'centre'.
+        Because the padding frames at each end of the reference sequence repeat phases from the other end,
+        we also include the equivalent window one period earlier and later (where those exist),
+        so that we do not miss a better match within the "main" frames.
+        
+        Returns:
+            sorted 1D array of indices into the (padded) reference sequence
+        """
+    period = int(round(settings["reference_period"]))
+    windows = []
+    for c in (centre - period, centre, centre + period):
+        lo = max(c - half_width, 0)
+        hi = min(c + half_width + 1, num_refs)
+        if lo < hi:
+            windows.append(np.arange(lo, hi))
+    return np.unique(np.concatenate(windows))
+
+
+def pyramid_sads(frame, frame_cropped, reference_frames_cropped, reference_cache, settings):
+    """ Coarse-to-fine alternative to comparing 'frame' against every reference frame at full resolution.
+        We compare against all reference frames at the coarsest level of the reference pyramid
+        (see ReferenceStackCache.reset), and then at each finer level we only compare against the
+        reference frames within settings["pyramid_shortlist_width"] of the best match at the level above
+        (allowing for wrap-around, see wrapped_window).
+        At full resolution we make sure that both neighbours of the best match (within the "main" frames)
+        have been evaluated, since subframe_fitting needs them.
+        
+        Parameters:
+            frame                       array-like  2D frame pixel data for our most recently-received frame
+            frame_cropped               array-like  'frame' cropped for the current drift
+            reference_frames_cropped    ndarray     3D reference frames, cropped to match frame_cropped
+            reference_cache             ReferenceStackCache  Cache holding the reference pyramid
+            settings                    dict        Parameters controlling the sync algorithms
+        Returns:
+            1D float array of SADs, with np.inf for reference frames that were not evaluated at full resolution
+        """
+    backend = sad_backends.get_backend(settings["sad_backend"])
+    levels = settings["pyramid_levels"]
+    halfWidth = settings["pyramid_shortlist_width"]
+    numRefs = reference_frames_cropped.shape[0]
+    numExtra = settings["numExtraRefFrames"]
+
+    # Coarse-to-fine search through the downsampled levels
+    candidates = np.arange(numRefs)
+    for level in range(levels, 0, -1):
+        frameCoarse = downsample(frame, level)
+        levelCache = reference_cache.pyramid[level - 1]
+        driftCoarse = [int(round(d / 2 ** level)) for d in settings["drift"]]
+        rectF, rect = drift_crop_rects(
+            frameCoarse.shape,
+            levelCache.reference_frames[0].shape,
+            driftCoarse,
+            scaled_roi(settings["roi"], level),
+        )
+        coarseSADs = backend.sad_with_references(
+            frameCoarse[rectF[0] : rectF[1], rectF[2] : rectF[3]],
+            levelCache.cropped(rect)[candidates],
+        )
+        best = candidates[np.argmin(coarseSADs)]
+        candidates = wrapped_window(best, halfWidth, numRefs, settings)
+    logger.debug("Pyramid shortlist: reference frames {0}", candidates)
+
+    # Refine at full resolution, extending the shortlist if the best match is at its edge
+    SADs = np.full(numRefs, np.inf)
+    while candidates.size > 0:
+        SADs[candidates] = backend.sad_with_references(
+            frame_cropped, reference_frames_cropped[candidates]
+        )
+        bestScorePos = numExtra + np.argmin(SADs[numExtra:-numExtra])
+        neighbours = np.array([bestScorePos - 1, bestScorePos + 1])
+        candidates = neighbours[np.isinf(SADs[neighbours])]
+    return SADs
+
+
+def predict_reference_index(last_index, last_timestamp, timestamp, settings, radsPerSec=None):
+    """ Predict which (padded) reference frame a new frame should match best, based on the best match for the
+        previous frame and how fast we expect the phase to be advancing. We use 'radsPerSec' (e.g. the gradient
+        of the most recent fit made by our predictor), if we have it, or otherwise the heart rate implied by the
+        reference sequence itself.
+        
+        Parameters:
+            last_index      int         Index of the best-matching reference frame for the previous frame
+            last_timestamp  float       Timestamp of the previous frame (seconds)
+            timestamp       float       Timestamp of the new frame (seconds)
+            settings        dict        Parameters controlling the sync algorithms
+            radsPerSec      float       Current estimate of the rate of change of phase (or None if unknown)
+        Returns:
+            int index into the padded reference sequence
+        """
+    period = settings["reference_period"]
+    numExtra = settings["numExtraRefFrames"]
+    if radsPerSec is None or radsPerSec <= 0:
+        radsPerSec = 2 * np.pi * settings["framerate"] / period
+    index = last_index + radsPerSec * (timestamp - last_timestamp) * period / (2 * np.pi)
+    # Wrap into the "main" (unpadded) frames
+    index = numExtra + ((index - numExtra) % period)
+    return min(int(round(index)), settings["referenceFrameCount"] - 1)
+
+
+def windowed_sads(frame_cropped, reference_frames_cropped, predicted_index, settings):
+    """ Compare 'frame_cropped' only against the reference frames within settings["phase_search_window"]
+        of 'predicted_index' (allowing for wrap-around, see wrapped_window).
+        
+        Parameters:
+            frame_cropped               array-like  2D frame pixel data, cropped for the current drift
+            reference_frames_cropped    array-like  3D reference frames, cropped to match frame_cropped
+            predicted_index             int         Index of the reference frame we expect to match best
+            settings                    dict        Parameters controlling the sync algorithms
+        Returns:
+            1D float array of SADs, with np.inf for reference frames that were not evaluated,
+            or None if the caller should fall back to a full search. That is the case when the best match
+            lies at the edge of the window (so the true minimum may lie outside it), or if its SAD exceeds
+            settings["phase_search_sad_factor"] times the best SAD for the previous frame.
+        """
+    numRefs = len(reference_frames_cropped)
+    numExtra = settings["numExtraRefFrames"]
+    candidates = wrapped_window(
+        predicted_index, settings["phase_search_window"], numRefs, settings
+    )
+    if isinstance(reference_frames_cropped, np.ndarray):
+        candidateFrames = reference_frames_cropped[candidates]
+    else:
+        candidateFrames = [reference_frames_cropped[i] for i in candidates]
+
+    SADs = np.full(numRefs, np.inf)
+    SADs[candidates] = sad_backends.get_backend(
+        settings["sad_backend"]
+    ).sad_with_references(frame_cropped, candidateFrames)
+
+    bestScorePos = numExtra + np.argmin(SADs[numExtra:-numExtra])
+    if np.isinf(SADs[bestScorePos - 1]) or np.isinf(SADs[bestScorePos + 1]):
+        logger.debug(
+            "Best match {0} is at the edge of the search window around {1}; falling back to full search",
+            bestScorePos,
+            predicted_index,
+        )
+        return None
+    if (
+        settings["lastSADMin"] > 0
+        and SADs[bestScorePos]
+        > settings["phase_search_sad_factor"] * settings["lastSADMin"]
+    ):
+        logger.debug(
+            "Best match in search window has SAD {0} (previous best {1}); falling back to full search",
+            SADs[bestScorePos],
+            settings["lastSADMin"],
+        )
+        return None
+    return SADs
+
+
+def early_abandon_sads(frame_cropped, reference_frames_cropped, predicted_index, settings):
+    """ Compare 'frame_cropped' against all the reference frames, but abandon each SAD calculation
+        as soon as it is clearly worse than the best (complete) match so far among the "main" reference frames.
+        We visit the reference frames in order of phase distance from 'predicted_index', so that
+        the bound tightens early. The two neighbours of the best match that subframe_fitting needs
+        are recomputed in full if they were abandoned, so the phase result is unchanged.
+        
+        Parameters:
+            frame_cropped               array-like  2D frame pixel data, cropped for the current drift
+            reference_frames_cropped    array-like  3D reference frames, cropped to match frame_cropped
+            predicted_index             int         Index of the reference frame we expect to match best (or None)
+            settings                    dict        Parameters controlling the sync algorithms
+        Returns:
+            1D int64 array of SADs (lower bounds only, for reference frames that were abandoned)
+        """
+    backend = sad_backends.get_backend(settings["sad_backend"])
+    numRefs = len(reference_frames_cropped)
+    numExtra = settings["numExtraRefFrames"]
+    isMain = np.zeros(numRefs, dtype=bool)
+    isMain[numExtra:-numExtra] = True
+
+    # Visit frames in order of phase distance from the prediction (main frames before equivalent padding frames)
+    if predicted_index is None:
+        predicted_index = numRefs // 2
+    period = settings["reference_period"]
+    offsets = (np.arange(numRefs) - predicted_index) % period
+    distance = np.minimum(offsets, period - offsets)
+    order = np.lexsort((~isMain, distance))
+
+    SADs, complete = backend.sad_early_abandon(
+        frame_cropped,
+        reference_frames_cropped,
+        order,
+        isMain,
+        settings["sad_abandon_margin"],
+        settings["sad_block_rows"],
+    )
+    logger.trace("Abandoned {0} of {1} SADs early", numRefs - np.sum(complete), numRefs)
+
+    # subframe_fitting needs the exact SADs either side of the best match
+    bestScorePos = numExtra + np.argmin(SADs[numExtra:-numExtra])
+    neighbours = np.array([bestScorePos - 1, bestScorePos + 1])
+    neighbours = neighbours[~complete[neighbours]]
+    if neighbours.size > 0:
+        SADs[neighbours] = backend.sad_with_references(
+            frame_cropped, sad_backends.as_stack(reference_frames_cropped)[neighbours]
+        )
+    return SADs
+
+
+def phase_matching(
+    frame, reference_frames, settings=None, reference_cache=None, predicted_index=None
+):
+    """Phase match a new frame based on a reference period.
+        
+        Parameters:
+            frame               array-like      2D frame pixel data for our most recently-received frame
+            reference_frames    array-like      3D (t by x by y) frame pixel data for our reference period
+            settings            dict            Parameters controlling the sync algorithms
+            reference_cache     ReferenceStackCache  Optional cache of cropped copies of reference_frames
+                                                     (must have been reset with these same reference_frames)
+            predicted_index     int             Optional index into reference_frames where we expect the best match
+                                                 to be (e.g. the best match for the previous frame)
+        Returns:
+            phase               float           phase matching results
+            SADs                ndarray         1D sum of absolute differences between frame and each reference_frames[t,...]
+            settings            dict            updated parameters controlling the sync algorithms
+    """
+    if settings == None:
+        logger.warning("No settings provided. Using sensible defaults.")
+        settings = parameters.initialise()
+
+    if settings["fused_drift_search"]:
+        return phase_matching_fused(
+            frame, reference_frames, settings, reference_cache, predicted_index
+        )
+
+    dx, dy = settings["drift"]
+
+    # Apply drift correction, identifying a crop rect for the frame and/or reference frames,
+    # representing the area intersection between them once drift is accounted for.
+    logger.info("Applying drift correction of ({0},{1})", dx, dy)
+    rectF, rect = drift_crop_rects(
+        frame.shape, reference_frames[0].shape, settings["drift"], settings["roi"]
+    )
 
     frame_cropped = frame[rectF[0] : rectF[1], rectF[2] : rectF[3]]
-    reference_frames_cropped = [
-        f[rect[0] : rect[1], rect[2] : rect[3]] for f in reference_frames
-    ]
+    if reference_cache is not None:
+        # Contiguous 3D stack, reused for as long as the drift stays the same
+        reference_frames_cropped = reference_cache.cropped(rect)
+    else:
+        reference_frames_cropped = [
+            f[rect[0] : rect[1], rect[2] : rect[3]] for f in reference_frames
+        ]
 
     # Calculate SADs
     logger.trace(
@@ -186,63 +524,320 @@ def phase_matching(frame, reference_frames, settings=None):
     logger.trace(
         "Reference frame shapes: {0} and {1}", frame.shape, reference_frames[0].shape
     )
-    SADs = jps.sad_with_references(frame_cropped, reference_frames_cropped)
+    SADs = None
+    if settings["phase_search_window"] > 0 and predicted_index is not None:
+        # Try only comparing against the reference frames near where we expect the match to be
+        SADs = windowed_sads(
+            frame_cropped, reference_frames_cropped, predicted_index, settings
+        )
+    if SADs is not None:
+        pass
+    elif (
+        settings["pyramid_levels"] > 0
+        and reference_cache is not None
+        and len(reference_cache.pyramid) >= settings["pyramid_levels"]
+    ):
+        SADs = pyramid_sads(
+            frame, frame_cropped, reference_frames_cropped, reference_cache, settings
+        )
+    elif (
+        settings["sad_early_abandon"]
+        and sad_backends.get_backend(settings["sad_backend"]).sad_early_abandon
+        is not None
+    ):
+        SADs = early_abandon_sads(
+            frame_cropped, reference_frames_cropped, predicted_index, settings
+        )
+    else:
+        SADs = sad_backends.get_backend(settings["sad_backend"]).sad_with_references(
+            frame_cropped, reference_frames_cropped
+        )
+    logger.trace(SADs)
+    settings["lastSADMin"] = np.min(SADs)
+
+    # Identify best match between 'frame' and the reference frame sequence
+    phase = subframe_fitting(SADs, settings)
+    logger.debug("Found frame phase to be {0}", phase)
+
+    # Update current drift estimate in the settings dictionary
+    # (the drift changes slowly, so to save time we can choose to only do this every few frames)
+    settings["framesSinceDriftUpdate"] += 1
+    if settings["framesSinceDriftUpdate"] >= settings["drift_update_interval"]:
+        settings["framesSinceDriftUpdate"] = 0
+        settings = update_drift(frame, reference_frames[np.argmin(SADs)], settings)
+        logger.info(
+            "Drift correction updated to ({0},{1})",
+            settings["drift"][0],
+            settings["drift"][1],
+        )
+
+    # Note: still includes padding frames (on purpose)   [TODO: JT writes: what does!? I presume the SAD array. Can the comment explain *why* this is done on purpose?]
+    return (phase, SADs, settings)
+
+
+def phase_matching_fused(
+    frame, reference_frames, settings, reference_cache=None, predicted_index=None
+):
+    """ Alternative to phase_matching() that does the phase matching *and* the drift update (see update_drift)
+        in a single batched SAD calculation, rather than two separate passes.
+        The unshifted frame is compared against every reference frame (to determine the phase),
+        and the candidate drift shifts are compared against the few reference frames around
+        'predicted_index' (or all reference frames, if no prediction is available).
+        If the best match turns out not to be among those few frames, we fall back to a separate update_drift() call.
+        
+        Note that all SADs are evaluated within the (slightly smaller) region used by update_drift,
+        so they will differ slightly from the values that phase_matching() would compute.
+        As in phase_matching(), the drift is only updated every settings["drift_update_interval"] frames;
+        on other frames we only compare the unshifted frame against the reference frames.
+        
+        Parameters and return values: as for phase_matching()
+        """
+    logger.info("Applying fused drift correction of ({0},{1})", *settings["drift"])
+    settings["framesSinceDriftUpdate"] += 1
+    updateDrift = settings["framesSinceDriftUpdate"] >= settings["drift_update_interval"]
+    if updateDrift:
+        settings["framesSinceDriftUpdate"] = 0
+    rect = drift_search_rect(frame.shape, settings["drift"], settings["roi"])
+    candidateFrames = np.array(candidate_drift_windows(frame, rect, settings["drift"]))
+    if not updateDrift:
+        # Only the unshifted candidate (see candidateDriftShifts) is needed
+        candidateFrames = candidateFrames[:1]
+    if reference_cache is not None:
+        reference_frames_cropped = reference_cache.cropped(rect)
+    else:
+        reference_frames_cropped = np.array(
+            [f[rect[0] : rect[1], rect[2] : rect[3]] for f in reference_frames]
+        )
+    numRefs = reference_frames_cropped.shape[0]
+
+    # Pick the few reference frames that we will compare the shifted candidates against
+    if not updateDrift:
+        nearbyRefs = np.arange(0)
+    elif predicted_index is None:
+        nearbyRefs = np.arange(numRefs)
+    else:
+        nearbyRefs = np.arange(
+            max(int(predicted_index) - settings["fused_drift_neighbours"], 0),
+            min(int(predicted_index) + settings["fused_drift_neighbours"] + 1, numRefs),
+        )
+
+    # Pairs of (candidate frame, reference frame) to evaluate: the unshifted candidate (index 0)
+    # against all reference frames, then every other candidate against the nearby reference frames
+    numShifts = len(candidateFrames)
+    frameIndices = np.concatenate(
+        (np.zeros(numRefs, dtype=np.int64), np.repeat(np.arange(1, numShifts), nearbyRefs.size))
+    )
+    referenceIndices = np.concatenate(
+        (np.arange(numRefs), np.tile(nearbyRefs, numShifts - 1))
+    )
+    pairSADs = sad_backends.get_backend(settings["sad_backend"]).sad_pairs(
+        candidateFrames, reference_frames_cropped, frameIndices, referenceIndices
+    )
+    SADs = pairSADs[:numRefs]
     logger.trace(SADs)
+    settings["lastSADMin"] = np.min(SADs)
 
     # Identify best match between 'frame' and the reference frame sequence
     phase = subframe_fitting(SADs, settings)
     logger.debug("Found frame phase to be {0}", phase)
 
     # Update current drift estimate in the settings dictionary
-    settings = update_drift(frame, reference_frames[np.argmin(SADs)], settings)
+    bestMatch = np.argmin(SADs)
+    if not updateDrift:
+        return (phase, SADs, settings)
+    if bestMatch in nearbyRefs:
+        shiftedSADs = pairSADs[numRefs:].reshape(numShifts - 1, nearbyRefs.size)
+        bestMatchSADs = np.concatenate(
+            ([SADs[bestMatch]], shiftedSADs[:, np.nonzero(nearbyRefs == bestMatch)[0][0]])
+        )
+        best = np.argmin(bestMatchSADs)
+        settings["drift"][0] += candidateDriftShifts[best][0]
+        settings["drift"][1] += candidateDriftShifts[best][1]
+    else:
+        logger.debug(
+            "Best match {0} was not near predicted index {1}; updating drift separately",
+            bestMatch,
+            predicted_index,
+        )
+        settings = update_drift(frame, reference_frames[bestMatch], settings)
     logger.info(
         "Drift correction updated to ({0},{1})",
         settings["drift"][0],
         settings["drift"][1],
     )
 
-    # Note: still includes padding frames (on purpose)   [TODO: JT writes: what does!? I presume the SAD array. Can the comment explain *why* this is done on purpose?]
     return (phase, SADs, settings)
 
 
+def unwrap_phase_delta(delta_phase, dt, settings, radsPerSec=None):
+    """ Work out how far the phase has advanced since the previous frame, given the difference between
+        their (wrapped) phases. For consecutive frames we assume the phase has not gone backwards by more than pi.
+        If the time since the previous frame is more than settings["frame_gap_factor"] frame intervals,
+        we assume that frames have been missed (e.g. dropped under heavy load), in which case the phase may have
+        advanced by more than one whole cycle. We then use the current estimate of the phase velocity
+        to decide how many multiples of 2pi to add.
+        
+        Parameters:
+            delta_phase     float       Difference between the wrapped phases of this frame and the previous one
+            dt              float       Time since the previous frame (in seconds)
+            settings        dict        Parameters controlling the sync algorithms
+            radsPerSec      float       Current estimate of the rate of change of phase (or None if unknown,
+                                         in which case we use the heart rate implied by the reference sequence)
+        Returns:
+            delta_phase     float       Unwrapped phase difference
+            frames_missed   int         Estimated number of frames missed between the two frames (0 if none)
+        """
+    frameInterval = 1.0 / settings["framerate"]
+    if dt <= settings["frame_gap_factor"] * frameInterval:
+        while delta_phase < -np.pi:
+            delta_phase += 2 * np.pi
+        return delta_phase, 0
+
+    if radsPerSec is None or radsPerSec <= 0:
+        radsPerSec = 2 * np.pi * settings["framerate"] / settings["reference_period"]
+    expectedDelta = radsPerSec * dt
+    delta_phase += 2 * np.pi * np.round((expectedDelta - delta_phase) / (2 * np.pi))
+    framesMissed = max(int(round(dt / frameInterval)) - 1, 1)
+    logger.info(
+        "{0} frames missed; unwrapped phase difference {1} (expected {2})",
+        framesMissed,
+        delta_phase,
+        expectedDelta,
+    )
+    return delta_phase, framesMissed
+
+
+def linear_fit(frame_history, numFrames, settings=None):
+    """ Least-squares linear fit of phase against time, for the most recent 'numFrames' frames in 'frame_history'.
+        Frames that follow missed frames (see unwrap_phase_delta) are given a weight of
+        settings["missed_frame_weight"] relative to the others, since their unwrapped phase is less certain.
+        
+        Parameters:
+            frame_history   FrameHistory or array-like  See predict_trigger_wait
+            numFrames       int                         Number of frames to fit to
+            settings        dict                        Parameters controlling the sync algorithms
+        Returns:
+            radsPerSec      float       Gradient of the fit
+            thisFramePhase  float       Fitted phase at the timestamp of the most recent frame
+        """
+    if hasattr(frame_history, "linear_fit"):
+        if settings is not None:
+            framesMissed = frame_history.window("frames_missed", int(numFrames))
+            if np.any(framesMissed > 0):
+                # Weighted fit (the running sums used below are unweighted).
+                # Timestamps may be wall-clock times, so we measure them from the most recent frame to avoid
+                # losing precision in the fit (the intercept is then the fitted phase of the most recent frame)
+                weights = np.where(framesMissed > 0, settings["missed_frame_weight"], 1.0)
+                pastPhases = frame_history.window(["timestamp", "unwrapped_phase"], int(numFrames))
+                radsPerSec, thisFramePhase = np.polyfit(
+                    pastPhases[:, 0] - pastPhases[-1, 0], pastPhases[:, 1], 1, w=np.sqrt(weights)
+                )
+                return radsPerSec, thisFramePhase
+        # Constant-time fit using the running sums maintained by the history object
+        return frame_history.linear_fit(numFrames)
+    pastPhases = frame_history[-int(numFrames) :, :]
+    logger.trace(pastPhases[:, 0])
+    logger.trace(pastPhases[:, 1])
+    radsPerSec, alpha = np.polyfit(pastPhases[:, 0], pastPhases[:, 1], 1)
+    return radsPerSec, alpha + pastPhases[-1, 0] * radsPerSec
+
+
 def predict_trigger_wait(frame_history, settings, fitBackToBarrier=True):
     """ Predict how long we need to wait until the heart is at the target phase we are triggering to.
         
         Parameters:
-            frame_history           array-like  Nx3 array of [timestamp in seconds, phase, argmin(SAD)]
+            frame_history           FrameHistory  History of frames analysed in sync mode
+                                     or array-like Nx3 array of [timestamp in seconds, phase, argmin(SAD)]
                                                  Phase (i.e. frame_history[:,1]) should be cumulative (i.e. phase-UNwrapped) phase in radians
             settings                dict        Parameters controlling the sync algorithms
                                                  targetSyncPhase is expected to be in [0,2pi]
             fitBackToBarrier        bool        Should we use the "barrier frame" logic? (see determine_barrier_frames)
         Returns:
-            Time delay (or phase delay) before trigger would need to be sent in seconds.
+            time_to_wait_seconds    float   Time delay (or phase delay) before trigger would need to be sent in seconds.
+            radsPerSec              float   Gradient of the fit used for the prediction (None if there were too few frames)
         """
 
-    if frame_history.shape[0] < settings["minFramesForFit"]:
+    numFrames = len(frame_history)
+    if numFrames < settings["minFramesForFit"]:
         logger.debug("Fit failed due to too few frames...")
-        return -1
+        return -1, None
+    if hasattr(frame_history, "last"):
+        thisFrameTime = frame_history.last("timestamp")
+        thisFrameSAD = frame_history.last("sad_min")
+    else:
+        thisFrameTime = frame_history[-1, 0]
+        thisFrameSAD = frame_history[-1, 2]
 
     # Deal with the barrier frame logic (if fitBackToBarrier is True):
     # Rather than fitting to a number of frames that depends on how far forward we are predicting, fit to a number that depends on where in the cycle we are. We try not to fit to the refractory period unless there really is no other data. The intention of this is to fit to as much data as possible but only in the parts of the cycle where the phase progression is highly predictable and linear with time.
     if fitBackToBarrier:
         allowedToExtendNumberOfFittedPoints = False
         framesForFit = min(
-            settings["frameToUseArray"][int(frame_history[-1, 2])],
-            frame_history.shape[0],
+            settings["frameToUseArray"][int(thisFrameSAD)], numFrames,
         )
         logger.debug("Consider {0} past frames for prediction;", framesForFit)
     else:
         framesForFit = settings["minFramesForFit"]
         allowedToExtendNumberOfFittedPoints = True
-    pastPhases = frame_history[-int(framesForFit):, :]
 
+    time_to_wait_seconds, radsPerSec = time_to_wait_for_fit(
+        frame_history, thisFrameTime, framesForFit, settings
+    )
+
+    # This logic catches cases where we are predicting a long way into the future using only a small number of datapoints.
+    # That is likely to be error-prone, so (unless using the "barrier frame" logic) we may increase
+    # the number of frames we use for prediction, doubling it until the prediction is no longer too long
+    # compared to the number of frames fitted (or we run out of frames).
+    frameInterval = 1.0 / settings["framerate"]
+    while allowedToExtendNumberOfFittedPoints and time_to_wait_seconds > (
+        settings["extrapolationFactor"] * framesForFit * frameInterval
+    ):
+        framesForFit *= 2
+        if framesForFit > numFrames or framesForFit > settings["maxFramesForFit"]:
+            break
+        logger.info("Increasing number of frames to use")
+        time_to_wait_seconds, radsPerSec = time_to_wait_for_fit(
+            frame_history, thisFrameTime, framesForFit, settings
+        )
+
+    # Return our prediction
+    return time_to_wait_seconds, radsPerSec
+
+
+def time_to_wait_for_fit(frame_history, thisFrameTime, framesForFit, settings):
+    """ Helper for predict_trigger_wait: fit to the most recent 'framesForFit' frames,
+        and work out how long until the fit reaches the target phase.
+        
+        Parameters:
+            frame_history   FrameHistory or array-like  See predict_trigger_wait
+            thisFrameTime   float       Timestamp of the most recent frame
+            framesForFit    int         Number of frames to fit to
+            settings        dict        Parameters controlling the sync algorithms
+        Returns:
+            time_to_wait_seconds    float   Time delay before trigger would need to be sent in seconds.
+            radsPerSec              float   Gradient of the fit
+        """
     # Perform a linear fit to the past phases. We will use this for our forward-prediction
-    radsPerSec, alpha = np.polyfit(pastPhases[:, 0], pastPhases[:, 1], 1)
+    # Use our linear fit to get a 'fitted' unwraped phase for the latest frame
+    # This should not rescue cases where, for some reason, the image-based
+    # phase matching is erroneous.
+    radsPerSec, thisFramePhase = linear_fit(frame_history, framesForFit, settings)
+    logger.info("Linear fit with phase {0} and gradient {1}", thisFramePhase, radsPerSec)
+    return time_to_target_phase(thisFramePhase, radsPerSec, thisFrameTime, settings), radsPerSec
 
-    logger.trace(pastPhases[:, 0])
-    logger.trace(pastPhases[:, 1])
 
-    logger.info("Linear fit with intersect {0} and gradient {1}", alpha, radsPerSec)
+def time_to_target_phase(thisFramePhase, radsPerSec, thisFrameTime, settings):
+    """ Work out how long we need to wait until the heart reaches settings["targetSyncPhase"],
+        given an estimate of the current (unwrapped) phase and how fast it is advancing.
+        
+        Parameters:
+            thisFramePhase  float       Estimated unwrapped phase at the time of the most recent frame
+            radsPerSec      float       Estimated rate of change of phase
+            thisFrameTime   float       Timestamp of the most recent frame
+            settings        dict        Parameters controlling the sync algorithms
+        Returns:
+            Time delay before trigger would need to be sent in seconds.
+        """
     if radsPerSec < 0:
         logger.warning(
             "Linear fit to unwrapped phases is negative! This is a problem for the trigger prediction."
@@ -252,10 +847,6 @@ def predict_trigger_wait(frame_history, settings, fitBackToBarrier=True):
             "Linear fit to unwrapped phases is zero! This will be a problem for prediction (divByZero)."
         )
 
-    # Use our linear fit to get a 'fitted' unwraped phase for the latest frame
-    # This should not rescue cases where, for some reason, the image-based
-    # phase matching is erroneous.
-    thisFramePhase = alpha + frame_history[-1, 0] * radsPerSec
     # Count how many total periods we have seen
     multiPhaseCounter = thisFramePhase // (2 * np.pi)
     # Determine how much of a cardiac cycle we have to wait till our target phase
@@ -271,9 +862,7 @@ def predict_trigger_wait(frame_history, settings, fitBackToBarrier=True):
     time_to_wait_seconds = max(time_to_wait_seconds, 0.0)
 
     logger.info(
-        "Current time: {0};\tTime to wait: {1};",
-        frame_history[-1, 0],
-        time_to_wait_seconds,
+        "Current time: {0};\tTime to wait: {1};", thisFrameTime, time_to_wait_seconds,
     )
     logger.debug(
         "Current phase: {0};\tPhase to wait: {1};", thisFramePhase, phaseToWait,
@@ -304,29 +893,6 @@ def predict_trigger_wait(frame_history, settings, fitBackToBarrier=True):
         )
         time_to_wait_seconds = 0.0
 
-    # This logic catches cases where we are predicting a long way into the future using only a small number of datapoints.
-    # That is likely to be error-prone, so (unless using the "barrier frame" logic) we may increase
-    # the number of frames we use for prediction.
-    frameInterval = 1.0 / settings["framerate"]
-    if allowedToExtendNumberOfFittedPoints and time_to_wait_seconds > (
-        settings["extrapolationFactor"] * settings["minFramesForFit"] * frameInterval
-    ):
-        # TODO: JT writes: this approach of editing settings[minFramesForFit] and then changing it back again feels really messy to me.
-        # We should hold off changing it for now, though, because I think we may want to refactor how settings is used
-        # Once that is complete, a better solution here may present itself naturally.
-        settings["minFramesForFit"] *= 2
-        if (
-            settings["minFramesForFit"] <= pastPhases.shape[0]
-            and settings["minFramesForFit"] <= settings["maxFramesForFit"]
-        ):
-            logger.info("Increasing number of frames to use")
-            #  Recurse, using a larger number of frames, to obtain an improved predicted time
-            time_to_wait_seconds = predict_trigger_wait(
-                frame_history, settings, fitBackToBarrier=False
-            )
-        settings["minFramesForFit"] = settings["minFramesForFit"] // 2
-
-    # Return our prediction
     return time_to_wait_seconds
 
 
@@ -379,7 +945,7 @@ def determine_barrier_frames(settings):
     return settings
 
 
-def pick_target_and_barrier_frames(reference_frames, settings):
+def pick_target_and_barrier_frames(reference_frames, settings, deltas=None):
     """Function to automatically identify a stable target phase and barrier frame.
         Looks through 'reference_frames' to identify a consistent point in the
         heart cycle (i.e. attempt to identify approximately the same absolute
@@ -404,20 +970,29 @@ def pick_target_and_barrier_frames(reference_frames, settings):
         Parameters:
             reference_frames    array-like  3D (t by x by y) frame pixel data for our reference period
             settings            dict        parameters controlling the sync algorithms
+            deltas              ndarray     Optional SADs between each (unpadded) reference frame and the next one,
+                                             if already known (e.g. from FrameRingBuffer.consecutive_sads)
         Returns:
             settings            dict        updated settings
     """
 
     # First compare each frame in our list with the previous one
     # Note that this code assumes "numExtraRefFrames">0 (which it certainly should be!)
-    deltas_without_padding = np.zeros(
-        (len(reference_frames) - 2 * settings["numExtraRefFrames"]), dtype=np.int64,
-    )
-    for i in np.arange(len(reference_frames) - 2 * settings["numExtraRefFrames"],):
-        deltas_without_padding[i] = jps.sad_correlation(
-            reference_frames[i + settings["numExtraRefFrames"]],
-            reference_frames[i + settings["numExtraRefFrames"] + 1],
+    if deltas is not None:
+        deltas_without_padding = np.asarray(deltas, dtype=np.int64)
+    else:
+        backend = sad_backends.get_backend(settings["sad_backend"])
+        if settings["roi"] is not None:
+            roi = settings["roi"]
+            reference_frames = [f[roi[0] : roi[1], roi[2] : roi[3]] for f in reference_frames]
+        deltas_without_padding = np.zeros(
+            (len(reference_frames) - 2 * settings["numExtraRefFrames"]), dtype=np.int64,
         )
+        for i in np.arange(len(reference_frames) - 2 * settings["numExtraRefFrames"],):
+            deltas_without_padding[i] = backend.sad_correlation(
+                reference_frames[i + settings["numExtraRefFrames"]],
+                reference_frames[i + settings["numExtraRefFrames"] + 1],
+            )
 
     min_pos_without_padding = np.argmin(deltas_without_padding)
     max_pos_without_padding = np.argmax(deltas_without_padding)
@@ -486,7 +1061,7 @@ def pick_target_and_barrier_frames(reference_frames, settings):
     return settings
 
 
-def decide_trigger(timestamp, timeToWaitInSeconds, settings):
+def decide_trigger(timestamp, timeToWaitInSeconds, settings, uncertainty_s=None):
     """ Potentially schedules a synchronization trigger for the fluorescence camera.
         We will do this if the trigger is due fairly soon in the future,
         and we are not confident we will have time to make an updated prediction
@@ -496,6 +1071,7 @@ def decide_trigger(timestamp, timeToWaitInSeconds, settings):
             timestamp               float   Time associated with current frame (seconds)
             timeToWaitInSeconds     float   Time delay before trigger would need to be sent.
             settings                dict    Parameters controlling the sync algorithms
+            uncertainty_s           float   Optional standard deviation of timeToWaitInSeconds (see predictors.py)
         Returns:
             timeToWaitInSeconds     float   Time delay before trigger would need to be sent.
                                              Note that this return value may be modified from its input value (see code below).
@@ -508,6 +1084,14 @@ def decide_trigger(timestamp, timeToWaitInSeconds, settings):
     # Its value should ideally depend on the actual observed variability in the time estimates
     # as successive frame data is received
     framerateFactor = 1.6  # in frames
+    if uncertainty_s is None:
+        safetyMargin = framerateFactor / settings["framerate"]
+    else:
+        # Our predictor has told us how uncertain its prediction is, so we use that instead:
+        # we need to wait one frame for an updated prediction, plus an allowance for the uncertainty.
+        safetyMargin = (1.0 / settings["framerate"]) + settings[
+            "trigger_uncertainty_factor"
+        ] * uncertainty_s
 
     logger.debug(
         "Time to wait: {0} s; with latency: {1} s;",
@@ -538,9 +1122,7 @@ def decide_trigger(timestamp, timeToWaitInSeconds, settings):
                 "Trigger already sent recently. Will not send another - extending the prediction to the next cycle."
             )
             timeToWaitInSeconds += settings["reference_period"] / settings["framerate"]
-    elif (timeToWaitInSeconds - (framerateFactor / settings["framerate"])) < settings[
-        "prediction_latency_s"
-    ]:
+    elif (timeToWaitInSeconds - safetyMargin) < settings["prediction_latency_s"]:
         # We don't expect to have time to wait for an updated prediction... so schuedule the trigger now!
         logger.success(
             "We don't expect to have time to wait for an updated prediction... so trigger scheduled now!"
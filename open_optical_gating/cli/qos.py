@@ -0,0 +1,138 @@
+"""Quality-of-service controller, trading phase-matching quality for speed when frame processing cannot keep up."""
+
+# Module imports
+from loguru import logger
+
+# Successive degradation levels. Each level lists the pog_settings overrides that apply at that level
+# (including those of the previous levels). A value given as a function is evaluated with the baseline
+# (full quality) value of that setting, so that we never make a setting *more* expensive than it was.
+LEVELS = (
+    # Level 0: full quality
+    {},
+    # Level 1: only update the drift estimate every other frame
+    {"drift_update_interval": lambda v: max(v, 2)},
+    # Level 2: also only search the reference frames near where we expect the match to be
+    {
+        "drift_update_interval": lambda v: max(v, 4),
+        "phase_search_window": lambda v: 3 if v == 0 else min(v, 3),
+    },
+    # Level 3: also find the approximate match using a downsampled copy of the reference sequence
+    {
+        "drift_update_interval": lambda v: max(v, 4),
+        "phase_search_window": lambda v: 3 if v == 0 else min(v, 3),
+        "pyramid_levels": lambda v: max(v, 1),
+    },
+    # Level 4: also skip non-essential bookkeeping (see QoSController.skip_bookkeeping)
+    {
+        "drift_update_interval": lambda v: max(v, 8),
+        "phase_search_window": lambda v: 3 if v == 0 else min(v, 3),
+        "pyramid_levels": lambda v: max(v, 1),
+    },
+)
+
+# Bookkeeping is skipped from this level upwards
+SKIP_BOOKKEEPING_LEVEL = 4
+
+# Number of pyramid levels that the reference cache must provide for the levels above
+PYRAMID_LEVELS = 1
+
+
+class QoSController:
+    """ Watches how long each frame takes to process, compared with the interval between frames,
+        and steps through LEVELS to shed load when processing cannot keep up (and back again when it can).
+
+        The load is the processing time divided by the frame interval, smoothed with an exponential moving average.
+        We degrade by one level once the load has exceeded 'degrade_load' for 'patience' consecutive frames,
+        and restore by one level once it has been below 'restore_load' for 'patience' consecutive frames.
+        Having separate thresholds (and requiring several frames in a row) stops us flipping back and forth between levels.
+
+        Restoring to level 0 puts the settings back to the values they had when we last left level 0.
+        Changes made to those settings while at level 0 are therefore kept, but changes made while degraded are undone.
+    """
+
+    def __init__(
+        self,
+        frame_interval,
+        degrade_load=0.9,
+        restore_load=0.6,
+        patience=10,
+        smoothing=0.2,
+    ):
+        """Function inputs:
+            frame_interval  float   Time between frames (in seconds)
+            degrade_load    float   Load above which we degrade (1.0 means processing takes the whole frame interval)
+            restore_load    float   Load below which we restore quality
+            patience        int     Number of consecutive frames required before changing level
+            smoothing       float   Weight given to each new frame in the moving average of the load
+        """
+        if restore_load >= degrade_load:
+            raise ValueError(
+                "QoS restore load ({0}) must be less than degrade load ({1})".format(
+                    restore_load, degrade_load
+                )
+            )
+        self.frame_interval = frame_interval
+        self.degrade_load = degrade_load
+        self.restore_load = restore_load
+        self.patience = patience
+        self.smoothing = smoothing
+        self.level = 0
+        self.load = None
+        self.baseline = None
+        self._frames_over = 0
+        self._frames_under = 0
+
+    @property
+    def skip_bookkeeping(self):
+        """True if non-essential bookkeeping (retaining pixel data, refining the reference sequence) should be skipped."""
+        return self.level >= SKIP_BOOKKEEPING_LEVEL
+
+    def update(self, processing_time_s, settings):
+        """ Record the processing time for a frame, and change level (updating 'settings') if necessary.
+            Parameters:
+                processing_time_s   float   Time taken to process the frame
+                settings            dict    Parameters controlling the sync algorithms (updated in place)
+            Returns:
+                Description of the decision made (str), or None if the level is unchanged
+        """
+        load = processing_time_s / self.frame_interval
+        if self.load is None:
+            self.load = load
+        else:
+            self.load += self.smoothing * (load - self.load)
+
+        if self.load > self.degrade_load:
+            self._frames_over += 1
+            self._frames_under = 0
+        elif self.load < self.restore_load:
+            self._frames_under += 1
+            self._frames_over = 0
+        else:
+            self._frames_over = 0
+            self._frames_under = 0
+
+        if self._frames_over >= self.patience and self.level < len(LEVELS) - 1:
+            return self.set_level(self.level + 1, settings, "degrade")
+        if self._frames_under >= self.patience and self.level > 0:
+            return self.set_level(self.level - 1, settings, "restore")
+        return None
+
+    def set_level(self, level, settings, reason="set"):
+        """ Switch to degradation level 'level', updating 'settings' accordingly.
+            Returns:
+                Description of the decision (str)
+        """
+        if self.level == 0:
+            # Remember the full-quality values of every setting that any level overrides
+            # (taking a fresh copy each time we leave level 0, in case they have been changed in the meantime)
+            keys = set(k for overrides in LEVELS for k in overrides)
+            self.baseline = {k: settings[k] for k in keys}
+        self.level = level
+        self._frames_over = 0
+        self._frames_under = 0
+        overrides = LEVELS[level]
+        for key, value in self.baseline.items():
+            settings[key] = overrides[key](value) if key in overrides else value
+        decision = "{0} to level {1} (load {2:.2f})".format(reason, level, self.load)
+        logger.warning("Quality of service: {0}", decision)
+        return decision
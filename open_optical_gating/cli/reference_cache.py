@@ -0,0 +1,76 @@
+"""Cache of cropped reference stacks, used to speed up per-frame phase matching."""
+
+# Python imports
+from collections import OrderedDict
+
+# Module imports
+import numpy as np
+from loguru import logger
+
+# Local imports
+from . import prospective_optical_gating as pog
+
+
+class ReferenceStackCache:
+    """ Holds contiguous, cropped copies of the current reference sequence.
+
+        phase_matching crops the reference frames to the region that overlaps with the
+        (drift-corrected) incoming frame. Because the drift rarely changes between frames,
+        we keep one C-ordered 3D array per crop rectangle, rather than building a list of
+        strided views for every frame. The number of cached stacks is bounded (least-recently-used
+        stacks are evicted first), and the whole cache must be reset whenever the reference frames change.
+
+        The cache can also hold a pyramid of downsampled copies of the reference frames
+        (self.pyramid[0] is downsampled 2x, self.pyramid[1] 4x, etc), each with its own cache of crops.
+    """
+
+    def __init__(self, reference_frames=None, max_entries=8, pyramid_levels=0):
+        """Function inputs:
+            reference_frames    array-like  3D (t by x by y) frame pixel data for our reference period (or None)
+            max_entries         int         Maximum number of cropped stacks to retain
+            pyramid_levels      int         Number of downsampled levels to build (see pog.pyramid_sads)
+        """
+        self.max_entries = max(int(max_entries), 1)
+        self._stacks = OrderedDict()
+        self.reset(reference_frames, pyramid_levels)
+
+    def reset(self, reference_frames=None, pyramid_levels=0):
+        """ Discard all cached stacks, and start caching crops of 'reference_frames' instead.
+            This must be called whenever the reference sequence is replaced.
+        """
+        self._stacks.clear()
+        self.pyramid = []
+        if reference_frames is None:
+            self.reference_frames = None
+        else:
+            self.reference_frames = np.asarray(reference_frames)
+            downsampled = self.reference_frames
+            for _ in range(pyramid_levels):
+                downsampled = pog.downsample(downsampled)
+                self.pyramid.append(
+                    ReferenceStackCache(downsampled, max_entries=self.max_entries)
+                )
+
+    def cropped(self, rect):
+        """ Return a contiguous 3D array of the reference frames cropped to 'rect'.
+            Parameters:
+                rect    list of int     X1,X2,Y1,Y2 crop rectangle
+            Returns:
+                ndarray (t by x by y), which must be treated as read-only by the caller
+        """
+        key = tuple(int(r) for r in rect)
+        stack = self._stacks.get(key)
+        if stack is None:
+            logger.debug("Caching cropped reference stack for rect {0}", key)
+            stack = np.ascontiguousarray(
+                self.reference_frames[:, key[0] : key[1], key[2] : key[3]]
+            )
+            self._stacks[key] = stack
+            if len(self._stacks) > self.max_entries:
+                self._stacks.popitem(last=False)
+        else:
+            self._stacks.move_to_end(key)
+        return stack
+
+    def __len__(self):
+        return len(self._stacks)
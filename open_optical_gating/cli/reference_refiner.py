@@ -0,0 +1,69 @@
+"""Incremental refinement of a reference sequence, using the phase-stamped frames received during sync."""
+
+# Module imports
+import numpy as np
+
+# Local imports
+from . import prospective_optical_gating as pog
+
+
+class ReferenceRefiner:
+    """ Maintains a continuously-updated copy of a reference sequence.
+
+        Each frame received during sync has already been phase-matched against the reference sequence,
+        so we know which reference frame(s) it corresponds to. We blend it into those reference frames
+        with an exponential forgetting factor: the reference frames either side of the frame's (sub-frame) phase
+        are moved towards it by forgetting_factor times their linear interpolation weight.
+        Padding frames at the start/end of the sequence that represent the same phase (one period earlier/later)
+        are updated as well.
+
+        The frame is aligned with the reference frames according to the current drift estimate (as in pog.phase_matching),
+        so the refined sequence stays in the coordinates of the original one. The refined sequence therefore
+        tracks slow changes in the appearance and beating of the heart, but not large-scale drift or changes in period,
+        which require a new reference sequence to be established.
+    """
+
+    def __init__(self, reference_frames, reference_period, forgetting_factor=0.05):
+        """Function inputs:
+            reference_frames    array-like  3D (t by x by y) frame pixel data for the reference sequence (including padding)
+            reference_period    float       Period of the reference sequence (in frames)
+            forgetting_factor   float       Weight given to each new frame (between 0 and 1)
+        """
+        # We accumulate in floating point, so that small changes are not lost to rounding
+        self.accumulator = np.array(reference_frames, dtype=np.float32)
+        self.reference_period = reference_period
+        self.forgetting_factor = forgetting_factor
+        self.num_blended = 0
+
+    def add_frame(self, frame, phase_in_frames, drift):
+        """ Blend a frame into the reference sequence.
+            Parameters:
+                frame           array-like  2D frame pixel data
+                phase_in_frames float       Position of the frame within the reference sequence (including padding),
+                                             as returned by pog.phase_matching
+                drift           list        [dx, dy] drift of the frame relative to the reference sequence
+        """
+        frame = np.asarray(frame)
+        numRefs = self.accumulator.shape[0]
+        rectF, rect = pog.drift_crop_rects(frame.shape, self.accumulator.shape[1:], drift)
+        framePixels = frame[rectF[0] : rectF[1], rectF[2] : rectF[3]]
+        for position in (
+            phase_in_frames - self.reference_period,
+            phase_in_frames,
+            phase_in_frames + self.reference_period,
+        ):
+            below = int(np.floor(position))
+            fraction = position - below
+            for index, weight in ((below, 1 - fraction), (below + 1, fraction)):
+                if 0 <= index < numRefs and weight > 0:
+                    target = self.accumulator[index, rect[0] : rect[1], rect[2] : rect[3]]
+                    target += (self.forgetting_factor * weight) * (framePixels - target)
+        self.num_blended += 1
+
+    def reference_frames(self, dtype):
+        """ Returns the refined reference sequence, as a new array of type 'dtype'
+            (so it is safe to keep, even as further frames are blended in).
+        """
+        if np.dtype(dtype).kind in ("i", "u"):
+            return np.round(self.accumulator).astype(dtype)
+        return self.accumulator.astype(dtype)
@@ -0,0 +1,127 @@
+"""Fixed-capacity circular buffer of frames, used while establishing a reference period."""
+
+# Module imports
+import numpy as np
+
+
+class FrameRingBuffer:
+    """ Preallocated circular buffer holding the most recent frames and their timestamps.
+
+        Every frame is written twice: at position i and at position i + capacity of a buffer
+        that is twice the capacity in length. The most recent frames (oldest first) therefore always
+        occupy a contiguous run of that buffer, and can be returned as a 3D view without copying,
+        however many times the buffer has wrapped around.
+
+        Views returned by frames() and timestamps() remain valid only until the next call to append().
+        Callers that need to keep hold of frames for longer (e.g. as a reference sequence)
+        should stop appending to this buffer and start a new one, rather than copying the frames.
+
+        The buffer can also cache the SADs between each frame and the frames that preceded it (see update_sads),
+        stored by lag: self._lag_sads[slot, lag - 1] is the SAD between the frame in 'slot' and the frame
+        'lag' frames before it. Each new frame therefore only needs one new row of SADs, and earlier rows
+        (e.g. the SADs between consecutive frames) can be looked up later rather than recomputed.
+    """
+
+    def __init__(self, capacity):
+        """Function inputs:
+            capacity    int     Maximum number of frames to retain
+        """
+        self.capacity = max(int(capacity), 1)
+        # The pixel storage is allocated when we see the first frame, since we do not know its shape and dtype until then
+        self._frames = None
+        self._timestamps = np.zeros(2 * self.capacity)
+        self._next = 0
+        self._length = 0
+        # Cache of SADs between frames (allocated the first time update_sads is called)
+        self._lag_sads = None
+        self._sads_valid = np.zeros(self.capacity, dtype=bool)
+        self._sad_roi = None
+
+    def append(self, frame, timestamp):
+        """ Add a frame to the buffer, discarding the oldest frame if the buffer is already full.
+            Parameters:
+                frame       array-like  2D frame pixel data
+                timestamp   float       Timestamp associated with the frame
+        """
+        if self._frames is None:
+            frame = np.asarray(frame)
+            self._frames = np.zeros((2 * self.capacity,) + frame.shape, dtype=frame.dtype)
+        self._frames[self._next] = frame
+        self._frames[self._next + self.capacity] = frame
+        self._timestamps[self._next] = timestamp
+        self._timestamps[self._next + self.capacity] = timestamp
+        self._sads_valid[self._next] = False
+        self._next = (self._next + 1) % self.capacity
+        self._length = min(self._length + 1, self.capacity)
+
+    def drop_oldest(self, count=1):
+        """Discard the 'count' oldest frames in the buffer."""
+        self._length = max(self._length - count, 0)
+
+    def clear(self):
+        """Discard all frames in the buffer (the storage itself is retained for reuse)."""
+        self._length = 0
+
+    def _start(self):
+        return (self._next - self._length) % self.capacity
+
+    def frames(self):
+        """ Returns a 3D (t by x by y) view of the frames in the buffer, oldest first.
+            If no frames have been added yet, returns an empty list.
+        """
+        if self._frames is None:
+            return []
+        start = self._start()
+        return self._frames[start : start + self._length]
+
+    def timestamps(self):
+        """Returns a 1D view of the timestamps of the frames in the buffer, oldest first."""
+        start = self._start()
+        return self._timestamps[start : start + self._length]
+
+    def duration(self):
+        """Returns the time between the oldest and most recent frames in the buffer."""
+        if self._length == 0:
+            return 0.0
+        timestamps = self.timestamps()
+        return timestamps[-1] - timestamps[0]
+
+    def update_sads(self, sad_with_references, roi=None):
+        """ Compute (and cache) the SADs between the most recent frame and every earlier frame in the buffer.
+            Parameters:
+                sad_with_references function    SAD function (see sad_backends)
+                roi                 list of int X1,X2,Y1,Y2 region of the frames to compare (or None for the whole frame)
+            Returns:
+                1D array of SADs against each earlier frame, oldest first (as expected by calculate_period_length)
+        """
+        if self._lag_sads is None:
+            self._lag_sads = np.zeros((self.capacity, self.capacity), dtype=np.int64)
+        if roi != self._sad_roi:
+            # SADs computed over a different region cannot be reused
+            self._sads_valid[:] = False
+            self._sad_roi = None if roi is None else list(roi)
+
+        frames = self.frames()
+        if roi is not None:
+            frames = frames[:, roi[0] : roi[1], roi[2] : roi[3]]
+        diffs = np.asarray(sad_with_references(frames[-1], frames[:-1]))
+        last = (self._next - 1) % self.capacity
+        self._lag_sads[last, : diffs.size] = diffs[::-1]
+        self._sads_valid[last] = True
+        return diffs
+
+    def consecutive_sads(self, first, last, roi=None):
+        """ Look up the cached SADs between each pair of consecutive frames frames()[i] and frames()[i + 1],
+            for first <= i < last.
+            Returns:
+                1D int64 array, or None if any of those SADs is not in the cache (or was computed for a different roi)
+        """
+        if roi != self._sad_roi or self._lag_sads is None:
+            return None
+        slots = (self._start() + np.arange(first + 1, last + 1)) % self.capacity
+        if not np.all(self._sads_valid[slots]):
+            return None
+        return self._lag_sads[slots, 0].copy()
+
+    def __len__(self):
+        return self._length
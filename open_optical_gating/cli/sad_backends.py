@@ -0,0 +1,337 @@
+"""Registry of interchangeable compute backends for sum-of-absolute-differences (SAD) calculations.
+
+Each backend provides:
+    sad_with_references(frame, reference_frames)    1D int64 array of SADs between 'frame' and each reference frame
+    sad_correlation(frame_a, frame_b)               SAD between two frames
+    sad_pairs(frames, reference_frames,             1D int64 array of SADs between frames[frame_indices[i]]
+              frame_indices, reference_indices)      and reference_frames[reference_indices[i]], for each i
+    sad_early_abandon(frame, reference_frames,      SADs computed in blocks of rows, abandoning each reference frame
+              order, bound_mask, margin, block_rows) once it is clearly worse than the best so far
+                                                    (optional: see _numpy_sad_early_abandon)
+
+Available backends:
+    "jps"       The j_py_sad_correlation C extension (fast, but not available everywhere)
+    "numpy"     Pure NumPy, batched over the whole reference stack
+    "numba"     Numba-compiled, parallelised across all cores (requires the optional 'numba' extra)
+    "auto"      Picks the best of the above that is available on this machine
+"""
+
+# Module imports
+import numpy as np
+from loguru import logger
+
+try:
+    import j_py_sad_correlation as jps
+except ImportError:
+    jps = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+class SADBackend:
+    """Simple container for the functions implementing one SAD backend."""
+
+    def __init__(
+        self,
+        name,
+        sad_with_references,
+        sad_correlation,
+        sad_pairs=None,
+        sad_early_abandon=None,
+    ):
+        self.name = name
+        self.sad_with_references = sad_with_references
+        self.sad_correlation = sad_correlation
+        if sad_pairs is None:
+            # Build the batched pairs calculation out of this backend's sad_with_references
+            sad_pairs = lambda *args: _generic_sad_pairs(self.sad_with_references, *args)
+        self.sad_pairs = sad_pairs
+        # Optional: None if this backend cannot abandon SAD calculations early
+        self.sad_early_abandon = sad_early_abandon
+
+    def __repr__(self):
+        return "SADBackend({0})".format(self.name)
+
+
+_backends = {}
+
+
+def register_backend(
+    name, sad_with_references, sad_correlation, sad_pairs=None, sad_early_abandon=None
+):
+    """ Register a SAD backend under 'name', so that it can be selected with the "sad_backend" setting.
+        Registering under an existing name replaces that backend.
+        If 'sad_pairs' is not provided, it is implemented in terms of 'sad_with_references'.
+        If 'sad_early_abandon' is not provided, callers will compute full SADs instead.
+    """
+    _backends[name] = SADBackend(
+        name, sad_with_references, sad_correlation, sad_pairs, sad_early_abandon
+    )
+    return _backends[name]
+
+
+def available_backends():
+    """Returns a list of the names of the backends that can be used on this machine."""
+    return list(_backends.keys())
+
+
+def get_backend(name="auto"):
+    """ Look up a SAD backend by name.
+        Parameters:
+            name    str     One of available_backends(), or "auto"
+        Returns:
+            SADBackend object
+    """
+    if name is None or name == "auto":
+        if "jps" in _backends and not _jps_is_fallback():
+            name = "jps"
+        elif "numba" in _backends:
+            name = "numba"
+        else:
+            name = "numpy"
+    try:
+        return _backends[name]
+    except KeyError:
+        raise ValueError(
+            "Unknown SAD backend '{0}' (available backends are: {1})".format(
+                name, ", ".join(available_backends())
+            )
+        )
+
+
+def _jps_is_fallback():
+    return hasattr(jps, "windows_fallback")
+
+
+def widened_dtype(dtype):
+    """ Returns a signed integer type wide enough to hold differences between pixels of type 'dtype'
+        (or float64 for non-integer pixel types).
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind == "u" and dtype.itemsize <= 4:
+        return np.dtype("int{0}".format(16 * dtype.itemsize))
+    elif dtype.kind in ("i", "u"):
+        return np.dtype(np.int64)
+    return np.dtype(np.float64)
+
+
+def as_stack(reference_frames):
+    """Returns the reference frames as a 3D ndarray (without copying, if they already are one)."""
+    return np.asarray(reference_frames)
+
+
+def _generic_sad_pairs(sad_with_references, frames, reference_frames, frame_indices, reference_indices):
+    # One sad_with_references call per distinct frame, covering all the references it is paired with
+    frame_indices = np.asarray(frame_indices)
+    reference_indices = np.asarray(reference_indices)
+    reference_frames = as_stack(reference_frames)
+    result = np.zeros(frame_indices.size, dtype=np.int64)
+    for f in np.unique(frame_indices):
+        which = np.nonzero(frame_indices == f)[0]
+        result[which] = sad_with_references(frames[f], reference_frames[reference_indices[which]])
+    return result
+
+
+# ---------------------------------------------------------------------------------
+# NumPy backend
+
+def _numpy_sad_with_references(frame, reference_frames):
+    # Widen the (single) frame once. Subtracting that from the reference stack then widens the
+    # reference pixels on the fly, so that we never hold a separate widened copy of the stack.
+    frame = np.asarray(frame)
+    reference_frames = as_stack(reference_frames)
+    frameWide = frame.astype(widened_dtype(frame.dtype))
+    if reference_frames.shape[0] == 0:
+        return np.zeros(0, dtype=np.int64)
+    diffs = np.abs(reference_frames - frameWide[np.newaxis, :, :])
+    return diffs.reshape(diffs.shape[0], -1).sum(axis=1, dtype=np.int64)
+
+
+def _numpy_sad_correlation(frame_a, frame_b):
+    frame_a = np.asarray(frame_a)
+    diffs = np.abs(np.asarray(frame_b) - frame_a.astype(widened_dtype(frame_a.dtype)))
+    return diffs.sum(dtype=np.int64)
+
+
+def _numpy_sad_early_abandon(
+    frame, reference_frames, order, bound_mask, margin=0.0, block_rows=8
+):
+    """ Compute SADs between 'frame' and the reference frames, visiting the reference frames in 'order',
+        and accumulating each SAD over blocks of 'block_rows' rows at a time.
+        We keep track of the best complete SAD so far among the reference frames flagged in 'bound_mask',
+        and abandon any reference frame as soon as its partial sum exceeds that best SAD times (1 + margin).
+        An abandoned reference frame cannot be the best match (among the frames in 'bound_mask', or overall),
+        but its reported SAD is only a lower bound on the true value.
+        
+        Parameters:
+            frame               array-like  2D frame pixel data
+            reference_frames    array-like  3D (t by x by y) reference frame pixel data
+            order               array-like  Indices of reference frames, in the order they should be visited
+            bound_mask          array-like  1D bool array: True for reference frames that may tighten the bound
+            margin              float       Fractional margin added to the bound before abandoning a frame
+            block_rows          int         Number of rows to accumulate between checks against the bound
+        Returns:
+            SADs                ndarray     1D int64 array (partial sums for abandoned frames)
+            complete            ndarray     1D bool array, True where the SAD was computed in full
+    """
+    frame = np.asarray(frame)
+    reference_frames = as_stack(reference_frames)
+    frameWide = frame.astype(widened_dtype(frame.dtype))
+    numRows = frame.shape[0]
+    SADs = np.zeros(reference_frames.shape[0], dtype=np.int64)
+    complete = np.zeros(reference_frames.shape[0], dtype=bool)
+    bound = np.inf
+    for k in order:
+        acc = 0
+        complete[k] = True
+        for r in range(0, numRows, block_rows):
+            diffs = np.abs(reference_frames[k, r : r + block_rows] - frameWide[r : r + block_rows])
+            acc += diffs.sum(dtype=np.int64)
+            if acc > bound and r + block_rows < numRows:
+                complete[k] = False
+                break
+        SADs[k] = acc
+        if complete[k] and bound_mask[k]:
+            bound = min(bound, acc * (1.0 + margin))
+    return SADs, complete
+
+
+def _numpy_sad_pairs(frames, reference_frames, frame_indices, reference_indices):
+    frames = as_stack(frames)
+    frameWide = frames.astype(widened_dtype(frames.dtype))
+    diffs = np.abs(as_stack(reference_frames)[reference_indices] - frameWide[frame_indices])
+    return diffs.reshape(diffs.shape[0], -1).sum(axis=1, dtype=np.int64)
+
+
+register_backend(
+    "numpy",
+    _numpy_sad_with_references,
+    _numpy_sad_correlation,
+    _numpy_sad_pairs,
+    _numpy_sad_early_abandon,
+)
+
+
+# ---------------------------------------------------------------------------------
+# Numba backend
+
+if numba is not None:
+
+    @numba.njit(parallel=True, cache=True)
+    def _numba_sad_rows(frame, reference_frames):
+        # We parallelise over (reference frame, row) pairs rather than just over reference frames,
+        # so that every core is kept busy even when there are few (but large) frames to compare.
+        n, h, w = reference_frames.shape
+        rowSums = np.zeros(n * h, dtype=np.int64)
+        for kr in numba.prange(n * h):
+            k = kr // h
+            r = kr % h
+            acc = 0
+            for c in range(w):
+                d = np.int64(frame[r, c]) - np.int64(reference_frames[k, r, c])
+                acc += abs(d)
+            rowSums[kr] = acc
+        return rowSums.reshape(n, h).sum(axis=1)
+
+    @numba.njit(parallel=True, cache=True)
+    def _numba_sad_pairs_rows(frames, reference_frames, frame_indices, reference_indices):
+        n = frame_indices.shape[0]
+        h = frames.shape[1]
+        w = frames.shape[2]
+        rowSums = np.zeros(n * h, dtype=np.int64)
+        for pr in numba.prange(n * h):
+            p = pr // h
+            r = pr % h
+            f = frame_indices[p]
+            k = reference_indices[p]
+            acc = 0
+            for c in range(w):
+                d = np.int64(frames[f, r, c]) - np.int64(reference_frames[k, r, c])
+                acc += abs(d)
+            rowSums[pr] = acc
+        return rowSums.reshape(n, h).sum(axis=1)
+
+    @numba.njit(cache=True)
+    def _numba_sad_early_abandon_kernel(
+        frame, reference_frames, order, bound_mask, margin, block_rows
+    ):
+        n, h, w = reference_frames.shape
+        SADs = np.zeros(n, dtype=np.int64)
+        complete = np.zeros(n, dtype=np.bool_)
+        bound = np.inf
+        for o in range(order.shape[0]):
+            k = order[o]
+            acc = 0
+            r = 0
+            complete[k] = True
+            while r < h:
+                rEnd = min(r + block_rows, h)
+                for i in range(r, rEnd):
+                    for c in range(w):
+                        d = np.int64(frame[i, c]) - np.int64(reference_frames[k, i, c])
+                        acc += abs(d)
+                r = rEnd
+                if acc > bound and r < h:
+                    complete[k] = False
+                    break
+            SADs[k] = acc
+            if complete[k] and bound_mask[k]:
+                bound = min(bound, acc * (1.0 + margin))
+        return SADs, complete
+
+    def _numba_sad_early_abandon(
+        frame, reference_frames, order, bound_mask, margin=0.0, block_rows=8
+    ):
+        return _numba_sad_early_abandon_kernel(
+            np.asarray(frame),
+            as_stack(reference_frames),
+            np.asarray(order, dtype=np.int64),
+            np.asarray(bound_mask, dtype=np.bool_),
+            float(margin),
+            int(block_rows),
+        )
+
+    def _numba_sad_with_references(frame, reference_frames):
+        reference_frames = as_stack(reference_frames)
+        if reference_frames.shape[0] == 0:
+            return np.zeros(0, dtype=np.int64)
+        return _numba_sad_rows(np.asarray(frame), reference_frames)
+
+    def _numba_sad_correlation(frame_a, frame_b):
+        frame_b = np.asarray(frame_b)
+        return _numba_sad_rows(np.asarray(frame_a), frame_b[np.newaxis, :, :])[0]
+
+    def _numba_sad_pairs(frames, reference_frames, frame_indices, reference_indices):
+        frame_indices = np.asarray(frame_indices, dtype=np.int64)
+        if frame_indices.size == 0:
+            return np.zeros(0, dtype=np.int64)
+        return _numba_sad_pairs_rows(
+            as_stack(frames),
+            as_stack(reference_frames),
+            frame_indices,
+            np.asarray(reference_indices, dtype=np.int64),
+        )
+
+    register_backend(
+        "numba",
+        _numba_sad_with_references,
+        _numba_sad_correlation,
+        _numba_sad_pairs,
+        _numba_sad_early_abandon,
+    )
+
+
+# ---------------------------------------------------------------------------------
+# j_py_sad_correlation backend
+
+if jps is not None:
+    register_backend("jps", jps.sad_with_references, jps.sad_correlation)
+    if _jps_is_fallback():
+        logger.warning(
+            "j_py_sad_correlation is using fallback code for temporary Windows support (slower - not suitable for realtime operation). "
+            "The 'auto' SAD backend will use {0} instead.",
+            get_backend("auto").name,
+        )
@@ -109,7 +109,11 @@ def run(args, desc):
     logger.success("Initialising gater...")
     analyser = WebSocketOpticalGater(settings=settings)
     logger.success("Running server...")
-    analyser.run_server()
+    try:
+        analyser.run_server()
+    finally:
+        # run_server only returns if it is interrupted (e.g. by Ctrl-C), so make sure queued periods are still saved
+        analyser.shutdown()
 
 
 if __name__ == "__main__":
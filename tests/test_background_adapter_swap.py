@@ -0,0 +1,82 @@
+"""Tests for swapping in the reference sequence from a background adaptive update (OpticalGater.check_background_adapter)."""
+
+# Module imports
+import numpy as np
+import pytest
+
+# Local imports
+from open_optical_gating.cli import optical_gater_server as server
+from open_optical_gating.cli import prospective_optical_gating as pog
+from open_optical_gating.cli.alignment_soak_benchmark import synthetic_sequence
+
+PERIOD = 20.0
+FRAMERATE = 80.0
+
+
+class FinishedAdapter:
+    """Stands in for an adaptive_update.BackgroundAdapter that has finished with the given result."""
+
+    def __init__(self, result):
+        self.result = result
+
+    def finished(self):
+        return True
+
+
+@pytest.fixture
+def gater(tmp_path):
+    settings = {
+        "brightfield_framerate": FRAMERATE,
+        "frame_buffer_length": 100,
+        "period_dir": str(tmp_path) + "/",
+        "update_after_n_triggers": 10,
+        "prediction_latency_s": 0.015,
+        "min_heart_rate_hz": 1.0,
+        "pog_settings": {"drift": [0, 0]},
+    }
+    rng = np.random.default_rng(0)
+    ref_frames = synthetic_sequence(PERIOD, 2, (32, 32), 0, rng)
+    g = server.OpticalGater(settings=settings, ref_frames=ref_frames, ref_frame_period=PERIOD)
+    yield g
+    g.shutdown()
+
+
+def test_swap_with_negative_offset_keeps_phase_continuous(gater):
+    radsPerSec = 2 * np.pi * FRAMERATE / PERIOD
+    step = radsPerSec / FRAMERATE
+    # Frames measured against the old reference sequence, ending just after the phase has wrapped round
+    # (so that the offset below takes the most recent wrapped phase below zero)
+    unwrapped = 2 * np.pi + 0.1 + (np.arange(10) - 9) * step
+    wrapped = unwrapped % (2 * np.pi)
+    for i in range(10):
+        gater.frame_history.append(timestamp=i / FRAMERATE, unwrapped_phase=unwrapped[i], sad_min=0)
+    gater.last_phase = wrapped[-1]
+    old_target = 3.0
+    gater.pog_settings["targetSyncPhase"] = old_target
+
+    # The new reference sequence starts later in the heart cycle, so its phases are smaller than the old ones
+    new_settings = dict(gater.pog_settings, targetSyncPhase=old_target - 1.0)
+    gater.adapter = FinishedAdapter(
+        {
+            "ref_frames": gater.ref_frames,
+            "oga_history": (None, None, None, None, None),
+            "target": 0,
+            "settings": new_settings,
+        }
+    )
+    gater.check_background_adapter(None)
+    offset = -1.0
+
+    assert gater.adapter is None
+    assert 0 <= gater.last_phase < 2 * np.pi
+    assert gater.last_phase == pytest.approx((wrapped[-1] + offset) % (2 * np.pi))
+    assert gater.frame_history.last("unwrapped_phase") == pytest.approx(unwrapped[-1] + offset)
+
+    # The next frame (as measured against the new reference sequence) should follow on smoothly
+    nextPhase = (wrapped[-1] + step + offset) % (2 * np.pi)
+    delta, frames_missed = pog.unwrap_phase_delta(
+        nextPhase - gater.last_phase, 1 / FRAMERATE, gater.pog_settings, radsPerSec=radsPerSec
+    )
+    assert frames_missed == 0
+    assert delta == pytest.approx(step)
+    assert gater.frame_history.last("unwrapped_phase") + delta == pytest.approx(unwrapped[-1] + step + offset)
@@ -0,0 +1,102 @@
+"""Tests that abandoning SAD calculations early (settings["sad_early_abandon"]) does not change the phase matching result."""
+
+# Python imports
+import copy
+
+# Module imports
+import numpy as np
+import pytest
+
+# Local imports
+from open_optical_gating.cli import parameters
+from open_optical_gating.cli import prospective_optical_gating as pog
+from open_optical_gating.cli import sad_backends
+from open_optical_gating.cli.alignment_soak_benchmark import synthetic_sequence
+
+PERIOD = 20.0
+SHAPE = (48, 48)
+NUM_EXTRA = 2
+
+BACKENDS = [
+    name
+    for name in sad_backends.available_backends()
+    if sad_backends.get_backend(name).sad_early_abandon is not None
+]
+
+
+def make_settings(backend_name, early_abandon):
+    settings = parameters.initialise(
+        framerate=80,
+        drift=[0, 0],
+        numExtraRefFrames=NUM_EXTRA,
+        sad_backend=backend_name,
+        sad_early_abandon=early_abandon,
+        sad_block_rows=4,
+    )
+    return parameters.update(settings, reference_period=PERIOD)
+
+
+def make_frame(phase, shift, rng):
+    frame = synthetic_sequence(PERIOD, 0, SHAPE, phase, rng)[0]
+    return np.roll(frame, shift, axis=(0, 1))
+
+
+def compare(frame, ref_frames, predicted_index, backend_name, drift=(0, 0)):
+    results = []
+    for early_abandon in (False, True):
+        settings = make_settings(backend_name, early_abandon)
+        settings["drift"] = list(drift)
+        phase, SADs, settings = pog.phase_matching(
+            frame, ref_frames, settings=settings, predicted_index=predicted_index
+        )
+        results.append((phase, SADs, settings))
+    (phase, SADs, settings), (phaseEA, SADsEA, settingsEA) = results
+    assert phaseEA == phase
+    assert np.argmin(SADsEA) == np.argmin(SADs)
+    assert settingsEA["drift"] == settings["drift"]
+    assert settingsEA["lastSADMin"] == settings["lastSADMin"]
+    # Any SADs that were abandoned are only lower bounds
+    assert np.all(SADsEA <= SADs)
+    return SADs, SADsEA
+
+
+@pytest.fixture(scope="module")
+def ref_frames():
+    return synthetic_sequence(PERIOD, NUM_EXTRA, SHAPE, 0, np.random.default_rng(0))
+
+
+@pytest.mark.parametrize("backend_name", BACKENDS)
+def test_random_frames_and_predictions(backend_name, ref_frames):
+    rng = np.random.default_rng(1)
+    numAbandoned = 0
+    for _ in range(200):
+        frame = make_frame(rng.uniform(0, 2 * np.pi), tuple(rng.integers(-2, 3, 2)), rng)
+        predicted_index = int(rng.integers(0, len(ref_frames))) if rng.uniform() < 0.8 else None
+        drift = tuple(rng.integers(-2, 3, 2))
+        SADs, SADsEA = compare(frame, ref_frames, predicted_index, backend_name, drift)
+        numAbandoned += np.sum(SADsEA != SADs)
+    # Make sure we are actually testing the early-abandon code
+    assert numAbandoned > 0
+
+
+@pytest.mark.parametrize("backend_name", BACKENDS)
+def test_wrong_prediction(backend_name, ref_frames):
+    rng = np.random.default_rng(2)
+    # The frame matches reference frame 7, but we predict that it will be half a period away
+    frame = make_frame(2 * np.pi * 5 / PERIOD, (0, 0), rng)
+    SADs, SADsEA = compare(frame, ref_frames, 7 + int(PERIOD) // 2, backend_name)
+    assert np.argmin(SADs) == 7
+
+
+@pytest.mark.parametrize("backend_name", BACKENDS)
+@pytest.mark.parametrize("phase", [0.02, 2 * np.pi - 0.02, 2 * np.pi / PERIOD, 2 * np.pi * (1 - 1 / PERIOD)])
+def test_best_match_at_either_end(backend_name, ref_frames, phase):
+    # subframe_fitting needs the exact SADs either side of the best match,
+    # which are padding frames when the best match is the first or last of the main reference frames
+    rng = np.random.default_rng(3)
+    frame = make_frame(phase, (0, 0), rng)
+    for predicted_index in (None, 0, NUM_EXTRA, len(ref_frames) - 1, len(ref_frames) // 2):
+        SADs, SADsEA = compare(frame, ref_frames, predicted_index, backend_name)
+        best = np.argmin(SADs[NUM_EXTRA:-NUM_EXTRA]) + NUM_EXTRA
+        assert SADsEA[best - 1] == SADs[best - 1]
+        assert SADsEA[best + 1] == SADs[best + 1]
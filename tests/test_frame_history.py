@@ -0,0 +1,98 @@
+"""Tests for FrameHistory, and in particular its constant-time linear fit of phase against time."""
+
+# Module imports
+import numpy as np
+import pytest
+
+# Local imports
+from open_optical_gating.cli import frame_history
+from open_optical_gating.cli import parameters
+from open_optical_gating.cli import prospective_optical_gating as pog
+
+CAPACITY = 16
+FRAMERATE = 80.0
+
+
+def fill(history, numFrames, rng, frames_missed=None, first=0):
+    # Realistic (wall-clock) timestamps, and phases advancing at about 2 beats per second, with a little noise
+    timestamps = 1.6e9 + np.arange(first, first + numFrames) / FRAMERATE + rng.normal(0, 1e-4, numFrames)
+    phases = 4 * np.pi * (timestamps - 1.6e9) + rng.normal(0, 0.05, numFrames)
+    for i in range(numFrames):
+        values = {"timestamp": timestamps[i], "unwrapped_phase": phases[i], "sad_min": 0}
+        if frames_missed is not None:
+            values["frames_missed"] = frames_missed[i]
+        history.append(**values)
+        yield i
+
+
+def polyfit(history, n, weights=None):
+    # (np.polyfit loses precision with wall-clock timestamps, so we measure them from the most recent frame)
+    rows = history.window(["timestamp", "unwrapped_phase"], n)
+    if weights is not None:
+        weights = np.sqrt(weights)
+    return tuple(np.polyfit(rows[:, 0] - rows[-1, 0], rows[:, 1], 1, w=weights))
+
+
+def assert_fits_equal(actual, expected):
+    assert actual[0] == pytest.approx(expected[0], rel=1e-8)
+    assert actual[1] == pytest.approx(expected[1], rel=1e-12, abs=1e-6)
+
+
+def test_linear_fit_matches_polyfit_after_wrapping_round():
+    rng = np.random.default_rng(0)
+    history = frame_history.FrameHistory(CAPACITY)
+    # Several times the capacity, so that we wrap round the storage and rebase the running sums more than once
+    for i in fill(history, 5 * CAPACITY + 3, rng):
+        for n in range(2, min(i + 1, CAPACITY) + 1):
+            assert_fits_equal(history.linear_fit(n), polyfit(history, n))
+    assert history.num_appended > 2 * history.capacity
+    # Asking for more rows than we have fits to all of them
+    assert_fits_equal(history.linear_fit(10 * CAPACITY), polyfit(history, CAPACITY))
+
+
+def test_linear_fit_after_changing_values():
+    rng = np.random.default_rng(1)
+    history = frame_history.FrameHistory(CAPACITY)
+    for _ in fill(history, 2 * CAPACITY + 5, rng):
+        pass
+    history.set_last(unwrapped_phase=history.last("unwrapped_phase") + 0.3)
+    assert_fits_equal(history.linear_fit(CAPACITY), polyfit(history, CAPACITY))
+    history.shift_phases(-2.5)
+    for n in (2, 5, CAPACITY):
+        assert_fits_equal(history.linear_fit(n), polyfit(history, n))
+    # Appending after shifting
+    for _ in fill(history, 7, rng, first=2 * CAPACITY + 5):
+        assert_fits_equal(history.linear_fit(CAPACITY), polyfit(history, CAPACITY))
+
+
+def test_weighted_fit_with_missed_frames():
+    rng = np.random.default_rng(2)
+    settings = parameters.initialise(framerate=FRAMERATE, drift=[0, 0], missed_frame_weight=0.25)
+    history = frame_history.FrameHistory(CAPACITY)
+    framesMissed = np.zeros(5 * CAPACITY + 3)
+    framesMissed[rng.choice(framesMissed.size, 12, replace=False)] = rng.integers(1, 4, 12)
+    numWeighted = 0
+    for i in fill(history, framesMissed.size, rng, framesMissed):
+        for n in range(2, min(i + 1, CAPACITY) + 1):
+            missed = history.window("frames_missed", n)
+            weights = np.where(missed > 0, settings["missed_frame_weight"], 1.0)
+            assert_fits_equal(pog.linear_fit(history, n, settings), polyfit(history, n, weights))
+            numWeighted += np.any(missed > 0)
+    assert numWeighted > 0
+
+
+def test_weighted_fit_matches_direct_least_squares():
+    # Independent check of the weighting: weighted least squares, solved directly
+    rng = np.random.default_rng(3)
+    settings = parameters.initialise(framerate=FRAMERATE, drift=[0, 0], missed_frame_weight=0.25)
+    history = frame_history.FrameHistory(CAPACITY)
+    framesMissed = np.zeros(CAPACITY)
+    framesMissed[[4, 11]] = 2
+    for _ in fill(history, CAPACITY, rng, framesMissed):
+        pass
+    rows = history.window(["timestamp", "unwrapped_phase"])
+    weights = np.where(framesMissed > 0, 0.25, 1.0)
+    x = rows[:, 0] - rows[-1, 0]
+    A = np.column_stack([x, np.ones_like(x)]) * np.sqrt(weights)[:, np.newaxis]
+    (radsPerSec, fittedPhase), *_ = np.linalg.lstsq(A, rows[:, 1] * np.sqrt(weights), rcond=None)
+    assert_fits_equal(pog.linear_fit(history, CAPACITY, settings), (radsPerSec, fittedPhase))
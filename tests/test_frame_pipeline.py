@@ -0,0 +1,148 @@
+"""Tests for FramePipeline (overflow policies, errors and cancellation), and its use by OpticalGater.analyse_until_stopped."""
+
+# Python imports
+import threading
+import time
+
+# Module imports
+import numpy as np
+import pytest
+
+# Local imports
+from open_optical_gating.cli import frame_pipeline
+from open_optical_gating.cli import optical_gater_server as server
+from open_optical_gating.cli.alignment_soak_benchmark import synthetic_sequence
+
+
+class Counter:
+    """Capture function returning 0, 1, 2, ... (and should_stop function, once 'limit' frames have been captured)."""
+
+    def __init__(self, limit=None, fail_at=None):
+        self.limit = limit
+        self.fail_at = fail_at
+        self.count = 0
+
+    def capture(self):
+        if self.count == self.fail_at:
+            raise RuntimeError("Camera failed")
+        self.count += 1
+        return self.count - 1
+
+    def should_stop(self):
+        return self.limit is not None and self.count >= self.limit
+
+
+def drain(pipeline):
+    frames = []
+    while True:
+        frame = pipeline.get()
+        if frame is None:
+            return frames
+        frames.append(frame)
+
+
+def wait_for(condition, timeout=5):
+    t0 = time.time()
+    while not condition():
+        assert time.time() - t0 < timeout, "Timed out"
+        time.sleep(0.001)
+
+
+@pytest.mark.parametrize(
+    "policy, survivors",
+    [("drop-oldest", [7, 8, 9]), ("latest-only", [9])],
+)
+def test_overfilled_queue_drops_frames(policy, survivors):
+    counter = Counter(limit=10)
+    pipeline = frame_pipeline.FramePipeline(
+        counter.capture, counter.should_stop, max_queue_length=3, policy=policy
+    )
+    pipeline.start()
+    # Capture everything before we analyse anything
+    pipeline.join()
+    assert drain(pipeline) == survivors
+    assert pipeline.num_captured == 10
+    assert pipeline.num_dropped == 10 - len(survivors)
+    assert pipeline.depth == 0
+
+
+def test_overfilled_queue_blocks_capture():
+    counter = Counter(limit=10)
+    pipeline = frame_pipeline.FramePipeline(
+        counter.capture, counter.should_stop, max_queue_length=3, policy="block"
+    )
+    pipeline.start()
+    # Capture is held up once the queue is full (the fourth frame is waiting for room)
+    wait_for(lambda: counter.count == 4)
+    time.sleep(0.05)
+    assert counter.count == 4
+    assert pipeline.depth == 3
+    assert pipeline._thread.is_alive()
+    assert drain(pipeline) == list(range(10))
+    pipeline.join()
+    assert pipeline.num_dropped == 0
+    assert pipeline.max_depth == 3
+
+
+def test_capture_error_is_raised_by_get():
+    counter = Counter(fail_at=3)
+    pipeline = frame_pipeline.FramePipeline(counter.capture, counter.should_stop, policy="block")
+    pipeline.start()
+    assert [pipeline.get() for _ in range(3)] == [0, 1, 2]
+    with pytest.raises(RuntimeError):
+        pipeline.get()
+    pipeline.join()
+
+
+@pytest.mark.parametrize("policy", frame_pipeline.OVERFLOW_POLICIES)
+def test_cancel_stops_capture(policy):
+    # Capture never stops of its own accord
+    counter = Counter()
+    pipeline = frame_pipeline.FramePipeline(
+        counter.capture, counter.should_stop, max_queue_length=2, policy=policy
+    )
+    pipeline.start()
+    wait_for(lambda: pipeline.depth > 0)
+    pipeline.cancel()
+    assert pipeline.get() is None
+    pipeline._thread.join(timeout=5)
+    assert not pipeline._thread.is_alive()
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        frame_pipeline.FramePipeline(lambda: 0, lambda: False, policy="drop-newest")
+
+
+def test_failing_analysis_stops_capture_thread(tmp_path):
+    settings = {
+        "brightfield_framerate": 80,
+        "frame_buffer_length": 100,
+        "period_dir": str(tmp_path) + "/",
+        "update_after_n_triggers": 10,
+        "prediction_latency_s": 0.015,
+        "min_heart_rate_hz": 1.0,
+        "capture_pipeline": True,
+        "capture_queue_length": 2,
+        "capture_overflow_policy": "block",
+        "pog_settings": {"drift": [0, 0]},
+    }
+    ref_frames = synthetic_sequence(20.0, 2, (32, 32), 0, np.random.default_rng(0))
+    gater = server.OpticalGater(settings=settings, ref_frames=ref_frames, ref_frame_period=20.0)
+    analysed = []
+
+    def analyze_pixelarray(pixelArray):
+        if len(analysed) == 3:
+            raise RuntimeError("Analysis failed")
+        analysed.append(pixelArray)
+
+    gater.analyze_pixelarray = analyze_pixelarray
+    # Capture never stops of its own accord (gater.stop is never set)
+    counter = Counter()
+    threadsBefore = set(threading.enumerate())
+    with pytest.raises(RuntimeError):
+        gater.analyse_until_stopped(counter.capture)
+    gater.shutdown()
+    assert analysed == [0, 1, 2]
+    assert not gater.frame_pipeline._thread.is_alive()
+    assert not [t for t in threading.enumerate() if t not in threadsBefore and t.name == "FramePipeline"]
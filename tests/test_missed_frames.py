@@ -0,0 +1,88 @@
+"""Tests for detecting missed frames from gaps in the timestamps, and unwrapping the phase across them."""
+
+# Module imports
+import numpy as np
+import pytest
+
+# Local imports
+from open_optical_gating.cli import optical_gater_server as server
+from open_optical_gating.cli import parameters
+from open_optical_gating.cli import pixelarray as pa
+from open_optical_gating.cli import prospective_optical_gating as pog
+from open_optical_gating.cli.alignment_soak_benchmark import synthetic_sequence
+
+PERIOD = 20.0
+FRAMERATE = 80.0
+STEP = 2 * np.pi / PERIOD
+
+
+@pytest.fixture
+def settings():
+    settings = parameters.initialise(framerate=FRAMERATE, drift=[0, 0])
+    return parameters.update(settings, reference_period=PERIOD)
+
+
+def test_consecutive_frames_across_wrap(settings):
+    delta, frames_missed = pog.unwrap_phase_delta(
+        (6.2 + STEP) % (2 * np.pi) - 6.2, 1 / FRAMERATE, settings
+    )
+    assert frames_missed == 0
+    assert delta == pytest.approx(STEP)
+
+
+@pytest.mark.parametrize("numIntervals", [2, 3])
+def test_gap_across_wrap(settings, numIntervals):
+    # The phase wraps round during the gap
+    last = 2 * np.pi - STEP / 2
+    delta, frames_missed = pog.unwrap_phase_delta(
+        (last + numIntervals * STEP) % (2 * np.pi) - last, numIntervals / FRAMERATE, settings
+    )
+    assert frames_missed == numIntervals - 1
+    assert delta == pytest.approx(numIntervals * STEP)
+
+
+def test_gap_longer_than_a_heartbeat(settings):
+    # 25 frame intervals is 1.25 heartbeats, so the wrapped phase alone cannot tell us how far we have advanced
+    last = 1.0
+    delta, frames_missed = pog.unwrap_phase_delta(
+        (last + 25 * STEP) % (2 * np.pi) - last, 25 / FRAMERATE, settings
+    )
+    assert frames_missed == 24
+    assert delta == pytest.approx(25 * STEP)
+
+
+def test_gap_uses_current_heart_rate(settings):
+    # The heart is beating 20% faster than the reference sequence implies
+    radsPerSec = 1.2 * STEP * FRAMERATE
+    last = 5.0
+    delta, frames_missed = pog.unwrap_phase_delta(
+        (last + 24 * 1.2 * STEP) % (2 * np.pi) - last, 24 / FRAMERATE, settings, radsPerSec=radsPerSec
+    )
+    assert frames_missed == 23
+    assert delta == pytest.approx(24 * 1.2 * STEP)
+
+
+def test_gater_records_missed_frames(tmp_path):
+    settings = {
+        "brightfield_framerate": FRAMERATE,
+        "frame_buffer_length": 100,
+        "period_dir": str(tmp_path) + "/",
+        "update_after_n_triggers": 10,
+        "prediction_latency_s": 0.015,
+        "min_heart_rate_hz": 1.0,
+        "pog_settings": {"drift": [0, 0]},
+    }
+    rng = np.random.default_rng(0)
+    ref_frames = synthetic_sequence(PERIOD, 2, (32, 32), 0, rng)
+    gater = server.OpticalGater(settings=settings, ref_frames=ref_frames, ref_frame_period=PERIOD)
+    # Frames 19 and 20 are missed, and the phase wraps round at frame 20
+    frameNumbers = list(range(19)) + [21, 22, 23]
+    for i in frameNumbers:
+        frame = synthetic_sequence(PERIOD, 0, (32, 32), i * STEP, rng)[0]
+        gater.analyze_pixelarray(pa.PixelArray(frame, metadata={"timestamp": i / FRAMERATE}))
+    gater.shutdown()
+
+    expectedMissed = [0] * 19 + [2, 0, 0]
+    np.testing.assert_array_equal(gater.frame_history["frames_missed"], expectedMissed)
+    unwrapped = gater.frame_history["unwrapped_phase"]
+    np.testing.assert_allclose(unwrapped - unwrapped[0], np.array(frameNumbers) * STEP, atol=0.1)
@@ -0,0 +1,83 @@
+"""Tests that the "fast" heartbeat period search gives identical results to the "reference" implementation."""
+
+# Module imports
+import numpy as np
+import pytest
+
+# Local imports
+from open_optical_gating.cli import determine_reference_period as ref
+
+SETTINGS = [
+    # minPeriod, lowerThresholdFactor, upperThresholdFactor
+    (5, 0.5, 0.75),
+    (2, 0.5, 0.75),
+    (10, 0.3, 0.9),
+    (3, 0.1, 0.2),
+]
+
+
+def noisy_sine(length, period, noise, rng):
+    # Diffs between the most recent frame and each earlier one are smallest a whole number of periods back
+    d = length - 1 - np.arange(length)
+    return 1000 * (1 - np.cos(2 * np.pi * d / period)) + rng.normal(0, noise, length)
+
+
+def diff_arrays():
+    rng = np.random.default_rng(0)
+    arrays = []
+    for length in (0, 1, 2, 3, 4, 6, 10):
+        arrays.append(rng.uniform(0, 100, length))
+    for _ in range(50):
+        length = int(rng.integers(5, 200))
+        arrays.append(noisy_sine(length, rng.uniform(4, 40), rng.uniform(0, 300), rng))
+        arrays.append(rng.uniform(0, 100, length))
+        arrays.append(rng.integers(0, 5, length).astype(float))
+    # No period to be found
+    arrays.append(np.zeros(50))
+    arrays.append(np.full(50, 7.0))
+    arrays.append(np.arange(50, dtype=float))
+    # Diffs that are not finite
+    withNaN = noisy_sine(60, 15, 10, rng)
+    withNaN[20] = np.nan
+    arrays.append(withNaN)
+    arrays.append(np.full(30, np.nan))
+    # A flat minimum, so that the sub-frame fit divides by zero
+    flat = noisy_sine(60, 20, 0, rng)
+    flat[38:43] = 0
+    arrays.append(flat)
+    return arrays
+
+
+@pytest.mark.parametrize("minPeriod, lower, upper", SETTINGS)
+def test_fast_matches_reference(minPeriod, lower, upper):
+    numFound = 0
+    for diffs in diff_arrays():
+        with np.errstate(all="ignore"):
+            expected = ref.calculate_period_length(diffs, minPeriod, lower, upper, method="reference")
+            actual = ref.calculate_period_length(diffs, minPeriod, lower, upper, method="fast")
+        # (treats NaN as equal to NaN)
+        np.testing.assert_equal(actual, expected)
+        numFound += expected != -1
+    # Make sure we are not just comparing failures
+    assert numFound > 20
+
+
+@pytest.mark.parametrize("minPeriod, lower, upper", SETTINGS)
+def test_search_matches_reference(minPeriod, lower, upper):
+    for diffs in diff_arrays():
+        if diffs.size < 1:
+            continue
+        expected = ref.period_search_reference(diffs, minPeriod, lower, upper)
+        actual = ref._period_search_fast(diffs, minPeriod, float(lower), float(upper))
+        assert actual == (-1 if expected is None else expected)
+
+
+def test_too_few_diffs():
+    for method in ("reference", "fast"):
+        assert ref.calculate_period_length(np.zeros(0), method=method) == -1
+        assert ref.calculate_period_length(np.ones(1), method=method) == -1
+
+
+def test_unknown_method():
+    with pytest.raises(ValueError):
+        ref.calculate_period_length(np.ones(10), method="slow")
@@ -0,0 +1,62 @@
+"""Tests comparing parallel phase stamping (phase_stamp.phase_stamp) with running the frames through an OpticalGater."""
+
+# Python imports
+import copy
+
+# Module imports
+import numpy as np
+import pytest
+
+tifffile = pytest.importorskip("tifffile")
+
+# Local imports
+from open_optical_gating.cli import file_optical_gater
+from open_optical_gating.cli import phase_stamp
+from open_optical_gating.cli.alignment_soak_benchmark import synthetic_sequence
+
+PERIOD = 20.3
+FRAMERATE = 80.0
+SHAPE = (32, 32)
+
+
+def drifting_frames(numFrames, rng):
+    # The heart moves one pixel to the right every 25 frames
+    frames = np.zeros((numFrames,) + SHAPE, dtype=np.uint8)
+    for i in range(numFrames):
+        frame = synthetic_sequence(PERIOD, 0, SHAPE, 2 * np.pi * i / PERIOD, rng)[0]
+        frames[i] = np.roll(frame, i // 25, axis=1)
+    return frames
+
+
+def test_parallel_matches_serial_gater_on_drifting_sequence(tmp_path):
+    rng = np.random.default_rng(1)
+    path = str(tmp_path / "drifting.tif")
+    tifffile.imwrite(path, drifting_frames(300, rng))
+    ref_frames = synthetic_sequence(PERIOD, 2, SHAPE, 0, rng)
+
+    settings = {
+        "path": path,
+        "brightfield_framerate": FRAMERATE,
+        "frame_buffer_length": 1000,
+        "period_dir": str(tmp_path) + "/",
+        "update_after_n_triggers": 10 ** 9,
+        "prediction_latency_s": 0.015,
+        "min_heart_rate_hz": 1.0,
+        "virtual_clock": True,
+        "pog_settings": {"drift": [0, 0]},
+    }
+    gater = file_optical_gater.FileOpticalGater(
+        source=path, settings=settings, ref_frames=ref_frames, ref_frame_period=PERIOD
+    )
+    # Phase stamping starts from the same settings (and drift estimate) as the gater
+    pog_settings = copy.deepcopy(gater.pog_settings)
+    gater.run_server()
+    gater.shutdown()
+
+    # Chunks much shorter than the time taken to drift by a pixel, and too little warmup to catch up with the drift
+    results = phase_stamp.phase_stamp(
+        path, ref_frames, pog_settings, chunk_size=40, warmup=2, workers=2
+    )
+    assert tuple(results["drift"][-1]) != (0, 0)
+    assert np.array_equal(results["sad_min"], gater.frame_history["sad_min"])
+    assert np.array_equal(results["unwrapped_phase"], gater.frame_history["unwrapped_phase"])
@@ -0,0 +1,121 @@
+"""Tests for the quality-of-service controller (qos.QoSController)."""
+
+# Module imports
+import pytest
+
+# Local imports
+from open_optical_gating.cli import parameters
+from open_optical_gating.cli import qos
+
+FRAME_INTERVAL = 0.01
+HIGH = 1.0 * FRAME_INTERVAL     # processing time giving a load above degrade_load
+MIDDLE = 0.75 * FRAME_INTERVAL  # between the two thresholds
+LOW = 0.3 * FRAME_INTERVAL      # below restore_load
+OVERRIDDEN_KEYS = ("drift_update_interval", "phase_search_window", "pyramid_levels")
+
+
+def make_settings(**kwargs):
+    return parameters.initialise(framerate=1 / FRAME_INTERVAL, drift=[0, 0], **kwargs)
+
+
+def make_controller():
+    # No smoothing, so that each frame's load is used directly
+    return qos.QoSController(FRAME_INTERVAL, patience=3, smoothing=1.0)
+
+
+def feed(controller, settings, processing_time, numFrames):
+    decisions = [controller.update(processing_time, settings) for _ in range(numFrames)]
+    return [d for d in decisions if d is not None]
+
+
+def test_hysteresis():
+    controller = make_controller()
+    settings = make_settings()
+    # Not enough frames in a row to change level
+    assert feed(controller, settings, HIGH, 2) == []
+    assert feed(controller, settings, MIDDLE, 1) == []
+    assert feed(controller, settings, HIGH, 2) == []
+    assert controller.level == 0
+    assert len(feed(controller, settings, HIGH, 1)) == 1
+    assert controller.level == 1
+    # A load between the thresholds changes nothing, however long it lasts
+    assert feed(controller, settings, MIDDLE, 20) == []
+    assert controller.level == 1
+    assert feed(controller, settings, LOW, 2) == []
+    assert feed(controller, settings, MIDDLE, 1) == []
+    assert feed(controller, settings, LOW, 2) == []
+    assert controller.level == 1
+    assert len(feed(controller, settings, LOW, 1)) == 1
+    assert controller.level == 0
+    # Already at full quality
+    assert feed(controller, settings, LOW, 20) == []
+    assert controller.level == 0
+
+
+def test_full_cycle_restores_baseline():
+    controller = make_controller()
+    settings = make_settings(drift_update_interval=1, phase_search_window=0, pyramid_levels=0)
+    original = {k: settings[k] for k in OVERRIDDEN_KEYS}
+
+    expected = [
+        (1, {"drift_update_interval": 2, "phase_search_window": 0, "pyramid_levels": 0}),
+        (2, {"drift_update_interval": 4, "phase_search_window": 3, "pyramid_levels": 0}),
+        (3, {"drift_update_interval": 4, "phase_search_window": 3, "pyramid_levels": 1}),
+        (4, {"drift_update_interval": 8, "phase_search_window": 3, "pyramid_levels": 1}),
+    ]
+    for level, values in expected:
+        assert len(feed(controller, settings, HIGH, 3)) == 1
+        assert controller.level == level
+        assert {k: settings[k] for k in OVERRIDDEN_KEYS} == values
+        assert controller.skip_bookkeeping == (level >= qos.SKIP_BOOKKEEPING_LEVEL)
+    # No further to go
+    assert feed(controller, settings, HIGH, 10) == []
+    assert controller.level == len(qos.LEVELS) - 1
+
+    for level, values in reversed([(0, original)] + expected[:-1]):
+        assert len(feed(controller, settings, LOW, 3)) == 1
+        assert controller.level == level
+        assert {k: settings[k] for k in OVERRIDDEN_KEYS} == values
+    assert not controller.skip_bookkeeping
+
+
+def test_never_makes_settings_more_expensive():
+    controller = make_controller()
+    settings = make_settings(drift_update_interval=16, phase_search_window=2, pyramid_levels=2)
+    feed(controller, settings, HIGH, 3 * (len(qos.LEVELS) - 1))
+    assert controller.level == len(qos.LEVELS) - 1
+    assert settings["drift_update_interval"] == 16
+    assert settings["phase_search_window"] == 2
+    assert settings["pyramid_levels"] == 2
+
+
+def test_changes_at_full_quality_are_kept():
+    controller = make_controller()
+    settings = make_settings(drift_update_interval=1)
+    feed(controller, settings, HIGH, 3)
+    feed(controller, settings, LOW, 3)
+    assert controller.level == 0
+    # Changed by someone else while at full quality: this is the new baseline
+    settings["drift_update_interval"] = 3
+    feed(controller, settings, HIGH, 3)
+    assert settings["drift_update_interval"] == 3
+    feed(controller, settings, HIGH, 3)
+    assert settings["drift_update_interval"] == 4
+    feed(controller, settings, LOW, 6)
+    assert controller.level == 0
+    assert settings["drift_update_interval"] == 3
+
+
+def test_changes_while_degraded_are_undone():
+    controller = make_controller()
+    settings = make_settings(phase_search_window=0)
+    feed(controller, settings, HIGH, 3)
+    settings["phase_search_window"] = 5
+    feed(controller, settings, LOW, 3)
+    assert controller.level == 0
+    assert settings["phase_search_window"] == 0
+
+
+def test_invalid_thresholds():
+    with pytest.raises(ValueError):
+        qos.QoSController(FRAME_INTERVAL, degrade_load=0.5, restore_load=0.6)
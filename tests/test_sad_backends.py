@@ -0,0 +1,106 @@
+"""Tests that every SAD backend available on this machine gives identical results."""
+
+# Module imports
+import numpy as np
+import pytest
+
+# Local imports
+from open_optical_gating.cli import sad_backends
+
+BACKENDS = sad_backends.available_backends()
+
+
+def expected_sads(frame, reference_frames):
+    # Straightforward (slow, but obviously correct) calculation
+    diffs = np.abs(np.asarray(reference_frames, dtype=np.int64) - np.asarray(frame, dtype=np.int64))
+    return diffs.reshape(diffs.shape[0], -1).sum(axis=1)
+
+
+def make_frames(dtype, rng, shape=(24, 40, 36)):
+    # Use the whole range of the pixel type, so that any overflow in the differences would show up
+    high = np.iinfo(dtype).max
+    references = rng.integers(0, high, shape, endpoint=True).astype(dtype)
+    frame = rng.integers(0, high, shape[1:], endpoint=True).astype(dtype)
+    return frame, references
+
+
+def stacks(dtype):
+    rng = np.random.default_rng(0)
+    frame, references = make_frames(dtype, rng)
+    yield "whole", frame, references
+    # As used in phase matching: a cropped region of interest, which is a non-contiguous view onto each frame
+    yield "cropped", frame[3:-5, 2:-7], references[:, 3:-5, 2:-7]
+    # Every other reference frame
+    yield "strided", frame, references[::2]
+
+
+@pytest.mark.parametrize("backend_name", BACKENDS)
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16])
+def test_sad_with_references(backend_name, dtype):
+    backend = sad_backends.get_backend(backend_name)
+    for description, frame, references in stacks(dtype):
+        assert not references.flags.c_contiguous or description == "whole"
+        SADs = backend.sad_with_references(frame, references)
+        np.testing.assert_array_equal(SADs, expected_sads(frame, references), err_msg=description)
+
+
+@pytest.mark.parametrize("backend_name", BACKENDS)
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16])
+def test_sad_correlation(backend_name, dtype):
+    backend = sad_backends.get_backend(backend_name)
+    for description, frame, references in stacks(dtype):
+        assert backend.sad_correlation(frame, references[1]) == expected_sads(frame, references[1:2])[0], description
+
+
+@pytest.mark.parametrize("backend_name", BACKENDS)
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16])
+def test_sad_pairs(backend_name, dtype):
+    backend = sad_backends.get_backend(backend_name)
+    rng = np.random.default_rng(1)
+    frames, references = make_frames(dtype, rng)
+    frames = frames[np.newaxis]
+    frames = np.concatenate([frames, references[:4] // 2])[:, 3:-5, 2:-7]
+    references = references[:, 3:-5, 2:-7]
+    frame_indices = rng.integers(0, len(frames), 30)
+    reference_indices = rng.integers(0, len(references), 30)
+    SADs = backend.sad_pairs(frames, references, frame_indices, reference_indices)
+    expected = [expected_sads(frames[f], references[k : k + 1])[0] for f, k in zip(frame_indices, reference_indices)]
+    np.testing.assert_array_equal(SADs, expected)
+
+
+@pytest.mark.parametrize("backend_name", BACKENDS)
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16])
+def test_sad_early_abandon(backend_name, dtype):
+    backend = sad_backends.get_backend(backend_name)
+    if backend.sad_early_abandon is None:
+        pytest.skip("{0} backend does not support early abandoning".format(backend_name))
+    for description, frame, references in stacks(dtype):
+        # Make one reference frame a close match, so that plenty of the others are abandoned
+        references = references.copy()
+        references[5] = frame
+        expected = expected_sads(frame, references)
+        order = np.arange(len(references))[::-1]
+        SADs, complete = backend.sad_early_abandon(
+            frame, references, order, np.ones(len(references), dtype=bool), 0.0, 4
+        )
+        assert complete[5] and SADs[5] == 0, description
+        assert not complete.all(), description
+        np.testing.assert_array_equal(SADs[complete], expected[complete], err_msg=description)
+        assert np.all(SADs[~complete] <= expected[~complete]), description
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16])
+def test_backends_agree(dtype):
+    for description, frame, references in stacks(dtype):
+        results = [sad_backends.get_backend(name).sad_with_references(frame, references) for name in BACKENDS]
+        for name, SADs in zip(BACKENDS[1:], results[1:]):
+            np.testing.assert_array_equal(SADs, results[0], err_msg="{0} ({1})".format(name, description))
+
+
+def test_auto_is_one_of_the_available_backends():
+    assert sad_backends.get_backend("auto").name in BACKENDS
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        sad_backends.get_backend("abacus")